@@ -73,6 +73,7 @@ class ConversationConfigResource(BaseResource):
 
             conversation.set_config(conv_config)
             yield conversation.save()
+            yield conversation.notify_config_changed()
         else:
             request.setResponseCode(http.BAD_REQUEST)
 
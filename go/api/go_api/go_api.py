@@ -230,7 +230,7 @@ class GoApiServer(JSONRPC, GoApiSubHandler):
 
         def save_routing_table(user_account, routing_table):
             user_account.routing_table = routing_table
-            return user_account.save()
+            return self.vumi_api.save_user_account(user_account)
 
         def swallow_result(result):
             return None
@@ -259,6 +259,9 @@ class GoApiWorker(BaseWorker):
             "Redis client configuration.", default={}, static=True)
         riak_manager = ConfigDict(
             "Riak client configuration.", default={}, static=True)
+        routing_table_dispatcher_name = ConfigText(
+            "Worker name of the routing table dispatcher, for sending it"
+            " commands.", default='routing_table_dispatcher', static=True)
 
     _web_service = None
 
@@ -276,7 +279,9 @@ class GoApiWorker(BaseWorker):
         self.vumi_api = yield VumiApi.from_config_async({
             'redis_manager': config.redis_manager,
             'riak_manager': config.riak_manager,
-        })
+            'routing_table_dispatcher_name': (
+                config.routing_table_dispatcher_name),
+        }, self._amqp_client)
         self.realm = GoUserRealm(self._rpc_resource_for_user)
         site = build_web_site({
             config.web_path: GoUserAuthSessionWrapper(
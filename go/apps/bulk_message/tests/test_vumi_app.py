@@ -238,6 +238,31 @@ class TestBulkMessageApplication(AppWorkerTestCase):
                 u'messages_received': [1],
                 }, metrics)
 
+    @inlineCallbacks
+    def test_collect_metrics_bulk(self):
+        conv1 = yield self.create_conversation()
+        yield self.start_conversation(conv1)
+        conv2 = yield self.create_conversation()
+        yield self.start_conversation(conv2)
+
+        mkid = TransportUserMessage.generate_id
+        yield self.store_outbound_msg(
+            self.mkmsg_out("out 1", message_id=mkid()), conv1)
+        yield self.store_inbound_msg(
+            self.mkmsg_in("in 1", message_id=mkid()), conv2)
+
+        yield self.dispatch_command(
+            'collect_metrics_bulk', conversations=[
+                [self.user_account.key, conv1.key],
+                [self.user_account.key, conv2.key]])
+        akey = self.user_account.key
+        self.assertEqual({
+                '%s.%s.messages_sent' % (akey, conv1.key): [1],
+                '%s.%s.messages_received' % (akey, conv1.key): [0],
+                '%s.%s.messages_sent' % (akey, conv2.key): [0],
+                '%s.%s.messages_received' % (akey, conv2.key): [1],
+                }, self.poll_metrics())
+
     @inlineCallbacks
     def test_reconcile_cache(self):
         conv = yield self.create_conversation()
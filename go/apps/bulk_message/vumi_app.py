@@ -99,25 +99,28 @@ class BulkMessageApplication(GoApplicationWorker):
 
     @inlineCallbacks
     def handle_event(self, event):
-        message = yield self.find_message_for_event(event)
-        if message is None:
+        info = yield self.find_message_info_for_event(event)
+        if info is None:
             log.error('Unable to find message for %s, user_message_id: %s' % (
                 event['event_type'], event.get('user_message_id')))
             return
 
-        msg_mdh = self.get_metadata_helper(message)
-        conv = yield msg_mdh.get_conversation()
-        if conv:
-            window_id = self.get_window_id(conv.key, conv.batch.key)
-            flight_key = yield self.window_manager.get_internal_id(window_id,
-                                message['message_id'])
-            yield self.window_manager.remove_key(window_id, flight_key)
+        window_id = self.get_window_id(
+            info['conversation_key'], info['batch_key'])
+        flight_key = yield self.window_manager.get_internal_id(window_id,
+                            event['user_message_id'])
+        yield self.window_manager.remove_key(window_id, flight_key)
 
     @inlineCallbacks
     def collect_metrics(self, user_api, conversation_key):
         conv = yield user_api.get_wrapped_conversation(conversation_key)
         yield self.collect_message_metrics(conv)
 
+    @inlineCallbacks
+    def collect_metrics_bulk(self, conversations):
+        convs = yield self.get_conversations(conversations)
+        yield self.collect_message_metrics_bulk(convs)
+
     @inlineCallbacks
     def process_command_initial_action_hack(self, user_account_key,
                                             conversation_key, **kwargs):
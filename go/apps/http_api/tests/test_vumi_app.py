@@ -430,6 +430,7 @@ class StreamingHTTPWorkerTestCase(AppWorkerTestCase):
             'push_message_url': self.mock_push_server.url,
         })
         yield self.conversation.save()
+        yield self.notify_config_changed(self.conversation)
 
         msg = self.mkmsg_in(content='in 1', message_id='1')
         msg_d = self.dispatch_to_conv(msg, self.conversation)
@@ -449,6 +450,7 @@ class StreamingHTTPWorkerTestCase(AppWorkerTestCase):
             'push_event_url': self.mock_push_server.url,
         })
         yield self.conversation.save()
+        yield self.notify_config_changed(self.conversation)
 
         msg1 = self.mkmsg_out(content='in 1', message_id='1')
         self.conversation.set_go_helper_metadata(msg1['helper_metadata'])
@@ -125,9 +125,8 @@ class StreamingHTTPWorker(GoApplicationWorker):
     @inlineCallbacks
     def consume_user_message(self, message):
         msg_mdh = self.get_metadata_helper(message)
-        user_api = msg_mdh.get_user_api()
-        conv_key = msg_mdh.get_conversation_key()
-        conversation = yield user_api.get_wrapped_conversation(conv_key)
+        conversation = yield self.get_conversation(
+            msg_mdh.get_account_key(), msg_mdh.get_conversation_key())
         if conversation is None:
             log.warning("Cannot find conversation for message: %r" % (
                 message,))
@@ -146,14 +145,10 @@ class StreamingHTTPWorker(GoApplicationWorker):
     @inlineCallbacks
     def consume_unknown_event(self, event):
         """
-        FIXME:  We're forced to do too much hoopla when trying to link events
-                back to the conversation the original message was part of.
+        The routing table dispatcher copies the original message's
+        conversation metadata onto the event, so the conversation is found
+        without looking up the message.
         """
-        outbound_message = yield self.find_outboundmessage_for_event(event)
-        if outbound_message is None:
-            log.warning('Unable to find message %s for event %s.' % (
-                event['user_message_id'], event['event_id']))
-
         config = yield self.get_message_config(event)
         conversation = config.get_conversation()
         push_event_url = self.get_api_config(conversation, 'push_event_url')
@@ -192,3 +192,8 @@ class SequentialSendApplication(GoApplicationWorker):
     def collect_metrics(self, user_api, conversation_key):
         conv = yield user_api.get_wrapped_conversation(conversation_key)
         yield self.collect_message_metrics(conv)
+
+    @inlineCallbacks
+    def collect_metrics_bulk(self, conversations):
+        convs = yield self.get_conversations(conversations)
+        yield self.collect_message_metrics_bulk(convs)
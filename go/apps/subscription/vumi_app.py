@@ -32,12 +32,8 @@ class SubscriptionApplication(GoApplicationWorker):
     @inlineCallbacks
     def consume_user_message(self, message):
         msg_mdh = self.get_metadata_helper(message)
-        user_api = self.get_user_api(msg_mdh.get_account_key())
         conv = yield msg_mdh.get_conversation()
-
-        delivery_class = user_api.delivery_class_for_msg(message)
-        contact = yield user_api.contact_store.contact_for_addr(
-            delivery_class, message['from_addr'], create=True)
+        contact = yield msg_mdh.get_contact(create=True)
         # We're guaranteed to have a contact here, because we create one if we
         # can't find an existing one.
 
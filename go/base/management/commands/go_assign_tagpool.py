@@ -86,4 +86,4 @@ class Command(BaseCommand):
         permission.save()
 
         account.tagpools.add(permission)
-        account.save()
+        api.save_user_account(account)
@@ -246,7 +246,7 @@ class Command(BaseCommand):
         permission.save()
 
         account.tagpools.add(permission)
-        account.save()
+        self.api.save_user_account(account)
         return permission
 
     def assign_application(self, account, application_module):
@@ -255,7 +255,7 @@ class Command(BaseCommand):
         app_permission.save()
 
         account.applications.add(app_permission)
-        account.save()
+        self.api.save_user_account(account)
         return app_permission
 
     def setup_channels(self, user, channels):
@@ -345,9 +345,10 @@ class Command(BaseCommand):
             rt.add_entry(
                 str(connectors[src]), src_ep, str(connectors[dst]), dst_ep)
 
-        user_account = vumi_api_for_user(user).get_user_account()
+        user_api = vumi_api_for_user(user)
+        user_account = user_api.get_user_account()
         user_account.routing_table = rt.routing_table
-        user_account.save()
+        user_api.api.save_user_account(user_account)
 
         self.stdout.write('Routing table for %s built\n' % (user.email,))
 
@@ -443,12 +444,20 @@ class Command(BaseCommand):
             cp.write(fp)
         self.stdout.write('Wrote %s.\n' % (fn,))
 
+    def get_routing_table_dispatcher_name(self):
+        return self.config.get(
+            'routing_table_dispatcher_name',
+            VumiApi.routing_table_dispatcher_name)
+
     def create_command_dispatcher_config(self, applications, routers):
         worker_names = []
         worker_names.extend(
             '%s_application' % (app_name,) for app_name in applications)
         worker_names.extend(
             '%s_router' % (router_name,) for router_name in routers)
+        # Routing table invalidation commands are sent to the routing table
+        # dispatcher, so the command dispatcher needs to forward to it too.
+        worker_names.append(self.get_routing_table_dispatcher_name())
         fn = self.mk_filename('command_dispatcher', 'yaml')
         with self.open_file(fn, 'w') as fp:
             self.write_yaml(fp, {
@@ -476,6 +485,7 @@ class Command(BaseCommand):
         with self.open_file(fn, 'w') as fp:
             templ = 'routing_table_dispatcher.yaml.template'
             data = self.render_template(templ, {
+                'worker_name': self.get_routing_table_dispatcher_name(),
                 'transport_names': transports,
                 'application_names': [
                     '%s_transport' % (app,) for app in applications],
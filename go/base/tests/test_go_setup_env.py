@@ -326,6 +326,7 @@ class GoBootstrapEnvTestCase(VumiGoDjangoTestCase):
 
         self.assertEqual(config['redis_manager'], {'key_prefix': 'test'})
         self.assertEqual(config['riak_manager'], {'bucket_prefix': 'test.'})
+        self.assertEqual(config['worker_name'], 'routing_table_dispatcher')
 
     def test_create_command_dispatcher_config(self):
         fake_file = FakeFile()
@@ -337,7 +338,17 @@ class GoBootstrapEnvTestCase(VumiGoDjangoTestCase):
         self.assertEqual(config['transport_name'],
             'command_dispatcher')
         self.assertEqual(config['worker_names'],
-            ['app1_application', 'app2_application', 'router1_router'])
+            ['app1_application', 'app2_application', 'router1_router',
+             'routing_table_dispatcher'])
+
+    def test_create_command_dispatcher_config_dispatcher_name(self):
+        self.command.config['routing_table_dispatcher_name'] = 'rtd'
+        fake_file = FakeFile()
+        self.command.open_file = Mock(side_effect=[fake_file])
+        self.command.create_command_dispatcher_config(['app1'], [])
+        fake_file.seek(0)
+        config = yaml.safe_load(fake_file)
+        self.assertEqual(config['worker_names'], ['app1_application', 'rtd'])
 
     def test_create_webui_supervisord_conf(self):
         fake_file = FakeFile()
@@ -442,6 +442,7 @@ class EditConversationView(ConversationTemplateView):
         conversation.c.extra_endpoints = self.view_def.get_endpoints(config)
 
         conversation.save()
+        conversation.notify_config_changed()
 
 
 def check_action_is_enabled(f):
@@ -604,6 +605,7 @@ class EditConversationGroupsView(ConversationTemplateView):
         for group_key in group_keys:
             conversation.add_group(group_key)
         conversation.save()
+        conversation.notify_config_changed()
 
         return HttpResponse(
             json.dumps({'success': True}),
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- test-case-name: go.scripts.tests.test_import_profile -*-
+
+"""Report how long the modules of Vumi Go workers take to import.
+
+Usage::
+
+    python -m go.scripts.import_profile [--top N] [module ...]
+
+Each module is imported in a fresh Python process, so that modules shared
+between workers are counted for each of them. If no modules are given,
+all the worker modules in Vumi Go are profiled.
+"""
+
+import glob
+import json
+import os
+import subprocess
+import sys
+from optparse import OptionParser
+
+
+WORKER_MODULES = [
+    'go.vumitools.routing',
+    'go.vumitools.api_worker',
+    'go.vumitools.metrics_worker',
+]
+
+# Run in the child process with the module to profile as its only argument.
+# It prints a JSON object with the total import time, the number of modules
+# imported, whether Django was imported and the time taken by each import
+# statement excluding the imports nested inside it.
+CHILD_SCRIPT = r"""
+import __builtin__
+import json
+import sys
+import time
+
+timings = {}
+stack = []
+original_import = __builtin__.__import__
+
+
+def timed_import(name, *args, **kw):
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return original_import(name, *args, **kw)
+    finally:
+        elapsed = time.time() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        timings[name] = timings.get(name, 0.0) + elapsed - nested
+
+before = len(sys.modules)
+__builtin__.__import__ = timed_import
+start = time.time()
+try:
+    __import__(sys.argv[1])
+finally:
+    __builtin__.__import__ = original_import
+total = time.time() - start
+
+json.dump({
+    'total': total,
+    'modules': len(sys.modules) - before,
+    'django': 'django' in sys.modules,
+    'timings': timings,
+}, sys.stdout)
+"""
+
+
+def find_worker_modules():
+    """Return the names of the worker modules in Vumi Go."""
+    go_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    modules = list(WORKER_MODULES)
+    for package in ('apps', 'routers'):
+        paths = glob.glob(os.path.join(go_dir, package, '*', 'vumi_app.py'))
+        for path in sorted(paths):
+            app = os.path.basename(os.path.dirname(path))
+            modules.append('go.%s.%s.vumi_app' % (package, app))
+    return modules
+
+
+def profile_module(module_name, python=sys.executable):
+    """Import `module_name` in a new process and return its import
+    profile.
+    """
+    # The new process should find the same modules we do.
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    output = subprocess.check_output(
+        [python, '-c', CHILD_SCRIPT, module_name], env=env)
+    return json.loads(output)
+
+
+def format_profile(module_name, profile, top=10):
+    lines = ['%s: %.3fs, %d modules, django: %s' % (
+        module_name, profile['total'], profile['modules'],
+        'yes' if profile['django'] else 'no')]
+    timings = sorted(profile['timings'].iteritems(),
+                     key=lambda item: item[1], reverse=True)
+    for name, elapsed in timings[:top]:
+        lines.append('    %.3fs  %s' % (elapsed, name))
+    return '\n'.join(lines)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [--top N] [module ...]")
+    parser.add_option(
+        '--top', type='int', default=10,
+        help="Number of slowest imports to list for each module.")
+    options, modules = parser.parse_args(argv)
+    for module_name in modules or find_worker_modules():
+        try:
+            profile = profile_module(module_name)
+        except subprocess.CalledProcessError:
+            print '%s: import failed' % (module_name,)
+            continue
+        print format_profile(module_name, profile, options.top)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,38 @@
+"""Tests for go.scripts.import_profile."""
+
+from twisted.trial.unittest import TestCase
+
+from go.scripts.import_profile import (
+    find_worker_modules, profile_module, format_profile)
+
+
+class TestImportProfile(TestCase):
+    def test_find_worker_modules(self):
+        modules = find_worker_modules()
+        self.assertTrue('go.vumitools.routing' in modules)
+        self.assertTrue('go.apps.bulk_message.vumi_app' in modules)
+
+    def test_profile_module(self):
+        profile = profile_module('xml.dom.minidom')
+        self.assertTrue(profile['total'] > 0)
+        self.assertTrue(profile['modules'] > 0)
+        self.assertFalse(profile['django'])
+        self.assertTrue('xml.dom' in profile['timings'])
+
+    def test_format_profile(self):
+        profile = {
+            'total': 1.5,
+            'modules': 12,
+            'django': True,
+            'timings': {'foo': 0.25, 'bar': 1.0, 'baz': 0.125},
+        }
+        self.assertEqual(format_profile('go.foo', profile, top=2), '\n'.join([
+            'go.foo: 1.500s, 12 modules, django: yes',
+            '    1.000s  bar',
+            '    0.250s  foo',
+        ]))
+
+    def test_vumitools_api_without_django(self):
+        # Workers import the API, so it mustn't need Django.
+        profile = profile_module('go.vumitools.api')
+        self.assertFalse(profile['django'])
@@ -1,10 +1,10 @@
 from go.vumitools.account.models import (
     UserTagPermission, UserAppPermission, UserAccount, RoutingTableHelper,
-    AccountStore, PerAccountStore, GoConnector)
+    CompiledRoutingTable, AccountStore, PerAccountStore, GoConnector)
 
 
 __all__ = [
     'UserTagPermission', 'UserAppPermission', 'UserAccount',
-    'RoutingTableHelper', 'AccountStore', 'PerAccountStore',
-    'GoConnector',
+    'RoutingTableHelper', 'CompiledRoutingTable', 'AccountStore',
+    'PerAccountStore', 'GoConnector',
     ]
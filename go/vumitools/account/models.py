@@ -11,6 +11,7 @@ from vumi.persist.fields import (
     Integer, Unicode, Timestamp, ManyToMany, Json, Boolean)
 
 from go.vumitools.account.migrations import UserAccountMigrator
+from go.vumitools.cache import LRUCache
 
 
 class UserTagPermission(Model):
@@ -62,6 +63,86 @@ class UserAccount(Model):
         returnValue(False)
 
 
+class CompiledRoutingTable(object):
+    """Indexes over a routing table dictionary for fast lookups.
+
+    The forward index is the routing table dictionary itself. A reverse
+    index from destination connectors to sources is built once on
+    construction, and the transitive targets and sources of each connector
+    are computed at most once and then remembered.
+
+    The routing table dictionary is not copied, so it serialises to the
+    same JSON as before. If it is modified, a new compiled table should be
+    built.
+    """
+
+    def __init__(self, routing_table):
+        self.routing_table = routing_table
+        self._sources = {}
+        for src_conn, routes in routing_table.iteritems():
+            for src_endpoint, (dst_conn, dst_endpoint) in routes.iteritems():
+                self._sources.setdefault(dst_conn, []).append(
+                    (dst_endpoint, [src_conn, src_endpoint]))
+        self._other_sides = {}
+        self._transitive_targets = {}
+        self._transitive_sources = {}
+
+    def lookup_targets(self, src_conn):
+        return self.routing_table.get(src_conn, {}).items()
+
+    def lookup_sources(self, dst_conn):
+        return [(dst_endpoint, list(source))
+                for dst_endpoint, source in self._sources.get(dst_conn, [])]
+
+    def lookup_source(self, dst_conn, dst_endpoint):
+        for endpoint, source in self._sources.get(dst_conn, []):
+            if endpoint == dst_endpoint:
+                return list(source)
+        return None
+
+    def _other_side(self, conn):
+        """Return the connector on the other side of a router connector, or
+        None if `conn` isn't a router connector.
+        """
+        if conn not in self._other_sides:
+            parsed = GoConnector.parse(conn)
+            if parsed.ctype == GoConnector.ROUTER:
+                self._other_sides[conn] = str(parsed.flip_direction())
+            else:
+                self._other_sides[conn] = None
+        return self._other_sides[conn]
+
+    def _closure(self, start_conn, neighbours):
+        pending = [start_conn]
+        seen = set(pending)
+        results = set()
+        while pending:
+            conn = pending.pop()
+            for found_conn in neighbours(conn):
+                results.add(found_conn)
+                extra_conn = self._other_side(found_conn)
+                if extra_conn is not None and extra_conn not in seen:
+                    pending.append(extra_conn)
+                    seen.add(extra_conn)
+        return results
+
+    def transitive_targets(self, src_conn):
+        if src_conn not in self._transitive_targets:
+            self._transitive_targets[src_conn] = self._closure(
+                src_conn, lambda conn: [
+                    dst_conn for dst_conn, _dst_endpoint
+                    in self.routing_table.get(conn, {}).itervalues()])
+        return set(self._transitive_targets[src_conn])
+
+    def transitive_sources(self, dst_conn):
+        if dst_conn not in self._transitive_sources:
+            self._transitive_sources[dst_conn] = self._closure(
+                dst_conn, lambda conn: [
+                    src_conn for _dst_endpoint, (src_conn, _src_endpoint)
+                    in self._sources.get(conn, [])])
+        return set(self._transitive_sources[dst_conn])
+
+
 class RoutingTableHelper(object):
     """Helper for dealing with routing table dictionaries.
 
@@ -76,10 +157,30 @@ class RoutingTableHelper(object):
 
     in order to make storing the mapping as JSON easier (JSON keys cannot be
     lists).
+
+    Reverse lookups use a :class:`CompiledRoutingTable` that is built on
+    first use and kept until the table is modified through this helper or
+    the routing table dictionary is replaced. Code that modifies the
+    dictionary directly must call :meth:`invalidate` before using the
+    helper again (or use a new helper).
     """
 
     def __init__(self, routing_table):
         self.routing_table = routing_table
+        self._compiled = None
+
+    @property
+    def compiled(self):
+        compiled = self._compiled
+        if (compiled is None
+                or compiled.routing_table is not self.routing_table):
+            compiled = CompiledRoutingTable(self.routing_table)
+            self._compiled = compiled
+        return compiled
+
+    def invalidate(self):
+        """Discard the compiled routing table."""
+        self._compiled = None
 
     def lookup_target(self, src_conn, src_endpoint):
         return self.routing_table.get(src_conn, {}).get(src_endpoint)
@@ -88,19 +189,10 @@ class RoutingTableHelper(object):
         return self.routing_table.get(src_conn, {}).items()
 
     def lookup_source(self, target_conn, target_endpoint):
-        for src_conn, routes in self.routing_table.iteritems():
-            for src_endpoint, (dst_conn, dst_endpoint) in routes.items():
-                if dst_conn == target_conn and dst_endpoint == target_endpoint:
-                    return [src_conn, src_endpoint]
-        return None
+        return self.compiled.lookup_source(target_conn, target_endpoint)
 
     def lookup_sources(self, target_conn):
-        sources = []
-        for src_conn, routes in self.routing_table.iteritems():
-            for src_endpoint, (dest_conn, dest_endpoint) in routes.items():
-                if dest_conn == target_conn:
-                    sources.append((dest_endpoint, [src_conn, src_endpoint]))
-        return sources
+        return self.compiled.lookup_sources(target_conn)
 
     def entries(self):
         """Iterate over entries in the routing table.
@@ -113,6 +205,7 @@ class RoutingTableHelper(object):
 
     def add_entry(self, src_conn, src_endpoint, dst_conn, dst_endpoint):
         self.validate_entry(src_conn, src_endpoint, dst_conn, dst_endpoint)
+        self.invalidate()
         connector_dict = self.routing_table.setdefault(src_conn, {})
         if src_endpoint in connector_dict:
             log.warning(
@@ -129,6 +222,7 @@ class RoutingTableHelper(object):
                     src_conn, src_endpoint))
             return None
 
+        self.invalidate()
         old_dest = connector_dict.pop(src_endpoint)
 
         if not connector_dict:
@@ -142,21 +236,21 @@ class RoutingTableHelper(object):
 
         Useful when the connector is going away for some reason.
         """
+        sources = self.lookup_sources(conn)
+        self.invalidate()
+
         # remove entries with connector as source
         self.routing_table.pop(conn, None)
 
-        # remove entires with connector as destination
-        to_remove = []
-        for src_conn, routes in self.routing_table.iteritems():
-            for src_endpoint, (dest_conn, dest_endpoint) in routes.items():
-                if dest_conn == conn:
-                    del routes[src_endpoint]
+        # remove entries with connector as destination
+        for _dest_endpoint, (src_conn, src_endpoint) in sources:
+            routes = self.routing_table.get(src_conn)
+            if routes is None:
+                # The connector routed to itself and is already gone.
+                continue
+            routes.pop(src_endpoint, None)
             if not routes:
-                # We can't modify this dict while iterating over it.
-                to_remove.append(src_conn)
-
-        for src_conn in to_remove:
-            del self.routing_table[src_conn]
+                del self.routing_table[src_conn]
 
     def remove_conversation(self, conv):
         """Remove all entries linking to or from a given conversation.
@@ -217,22 +311,7 @@ class RoutingTableHelper(object):
         :param str src_conn: source connector to start search with.
         :rtype: set of destination connector strings.
         """
-        sources = [src_conn]
-        sources_seen = set(sources)
-        results = set()
-        while sources:
-            source = sources.pop()
-            destinations = self.lookup_targets(source)
-            for _src_endpoint, (dst_conn, _dst_endpoint) in destinations:
-                results.add(dst_conn)
-                parsed_dst = GoConnector.parse(dst_conn)
-                if parsed_dst.ctype != GoConnector.ROUTER:
-                    continue
-                extra_src = str(parsed_dst.flip_direction())
-                if extra_src not in sources_seen:
-                    sources.append(extra_src)
-                    sources_seen.add(extra_src)
-        return results
+        return self.compiled.transitive_targets(src_conn)
 
     def transitive_sources(self, dst_conn):
         """Return all connectors that lead to `dst_conn`.
@@ -254,22 +333,7 @@ class RoutingTableHelper(object):
         :param str dst_conn: destination connector to start search with.
         :rtype: set of source connector strings.
         """
-        destinations = [dst_conn]
-        destinations_seen = set(destinations)
-        results = set()
-        while destinations:
-            destination = destinations.pop()
-            sources = self.lookup_sources(destination)
-            for _dst_endpoint, (src_conn, _src_endpoint) in sources:
-                results.add(src_conn)
-                parsed_src = GoConnector.parse(src_conn)
-                if parsed_src.ctype != GoConnector.ROUTER:
-                    continue
-                extra_dst = str(parsed_src.flip_direction())
-                if extra_dst not in destinations_seen:
-                    destinations.append(extra_dst)
-                    destinations_seen.add(extra_dst)
-        return results
+        return self.compiled.transitive_sources(dst_conn)
 
     def validate_entry(self, src_conn, src_endpoint, dst_conn, dst_endpoint):
         """Validate the provided entry.
@@ -298,7 +362,15 @@ class GoConnectorError(Exception):
 
 
 class GoConnector(object):
-    """Container for Go routing table connector item."""
+    """Container for Go routing table connector item.
+
+    Connectors are treated as immutable. Connectors returned by
+    :meth:`parse` are interned in a bounded table keyed by connector
+    string, so parsing a string seen recently is a single lookup. Each
+    connector formats its string form at most once.
+    """
+
+    __slots__ = ('ctype', '_names', '_parts', '_str')
 
     # Types of connectors in Go routing tables
 
@@ -312,26 +384,44 @@ class GoConnector(object):
     INBOUND = "INBOUND"
     OUTBOUND = "OUTBOUND"
 
+    # Directions for non-router entries
+
+    _DIRECTIONS = {
+        OPT_OUT: INBOUND,
+        CONVERSATION: INBOUND,
+        TRANSPORT_TAG: OUTBOUND,
+    }
+
+    # Parsed connectors, keyed by connector string.
+
+    _parse_cache = LRUCache(10000)
+
     def __init__(self, ctype, names, parts):
         self.ctype = ctype
-        self._names = names
-        self._parts = parts
-        self._attrs = dict(zip(self._names, self._parts))
+        self._names = tuple(names)
+        self._parts = tuple(parts)
+        self._str = None
 
     @property
     def direction(self):
-        return {
-            self.OPT_OUT: self.INBOUND,
-            self.CONVERSATION: self.INBOUND,
-            self.TRANSPORT_TAG: self.OUTBOUND,
-            self.ROUTER: self._attrs.get('direction'),
-        }[self.ctype]
+        if self.ctype == self.ROUTER:
+            return self._parts[2]
+        return self._DIRECTIONS[self.ctype]
 
     def __str__(self):
-        return ":".join([self.ctype] + self._parts)
+        if self._str is None:
+            self._str = ":".join((self.ctype,) + self._parts)
+        return self._str
 
     def __getattr__(self, name):
-        return self._attrs[name]
+        # Only called for names that aren't slots or class attributes. Slots
+        # that haven't been set yet must not be looked up here.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._parts[self._names.index(name)]
+        except ValueError:
+            raise AttributeError(name)
 
     def flip_direction(self):
         if self.ctype != self.ROUTER:
@@ -345,26 +435,35 @@ class GoConnector(object):
 
     @classmethod
     def for_conversation(cls, conv_type, conv_key):
-        return cls(cls.CONVERSATION, ["conv_type", "conv_key"],
-                   [conv_type, conv_key])
+        return cls(cls.CONVERSATION, ("conv_type", "conv_key"),
+                   (conv_type, conv_key))
 
     @classmethod
     def for_router(cls, router_type, router_key, direction):
         return cls(cls.ROUTER,
-                   ["router_type", "router_key", "direction"],
-                   [router_type, router_key, direction])
+                   ("router_type", "router_key", "direction"),
+                   (router_type, router_key, direction))
 
     @classmethod
     def for_transport_tag(cls, tagpool, tagname):
-        return cls(cls.TRANSPORT_TAG, ["tagpool", "tagname"],
-                   [tagpool, tagname])
+        return cls(cls.TRANSPORT_TAG, ("tagpool", "tagname"),
+                   (tagpool, tagname))
 
     @classmethod
     def for_opt_out(cls):
-        return cls(cls.OPT_OUT, [], [])
+        return cls(cls.OPT_OUT, (), ())
 
     @classmethod
     def parse(cls, s):
+        conn = cls._parse_cache.get(s)
+        if conn is None:
+            conn = cls._parse(s)
+            conn._str = s
+            cls._parse_cache.set(s, conn)
+        return conn
+
+    @classmethod
+    def _parse(cls, s):
         parts = s.split(":")
         ctype, parts = parts[0], parts[1:]
         constructors = {
@@ -7,7 +7,8 @@ from vumi.tests.utils import UTCNearNow, LogCatcher
 
 from go.vumitools.tests.utils import GoTestCase
 from go.vumitools.account.models import (
-    AccountStore, RoutingTableHelper, GoConnector, GoConnectorError)
+    AccountStore, RoutingTableHelper, CompiledRoutingTable, GoConnector,
+    GoConnectorError)
 from go.vumitools.account.old_models import AccountStoreVNone, AccountStoreV1
 
 
@@ -396,6 +397,114 @@ class RoutingTableHelperTestCase(GoTestCase):
         add_entry(self.CONV_1, "bar", self.CONV_1, "baz")
         self.assertRaises(ValueError, rt.validate_all_entries)
 
+    def test_lookup_sources_after_add_entry(self):
+        rt = self.mk_helper()
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [])
+        rt.add_entry(self.CHANNEL_2, "default", self.CONV_2, "default")
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [
+            ("default", [self.CHANNEL_2, "default"]),
+        ])
+
+    def test_transitive_targets_after_remove_entry(self):
+        rt = self.mk_helper()
+        self.assertEqual(sorted(rt.transitive_targets(self.CONV_1)), [
+            self.CHANNEL_2, self.CHANNEL_3,
+        ])
+        rt.remove_entry(self.CONV_1, "default1.1")
+        self.assertEqual(sorted(rt.transitive_targets(self.CONV_1)), [
+            self.CHANNEL_3,
+        ])
+
+    def test_lookup_sources_after_direct_modification(self):
+        rt = self.mk_helper()
+        routing_table = rt.routing_table
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [])
+        # Code that edits the dict (e.g. user_account.routing_table) without
+        # going through the helper.
+        routing_table[self.CHANNEL_2] = {
+            "default": [self.CONV_2, "default"]}
+        rt.invalidate()
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [
+            ("default", [self.CHANNEL_2, "default"]),
+        ])
+
+    def test_compiled_table_after_routing_table_replaced(self):
+        rt = self.mk_helper()
+        compiled = rt.compiled
+        self.assertIdentical(rt.compiled, compiled)
+        rt.routing_table = copy.deepcopy(self.COMPLEX_ROUTING)
+        self.assertNotIdentical(rt.compiled, compiled)
+
+    def test_repeated_lookups_use_compiled_table(self):
+        rt = self.mk_helper(copy.deepcopy(self.COMPLEX_ROUTING))
+        with mock.patch(
+                'go.vumitools.account.models.CompiledRoutingTable',
+                wraps=CompiledRoutingTable) as compile_table:
+            for _ in range(3):
+                rt.lookup_source(self.CHANNEL_3, "default")
+                rt.lookup_sources(self.ROUTER_1_OUTBOUND)
+                rt.transitive_targets(self.CONV_1)
+                rt.transitive_sources(self.CHANNEL_2)
+            self.assertEqual(compile_table.call_count, 1)
+            rt.add_entry(self.CHANNEL_2, "other", self.CONV_2, "default")
+            rt.lookup_sources(self.CONV_2)
+            self.assertEqual(compile_table.call_count, 2)
+
+    def test_remove_connector_with_routers(self):
+        rt = self.mk_helper(copy.deepcopy(self.COMPLEX_ROUTING))
+        rt.remove_connector(self.ROUTER_1_OUTBOUND)
+        self.assertEqual(sorted(rt.entries()), [
+            (self.CHANNEL_2, "default", self.ROUTER_1_INBOUND, "default"),
+            (self.CONV_2, "sms", self.CHANNEL_3, "default"),
+            (self.ROUTER_1_INBOUND, "default", self.CHANNEL_2, "default"),
+        ])
+
+
+class CompiledRoutingTableTestCase(GoTestCase):
+
+    ROUTING = RoutingTableHelperTestCase.COMPLEX_ROUTING
+
+    def mk_compiled(self):
+        return CompiledRoutingTable(copy.deepcopy(self.ROUTING))
+
+    def test_routing_table_unchanged(self):
+        compiled = self.mk_compiled()
+        self.assertEqual(compiled.routing_table, self.ROUTING)
+
+    def test_lookup_sources(self):
+        compiled = self.mk_compiled()
+        self.assertEqual(
+            sorted(compiled.lookup_sources(
+                RoutingTableHelperTestCase.ROUTER_1_OUTBOUND)), [
+                ("keyword1", [RoutingTableHelperTestCase.CONV_1, "default"]),
+                ("keyword2", [RoutingTableHelperTestCase.CONV_2, "default"]),
+            ])
+
+    def test_lookup_source(self):
+        compiled = self.mk_compiled()
+        self.assertEqual(
+            compiled.lookup_source(
+                RoutingTableHelperTestCase.CHANNEL_3, "default"),
+            [RoutingTableHelperTestCase.CONV_2, "sms"])
+        self.assertEqual(
+            compiled.lookup_source(
+                RoutingTableHelperTestCase.CHANNEL_3, "other"), None)
+
+    def test_transitive_targets_are_remembered(self):
+        compiled = self.mk_compiled()
+        conv_1 = RoutingTableHelperTestCase.CONV_1
+        targets = compiled.transitive_targets(conv_1)
+        self.assertEqual(compiled._transitive_targets, {conv_1: targets})
+        # Modifying the result doesn't affect the remembered value.
+        targets.add("foo")
+        self.assertNotEqual(compiled.transitive_targets(conv_1), targets)
+
+    def test_transitive_sources_are_remembered(self):
+        compiled = self.mk_compiled()
+        conv_1 = RoutingTableHelperTestCase.CONV_1
+        sources = compiled.transitive_sources(conv_1)
+        self.assertEqual(compiled._transitive_sources, {conv_1: sources})
+
 
 class GoConnectorTestCase(GoTestCase):
     def test_create_conversation_connector(self):
@@ -488,3 +597,14 @@ class GoConnectorTestCase(GoTestCase):
             GoConnector.for_router("rb_type_1", "12345", GoConnector.INBOUND))
         assert_outbound(
             GoConnector.for_router("rb_type_1", "12345", GoConnector.OUTBOUND))
+
+    def test_parse_interns_connectors(self):
+        c1 = GoConnector.parse("CONVERSATION:conv_type_1:12345")
+        c2 = GoConnector.parse("CONVERSATION:conv_type_1:12345")
+        self.assertTrue(c1 is c2)
+        self.assertEqual(str(c1), "CONVERSATION:conv_type_1:12345")
+
+    def test_unknown_attribute(self):
+        c = GoConnector.for_conversation("conv_type_1", "12345")
+        self.assertRaises(AttributeError, getattr, c, "tagpool")
+        self.assertFalse(hasattr(c, "router_key"))
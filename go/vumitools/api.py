@@ -3,9 +3,11 @@
 
 """Convenience API, mostly for working with various datastores."""
 
+import json
 from collections import defaultdict
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, Deferred)
 
 from vumi.errors import VumiError
 from vumi.service import Publisher
@@ -20,17 +22,16 @@ from vumi.persist.txredis_manager import TxRedisManager
 from vumi import log
 
 from go.vumitools.account import AccountStore, RoutingTableHelper, GoConnector
+from go.vumitools.cache import LRUCache
 from go.vumitools.channel import ChannelStore
 from go.vumitools.contact import ContactStore
 from go.vumitools.conversation import ConversationStore
 from go.vumitools.router import RouterStore
 from go.vumitools.conversation.utils import ConversationWrapper
 from go.vumitools.credit import CreditManager
+from go.vumitools.tag_ownership import TagOwnershipManager
 from go.vumitools.token_manager import TokenManager
 
-from django.conf import settings
-from django.utils.datastructures import SortedDict
-
 from vumi.message import TransportUserMessage
 
 
@@ -219,6 +220,11 @@ class VumiUserApi(object):
 
     @Manager.calls_manager
     def applications(self):
+        # Django is imported here rather than at module level so that
+        # workers, which never need it, don't pay for loading it.
+        from django.conf import settings
+        from django.utils.datastructures import SortedDict
+
         user_account = yield self.get_user_account()
         # NOTE: This assumes that we don't have very large numbers of
         #       applications.
@@ -235,6 +241,9 @@ class VumiUserApi(object):
 
     @Manager.calls_manager
     def router_types(self):
+        from django.conf import settings
+        from django.utils.datastructures import SortedDict
+
         # TODO: Permissions.
         yield None
         router_settings = settings.VUMI_INSTALLED_ROUTERS
@@ -331,6 +340,7 @@ class VumiUserApi(object):
         tag_info = yield self.api.mdb.get_tag_info(tag)
         tag_info.metadata['user_account'] = user_account.key.decode('utf-8')
         yield tag_info.save()
+        yield self.api.tag_owners.set_owner(tag, user_account.key)
         yield user_account.save()
 
     @Manager.calls_manager
@@ -399,6 +409,7 @@ class VumiUserApi(object):
             tag_info = yield self.api.mdb.get_tag_info(tag)
             del tag_info.metadata['user_account']
             yield tag_info.save()
+            yield self.api.tag_owners.clear_owner(tag)
             # NOTE: This loads and saves the CurrentTag object a second time.
             #       We should probably refactor the message store to make this
             #       less clumsy.
@@ -410,7 +421,7 @@ class VumiUserApi(object):
             rt_helper = RoutingTableHelper(routing_table)
             rt_helper.remove_transport_tag(tag)
 
-            yield user_account.save()
+            yield self.api.save_user_account(user_account)
         yield self.api.tpm.release_tag(tag)
 
     def delivery_class_for_msg(self, msg):
@@ -454,7 +465,7 @@ class VumiRouterApi(object):
         routing_table = yield self.user_api.get_routing_table(user_account)
         rt_helper = RoutingTableHelper(routing_table)
         rt_helper.remove_router(router)
-        yield user_account.save()
+        yield self.user_api.api.save_user_account(user_account)
 
     @Manager.calls_manager
     def start_router(self, router=None):
@@ -497,7 +508,17 @@ class VumiRouterApi(object):
 
 
 class VumiApi(object):
-    def __init__(self, manager, redis, sender=None):
+
+    # The default worker name the routing table dispatcher listens for
+    # commands on. This can be set with `routing_table_dispatcher_name` in
+    # the API config.
+    routing_table_dispatcher_name = 'routing_table_dispatcher'
+
+    # The number of conversation and router batch keys to cache.
+    batch_key_cache_size = 10000
+
+    def __init__(self, manager, redis, sender=None,
+                 routing_table_dispatcher_name=None):
         # local import to avoid circular import since
         # go.api.go_api needs to access VumiApi
         from go.api.go_api.session_manager import SessionManager
@@ -507,6 +528,8 @@ class VumiApi(object):
 
         self.tpm = TagpoolManager(self.redis.sub_manager('tagpool_store'))
         self.cm = CreditManager(self.redis.sub_manager('credit_store'))
+        self.tag_owners = TagOwnershipManager(
+            self.redis.sub_manager('tag_ownership'))
         self.mdb = MessageStore(self.manager,
                                 self.redis.sub_manager('message_store'))
         self.account_store = AccountStore(self.manager)
@@ -515,6 +538,13 @@ class VumiApi(object):
         self.session_manager = SessionManager(
             self.redis.sub_manager('session_manager'))
         self.mapi = sender
+        if routing_table_dispatcher_name is not None:
+            self.routing_table_dispatcher_name = routing_table_dispatcher_name
+        # Maps (owner type, account key, owner key) to the batch key of
+        # a conversation or router. See MessageMetadataHelper. A
+        # conversation's or router's batch key never changes, so entries
+        # are never invalidated and are only bounded by the LRU size.
+        self.batch_key_cache = LRUCache(self.batch_key_cache_size)
 
     @staticmethod
     def _parse_config(config):
@@ -530,7 +560,8 @@ class VumiApi(object):
         sender = None
         if amqp_client is not None:
             sender = SyncMessageSender(amqp_client)
-        return cls(manager, redis, sender)
+        return cls(manager, redis, sender,
+                   config.get('routing_table_dispatcher_name'))
 
     @classmethod
     @inlineCallbacks
@@ -541,7 +572,8 @@ class VumiApi(object):
         sender = None
         if amqp_client is not None:
             sender = AsyncMessageSender(amqp_client)
-        returnValue(cls(manager, redis, sender))
+        returnValue(cls(manager, redis, sender,
+                        config.get('routing_table_dispatcher_name')))
 
     @Manager.calls_manager
     def user_exists(self, user_account_key):
@@ -574,6 +606,122 @@ class VumiApi(object):
         return self.mapi.send_command(
             VumiApiCommand.command(worker_name, command, *args, **kwargs))
 
+    def invalidate_routing_table(self, user_account_key):
+        """Tell the routing table dispatcher to discard any cached copy of
+        an account's routing table.
+
+        This should be called whenever an account's routing table is saved.
+        It does nothing if this API object has no message sender.
+
+        :param str user_account_key:
+            The key of the account whose routing table has changed.
+        """
+        if self.mapi is None:
+            return
+        return self.send_command(
+            self.routing_table_dispatcher_name, 'invalidate_routing_table',
+            user_account_key=user_account_key)
+
+    @Manager.calls_manager
+    def save_user_account(self, user_account):
+        """Save a user account and invalidate any cached copy of its
+        routing table.
+
+        Use this rather than `user_account.save()` so that routing table
+        changes reach the routing table dispatcher.
+        """
+        yield user_account.save()
+        yield self.invalidate_routing_table(user_account.key)
+
+
+class VumiApiRegistry(object):
+    """Hands out :class:`VumiApi` instances that are shared by everything in
+    a process that uses the same Riak and Redis config, so that a worker and
+    its middlewares share one set of connections.
+
+    Each call to :meth:`acquire` must be matched by a call to
+    :meth:`release`. The Redis connection is closed once the last user of
+    an API releases it.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    @staticmethod
+    def config_key(config):
+        riak_config, redis_config = VumiApi._parse_config(config)
+        return json.dumps(
+            [riak_config, redis_config,
+             config.get('routing_table_dispatcher_name')],
+            sort_keys=True, default=repr)
+
+    def acquire(self, config, amqp_client=None):
+        """Return a deferred that fires with the shared API for `config`.
+
+        If `amqp_client` is given and the API has no message sender, one is
+        created from it. All workers in a process share an AMQP client, so
+        the first one given is used by everything sharing the API.
+        """
+        key = self.config_key(config)
+        entry = self._entries.get(key)
+        create = entry is None
+        if create:
+            entry = self._entries[key] = {
+                'refs': 0, 'vumi_api': None, 'waiting': []}
+        entry['refs'] += 1
+        if entry['vumi_api'] is not None:
+            d = succeed(entry['vumi_api'])
+        else:
+            d = Deferred()
+            entry['waiting'].append(d)
+        if create:
+            api_d = VumiApi.from_config_async(config)
+            api_d.addCallbacks(self._api_ready, self._api_failed,
+                               callbackArgs=(key,), errbackArgs=(key,))
+        return d.addCallback(self._add_sender, amqp_client)
+
+    def _api_ready(self, vumi_api, key):
+        entry = self._entries[key]
+        entry['vumi_api'] = vumi_api
+        waiting, entry['waiting'] = entry['waiting'], []
+        for d in waiting:
+            d.callback(vumi_api)
+
+    def _api_failed(self, failure, key):
+        entry = self._entries.pop(key)
+        for d in entry['waiting']:
+            d.errback(failure)
+
+    def _add_sender(self, vumi_api, amqp_client):
+        if vumi_api.mapi is None and amqp_client is not None:
+            vumi_api.mapi = AsyncMessageSender(amqp_client)
+        return vumi_api
+
+    def release(self, vumi_api):
+        """Give up a reference to an API returned by :meth:`acquire`.
+
+        Returns a deferred that fires once the API's connections are closed
+        if this was the last reference to it. An API that didn't come from
+        the registry is closed immediately.
+        """
+        for key, entry in self._entries.items():
+            if entry['vumi_api'] is vumi_api:
+                entry['refs'] -= 1
+                if entry['refs'] > 0:
+                    return succeed(None)
+                del self._entries[key]
+                break
+        return vumi_api.redis.close_manager()
+
+    def clear(self):
+        """Forget all shared APIs without closing them. This is for tests,
+        which discard their Redis and Riak managers themselves.
+        """
+        self._entries.clear()
+
+
+vumi_api_registry = VumiApiRegistry()
+
 
 class SyncMessageSender(object):
     def __init__(self, amqp_client):
@@ -24,7 +24,19 @@ class CommandDispatcher(ApplicationWorker):
         Dictionary describing where to consume API commands.
     :param list worker_names:
         A list of known worker names that we can forward
-        VumiApiCommands to.
+        VumiApiCommands to. This must include the routing table
+        dispatcher's worker name (`routing_table_dispatcher_name` in the
+        Vumi API config, `routing_table_dispatcher` by default), otherwise
+        routing table changes only take effect once the dispatcher's
+        cached copy expires.
+
+    A sample configuration::
+
+        transport_name: command_dispatcher
+        worker_names:
+          - bulk_message_application
+          - keyword_router
+          - routing_table_dispatcher
     """
 
     def validate_config(self):
@@ -1,3 +1,6 @@
+import json
+import time
+
 from zope.interface import implements
 from twisted.internet.defer import (
     inlineCallbacks, returnValue, maybeDeferred, gatherResults)
@@ -6,10 +9,15 @@ from vumi import log
 from vumi.worker import BaseWorker
 from vumi.application import ApplicationWorker
 from vumi.blinkenlights.metrics import MetricManager, Metric, MAX
-from vumi.config import IConfigData, ConfigText, ConfigDict
+from vumi.config import (
+    IConfigData, ConfigText, ConfigDict, ConfigBool, ConfigInt, ConfigList)
 from vumi.connectors import IgnoreMessage
 
-from go.vumitools.api import VumiApiCommand, VumiApi, VumiApiEvent
+from go.vumitools.api import (
+    VumiApiCommand, VumiApiEvent, vumi_api_registry)
+from go.vumitools.cache import TTLCache
+from go.vumitools.command_scheduler import CommandScheduler
+from go.vumitools.histogram import Histogram
 from go.vumitools.utils import MessageMetadataHelper
 
 
@@ -17,9 +25,29 @@ class OneShotMetricManager(MetricManager):
     # TODO: Replace this with appropriate functionality on MetricManager and
     # actions triggered by conversations ending.
 
+    def __init__(self, *args, **kw):
+        super(OneShotMetricManager, self).__init__(*args, **kw)
+        self._histograms = {}
+
     def _clear_metrics(self):
         self._metrics = []
         self._metrics_lookup = {}
+        self._histograms = {}
+
+    def observe(self, name, value):
+        """Add a sample to the named histogram.
+
+        When metrics are next published, percentiles of the samples are
+        published as `<name>.p<percentile>` and the largest sample is
+        published as `<name>.max`.
+        """
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = Histogram(name)
+            for metric in histogram.metrics():
+                self.register(metric)
+            self._histograms[name] = histogram
+        histogram.add(value)
 
     def _publish_metrics(self):
         super(OneShotMetricManager, self)._publish_metrics()
@@ -53,23 +81,61 @@ class GoWorkerConfigMixin(object):
     redis_manager = ConfigDict("Redis config.", static=True)
 
     api_routing = ConfigDict("AMQP config for API commands.", static=True)
+    routing_table_dispatcher_name = ConfigText(
+        "Worker name of the routing table dispatcher, for sending it"
+        " commands.", default='routing_table_dispatcher', static=True)
     app_event_routing = ConfigDict("AMQP config for app events.", static=True)
 
+    conversation_cache_ttl = ConfigInt(
+        "Number of seconds to cache conversations for. Cached conversations"
+        " are also discarded when the conversation is started or stopped or"
+        " its config changes. Set to zero to disable the cache.",
+        default=5, static=True)
+    conversation_cache_size = ConfigInt(
+        "Maximum number of conversations to cache.",
+        default=1000, static=True)
+    event_index_ttl = ConfigInt(
+        "Number of seconds to remember the account, conversation and batch"
+        " of each message sent, so that events for the message can be"
+        " handled without loading it. This should cover the time taken for"
+        " delivery reports to arrive. Set to zero to disable the index.",
+        default=2 * 24 * 60 * 60, static=True)
+    command_concurrency = ConfigInt(
+        "Maximum number of control commands to process at once. Priority"
+        " commands don't count towards this limit. Set to zero for no limit.",
+        default=10, static=True)
+    command_concurrency_limits = ConfigDict(
+        "Maximum number of control commands of each type (e.g."
+        " `collect_metrics`) to process at once.",
+        default={'collect_metrics': 2, 'collect_metrics_bulk': 1,
+                 'reconcile_cache': 1}, static=True)
+    priority_commands = ConfigList(
+        "Control commands to process ahead of other queued commands and"
+        " regardless of `command_concurrency`.",
+        default=['start', 'stop', 'config_changed',
+                 'invalidate_routing_table'], static=True)
+
     def get_conversation(self):
         return self._config_data.conv
 
 
 class GoWorkerMixin(object):
+    vumi_api = None
     redis = None
     manager = None
     control_consumer = None
+    conversation_cache = None
+    command_scheduler = None
+    event_index_ttl = 0
 
     def _go_setup_vumi_api(self, config):
         api_config = {
             'riak_manager': config.riak_manager,
             'redis_manager': config.redis_manager,
+            'routing_table_dispatcher_name': (
+                config.routing_table_dispatcher_name),
             }
-        d = VumiApi.from_config_async(api_config, self._amqp_client)
+        d = vumi_api_registry.acquire(api_config, self._amqp_client)
 
         def cb(vumi_api):
             self.vumi_api = vumi_api
@@ -106,16 +172,26 @@ class GoWorkerMixin(object):
 
         self.metrics = yield self.start_publisher(
             OneShotMetricManager, config.metrics_prefix)
+        if config.conversation_cache_ttl > 0:
+            self.conversation_cache = TTLCache(
+                config.conversation_cache_size, config.conversation_cache_ttl)
 
         yield self._go_setup_vumi_api(config)
+        self.event_index_ttl = config.event_index_ttl
+        self.event_index = self.redis.sub_manager('event_index')
         yield self._go_setup_event_publisher(config)
+        self.command_scheduler = CommandScheduler(
+            max_concurrency=config.command_concurrency or None,
+            concurrency_limits=config.command_concurrency_limits,
+            priority_commands=config.priority_commands,
+            publish_metric=self.publish_metric)
         yield self._go_setup_command_consumer(config)
 
     @inlineCallbacks
     def _go_teardown_worker(self):
         # Sometimes something else closes our Redis connection.
-        if self.redis is not None:
-            yield self.redis.close_manager()
+        if self.vumi_api is not None:
+            yield vumi_api_registry.release(self.vumi_api)
         if self.control_consumer is not None:
             yield self.control_consumer.stop()
             self.control_consumer = None
@@ -128,6 +204,9 @@ class GoWorkerMixin(object):
         """
         Handle a VumiApiCommand message that has arrived.
 
+        Known commands are run through :attr:`command_scheduler`, which
+        limits how many run at once.
+
         :type command_message: VumiApiCommand
         :param command_message:
             The command message received for this application.
@@ -137,7 +216,8 @@ class GoWorkerMixin(object):
         kwargs = command_message['kwargs']
         cmd_method = getattr(self, cmd_method_name, None)
         if cmd_method:
-            return cmd_method(*args, **kwargs)
+            return self.command_scheduler.schedule(
+                command_message['command'], cmd_method, *args, **kwargs)
         else:
             return self.process_unknown_cmd(cmd_method_name, *args, **kwargs)
 
@@ -155,6 +235,30 @@ class GoWorkerMixin(object):
         yield self.collect_metrics(user_api, conversation_key)
         self._metrics_conversations.remove(key_tuple)
 
+    @inlineCallbacks
+    def process_command_collect_metrics_bulk(self, conversations):
+        """Collect metrics for several conversations.
+
+        :param list conversations:
+            A list of `[user_account_key, conversation_key]` pairs.
+        """
+        key_tuples = []
+        for user_account_key, conversation_key in conversations:
+            key_tuple = (conversation_key, user_account_key)
+            if key_tuple in self._metrics_conversations:
+                log.info("Ignoring conversation %s for user %s because the "
+                         "previous collection run is still going." % (
+                             conversation_key, user_account_key))
+                continue
+            self._metrics_conversations.add(key_tuple)
+            key_tuples.append(key_tuple)
+        try:
+            yield self.collect_metrics_bulk(
+                [(user_account_key, conversation_key)
+                 for conversation_key, user_account_key in key_tuples])
+        finally:
+            self._metrics_conversations.difference_update(key_tuples)
+
     @inlineCallbacks
     def process_command_reconcile_cache(self, conversation_key,
                                         user_account_key):
@@ -177,6 +281,29 @@ class GoWorkerMixin(object):
         # By default, we don't collect metrics.
         pass
 
+    @inlineCallbacks
+    def collect_metrics_bulk(self, conversations):
+        """Collect metrics for a list of `(user_account_key,
+        conversation_key)` pairs.
+
+        By default, this calls :meth:`collect_metrics` for each
+        conversation in turn. Workers that can collect metrics for many
+        conversations more efficiently should override it.
+        """
+        for user_account_key, conversation_key in conversations:
+            user_api = self.get_user_api(user_account_key)
+            yield self.collect_metrics(user_api, conversation_key)
+
+    @inlineCallbacks
+    def get_conversations(self, conversations):
+        """Load a list of `(user_account_key, conversation_key)` pairs
+        using :meth:`get_conversation`, skipping missing conversations.
+        """
+        loaded = yield gatherResults([
+            self.get_conversation(user_account_key, conversation_key)
+            for user_account_key, conversation_key in conversations])
+        returnValue([conv for conv in loaded if conv is not None])
+
     @inlineCallbacks
     def reconcile_cache(self, user_api, conversation_key, delta=0.01):
         """Reconcile the cached values for the conversation.
@@ -205,28 +332,37 @@ class GoWorkerMixin(object):
 
     @inlineCallbacks
     def get_contact_for_message(self, message, create=True):
-        helper_metadata = message.get('helper_metadata', {})
-
-        go_metadata = helper_metadata.get('go', {})
-        account_key = go_metadata.get('user_account', None)
-
-        if account_key:
-            user_api = self.get_user_api(account_key)
-            delivery_class = user_api.delivery_class_for_msg(message)
-            contact = yield user_api.contact_store.contact_for_addr(
-                delivery_class, message.user(), create=create)
+        msg_mdh = self.get_metadata_helper(message)
+        if msg_mdh.has_user_account():
+            contact = yield msg_mdh.get_contact(create=create)
             returnValue(contact)
 
+    @inlineCallbacks
     def get_conversation(self, user_account_key, conversation_key):
+        cache_key = (user_account_key, conversation_key)
+        if self.conversation_cache is not None:
+            conv = self.conversation_cache.get(cache_key)
+            if conv is not None:
+                returnValue(conv)
         user_api = self.get_user_api(user_account_key)
-        return user_api.get_wrapped_conversation(conversation_key)
+        conv = yield user_api.get_wrapped_conversation(conversation_key)
+        if conv is not None and self.conversation_cache is not None:
+            self.conversation_cache.set(cache_key, conv)
+        returnValue(conv)
+
+    def forget_conversation(self, user_account_key, conversation_key):
+        """Discard any cached copy of a conversation."""
+        if self.conversation_cache is not None:
+            self.conversation_cache.delete(
+                (user_account_key, conversation_key))
 
     def get_router(self, user_account_key, router_key):
         user_api = self.get_user_api(user_account_key)
         return user_api.get_router(router_key)
 
     def get_metadata_helper(self, msg):
-        return MessageMetadataHelper(self.vumi_api, msg)
+        return MessageMetadataHelper(
+            self.vumi_api, msg, conversation_cache=self.conversation_cache)
 
     @inlineCallbacks
     def find_outboundmessage_for_event(self, event):
@@ -241,6 +377,64 @@ class GoWorkerMixin(object):
 
         returnValue(msg)
 
+    @inlineCallbacks
+    def index_outbound_message(self, message):
+        """Record the account, conversation and batch of an outbound
+        message for :meth:`find_message_info_for_event`.
+
+        The entry is built from the message's helper metadata without
+        loading the conversation. If the batch key isn't already known, it
+        is left out and looked up when an event arrives. Messages without
+        conversation metadata are not indexed.
+        """
+        msg_mdh = self.get_metadata_helper(message)
+        if self.event_index_ttl <= 0 or not msg_mdh.get_conversation_info():
+            return
+        yield self.event_index.setex(
+            message['message_id'], self.event_index_ttl, json.dumps([
+                msg_mdh.get_account_key(), msg_mdh.get_conversation_key(),
+                msg_mdh.get_cached_conversation_batch_key()]))
+
+    @inlineCallbacks
+    def find_message_info_for_event(self, event):
+        """Return a dict containing the `user_account_key`,
+        `conversation_key` and `batch_key` of the message an event is for,
+        or `None` if the message can't be found.
+
+        The index written by :meth:`index_outbound_message` is checked
+        first. The message is only loaded if it isn't in the index.
+        """
+        user_message_id = event.get('user_message_id')
+        if user_message_id is None:
+            log.error('Received event without user_message_id: %s' % (event,))
+            return
+        info = yield self.event_index.get(user_message_id)
+        if info is not None:
+            account_key, conversation_key, batch_key = json.loads(info)
+            if batch_key is None:
+                conv = yield self.get_conversation(
+                    account_key, conversation_key)
+                if conv is None:
+                    return
+                batch_key = conv.batch.key
+        else:
+            message = yield self.find_message_for_event(event)
+            if message is None:
+                return
+            msg_mdh = self.get_metadata_helper(message)
+            if not msg_mdh.get_conversation_info():
+                return
+            conv = yield msg_mdh.get_conversation()
+            if conv is None:
+                return
+            account_key = msg_mdh.get_account_key()
+            conversation_key, batch_key = conv.key, conv.batch.key
+        returnValue({
+            'user_account_key': account_key,
+            'conversation_key': conversation_key,
+            'batch_key': batch_key,
+        })
+
     @inlineCallbacks
     def find_message_for_event(self, event):
         outbound_message = yield self.find_outboundmessage_for_event(event)
@@ -315,6 +509,25 @@ class GoWorkerMixin(object):
         self.publish_conversation_metric(
             conversation, 'messages_received', received)
 
+    @inlineCallbacks
+    def collect_message_metrics_bulk(self, conversations):
+        """Collect message count metrics for several conversations.
+
+        Like :meth:`collect_message_metrics`, but the counts for all the
+        conversations are requested at once so that they share Redis round
+        trips instead of waiting for two per conversation.
+        """
+        mdb = self.vumi_api.mdb
+        counts = yield gatherResults([
+            count(conversation.batch.key)
+            for conversation in conversations
+            for count in (mdb.batch_outbound_count, mdb.batch_inbound_count)])
+        for i, conversation in enumerate(conversations):
+            self.publish_conversation_metric(
+                conversation, 'messages_sent', counts[2 * i])
+            self.publish_conversation_metric(
+                conversation, 'messages_received', counts[2 * i + 1])
+
     def add_conv_to_msg_options(self, conv, msg_options):
         helper_metadata = msg_options.setdefault('helper_metadata', {})
         conv.set_go_helper_metadata(helper_metadata)
@@ -345,6 +558,7 @@ class GoApplicationMixin(GoWorkerMixin):
     def process_command_start(self, user_account_key, conversation_key):
         log.info("Starting conversation '%s' for user '%s'." % (
             conversation_key, user_account_key))
+        self.forget_conversation(user_account_key, conversation_key)
         conv = yield self.get_conversation(user_account_key, conversation_key)
         if conv is None:
             log.warning(
@@ -362,6 +576,7 @@ class GoApplicationMixin(GoWorkerMixin):
 
     @inlineCallbacks
     def process_command_stop(self, user_account_key, conversation_key):
+        self.forget_conversation(user_account_key, conversation_key)
         conv = yield self.get_conversation(user_account_key, conversation_key)
         if conv is None:
             log.warning(
@@ -377,6 +592,10 @@ class GoApplicationMixin(GoWorkerMixin):
         conv.set_status_stopped()
         yield conv.save()
 
+    def process_command_config_changed(self, user_account_key,
+                                       conversation_key):
+        self.forget_conversation(user_account_key, conversation_key)
+
     @inlineCallbacks
     def process_command_send_message(self, user_account_key, conversation_key,
                                      command_data, **kwargs):
@@ -487,13 +706,20 @@ class GoApplicationWorker(GoApplicationMixin, ApplicationWorker):
     def teardown_application(self):
         return self._go_teardown_worker()
 
+    @inlineCallbacks
     def _publish_message(self, message, endpoint_name=None):
         if not self.get_metadata_helper(message).get_conversation_info:
             log.error(
                 "Conversation metadata missing for message for %s: %s" % (
                     type(self).__name__, message))
-        return super(GoApplicationWorker, self)._publish_message(
+        # Publishing doesn't wait for the event index. Events for the
+        # message will fall back to loading it if the entry isn't there.
+        d = self.index_outbound_message(message)
+        d.addErrback(log.err, "Error indexing outbound message %s." % (
+            message['message_id'],))
+        result = yield super(GoApplicationWorker, self)._publish_message(
             message, endpoint_name)
+        returnValue(result)
 
 
 class GoRouterConfig(BaseWorker.CONFIG_CLASS, GoWorkerConfigMixin):
@@ -503,6 +729,14 @@ class GoRouterConfig(BaseWorker.CONFIG_CLASS, GoWorkerConfigMixin):
     ro_connector_name = ConfigText(
         "The name of the receive_outbound connector.",
         required=True, static=True)
+    hop_timing = ConfigBool(
+        "Stamp the time messages are received and published in their"
+        " routing metadata.",
+        default=False, static=True)
+    compact_hops = ConfigBool(
+        "Publish messages with compact routing hops (see"
+        " RoutingMetadata.compact).",
+        default=False, static=True)
 
 
 class GoRouterWorker(GoRouterMixin, BaseWorker):
@@ -544,8 +778,21 @@ class GoRouterWorker(GoRouterMixin, BaseWorker):
         endpoint = RoutingMetadata(event).next_router_endpoint()
         self.publish_event(event, endpoint=endpoint)
 
+    def stamp_hop(self, msg):
+        if self.get_static_config().hop_timing:
+            # To avoid circular import.
+            from go.vumitools.routing import RoutingMetadata
+            RoutingMetadata(msg).stamp_hop(time.time())
+
+    def compact_routing_metadata(self, msg):
+        if self.get_static_config().compact_hops:
+            # To avoid circular import.
+            from go.vumitools.routing import RoutingMetadata
+            RoutingMetadata(msg).compact()
+
     def _mkhandler(self, handler_func, connector_name):
         def handler(msg):
+            self.stamp_hop(msg)
             d = self.get_config(msg)
             d.addCallback(handler_func, msg, connector_name)
             return d
@@ -580,13 +827,19 @@ class GoRouterWorker(GoRouterMixin, BaseWorker):
         return gatherResults(deferreds)
 
     def publish_inbound(self, msg, endpoint):
+        self.stamp_hop(msg)
+        self.compact_routing_metadata(msg)
         return self.connectors[self._ro_conn_name].publish_inbound(
             msg, endpoint)
 
     def publish_outbound(self, msg, endpoint):
+        self.stamp_hop(msg)
+        self.compact_routing_metadata(msg)
         return self.connectors[self._ri_conn_name].publish_outbound(
             msg, endpoint)
 
     def publish_event(self, event, endpoint):
+        self.stamp_hop(event)
+        self.compact_routing_metadata(event)
         return self.connectors[self._ro_conn_name].publish_event(
             event, endpoint)
@@ -0,0 +1,92 @@
+# -*- test-case-name: go.vumitools.tests.test_cache -*-
+
+"""Small in-process caches for use by Vumi Go workers."""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A bounded mapping that discards the least recently used entries.
+
+    :param int max_size:
+        The maximum number of entries to hold. Once this is exceeded, the
+        least recently used entry is discarded. A `max_size` of zero means
+        nothing is ever cached.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Return the value for `key` (or `default` if there isn't one) and
+        mark it as recently used.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        """Store `value` for `key`, discarding old entries if necessary."""
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove the entry for `key` if there is one."""
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        self._data.clear()
+
+
+class TTLCache(LRUCache):
+    """An :class:`LRUCache` whose entries also expire `ttl` seconds after
+    they are set.
+
+    :param int max_size:
+        See :class:`LRUCache`.
+    :param float ttl:
+        Number of seconds to keep entries for.
+    :param clock:
+        Provider of the current time. Defaults to the reactor.
+    """
+
+    def __init__(self, max_size, ttl, clock=None):
+        super(TTLCache, self).__init__(max_size)
+        self.ttl = ttl
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.clock = clock
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        entry = super(TTLCache, self).get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= self.clock.seconds():
+            self.delete(key)
+            return default
+        return value
+
+    def set(self, key, value):
+        expires_at = self.clock.seconds() + self.ttl
+        super(TTLCache, self).set(key, (expires_at, value))
+
+
+_MISSING = object()
@@ -0,0 +1,141 @@
+# -*- test-case-name: go.vumitools.tests.test_command_scheduler -*-
+
+"""Bounded concurrent execution of Vumi Go worker control commands."""
+
+from collections import deque
+from itertools import count
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+class CommandScheduler(object):
+    """Runs commands with limits on how many may run at once.
+
+    Commands that can't run yet are queued and run in the order they were
+    scheduled once there is room for them.
+
+    :param int max_concurrency:
+        The maximum number of commands (other than priority commands) to
+        run at once. `None` means no limit.
+    :param dict concurrency_limits:
+        Maps command names to the maximum number of commands with that
+        name to run at once. Commands not listed are only limited by
+        `max_concurrency`.
+    :param priority_commands:
+        Names of commands that don't count towards `max_concurrency` and
+        are run ahead of other queued commands.
+    :param publish_metric:
+        If given, called as `publish_metric(name, value)` with the number
+        of queued commands (as `command_queue.depth`) and the number of
+        queued commands with a particular name (as
+        `command_queue.<command>.depth`) whenever these change. Nothing is
+        published until commands start having to wait.
+    """
+
+    def __init__(self, max_concurrency=None, concurrency_limits=None,
+                 priority_commands=(), publish_metric=None):
+        self.max_concurrency = max_concurrency
+        self.concurrency_limits = concurrency_limits or {}
+        self.priority_commands = frozenset(priority_commands)
+        self.publish_metric = publish_metric
+        self._queues = {}
+        self._running = {}
+        self._running_total = 0
+        self._queued_total = 0
+        self._sequence = count()
+        self._starting = False
+        self._reported = set()
+
+    def running(self, command=None):
+        """Return the number of commands (with the given name) running."""
+        if command is None:
+            return sum(self._running.itervalues())
+        return self._running.get(command, 0)
+
+    def queued(self, command=None):
+        """Return the number of commands (with the given name) queued."""
+        if command is None:
+            return self._queued_total
+        return len(self._queues.get(command, ()))
+
+    def schedule(self, command, func, *args, **kw):
+        """Run `func(*args, **kw)` as the command named `command` once
+        there is room for it.
+
+        Returns a deferred that fires with the result of `func` once it
+        has finished.
+        """
+        d = Deferred()
+        self._queues.setdefault(command, deque()).append(
+            (next(self._sequence), d, func, args, kw))
+        self._queued_total += 1
+        self._run_ready()
+        self._publish_depths()
+        return d
+
+    def _can_run(self, command):
+        limit = self.concurrency_limits.get(command)
+        if limit is not None and self._running.get(command, 0) >= limit:
+            return False
+        if command in self.priority_commands:
+            return True
+        return (self.max_concurrency is None
+                or self._running_total < self.max_concurrency)
+
+    def _next_command(self):
+        # Priority commands first, then whichever has waited longest.
+        ready = [(command not in self.priority_commands, queue[0][0], command)
+                 for command, queue in self._queues.iteritems()
+                 if queue and self._can_run(command)]
+        if not ready:
+            return None
+        return min(ready)[2]
+
+    def _run_ready(self):
+        # Commands that finish immediately call back into this method. The
+        # loop below picks up anything they make room for, so we avoid
+        # recursing (potentially once per queued command).
+        if self._starting:
+            return
+        self._starting = True
+        try:
+            while True:
+                command = self._next_command()
+                if command is None:
+                    return
+                self._start(command)
+        finally:
+            self._starting = False
+
+    def _start(self, command):
+        _, d, func, args, kw = self._queues[command].popleft()
+        self._queued_total -= 1
+        self._running[command] = self._running.get(command, 0) + 1
+        if command not in self.priority_commands:
+            self._running_total += 1
+        result_d = maybeDeferred(func, *args, **kw)
+        result_d.addBoth(self._finished, command)
+        result_d.chainDeferred(d)
+
+    def _finished(self, result, command):
+        self._running[command] -= 1
+        if command not in self.priority_commands:
+            self._running_total -= 1
+        self._run_ready()
+        self._publish_depths()
+        return result
+
+    def _publish_depths(self):
+        # We only report queues that are or have been in use, so that a
+        # worker whose commands never wait doesn't publish a stream of zeros.
+        if self.publish_metric is None:
+            return
+        commands = set(command for command, queue in self._queues.iteritems()
+                       if queue)
+        if not (commands or self._reported):
+            return
+        self.publish_metric('command_queue.depth', self._queued_total)
+        for command in commands | self._reported:
+            self.publish_metric(
+                'command_queue.%s.depth' % (command,), self.queued(command))
+        self._reported = commands
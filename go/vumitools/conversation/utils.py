@@ -34,6 +34,17 @@ class ConversationWrapper(object):
                                     user_account_key=self.c.user_account.key,
                                     conversation_key=self.c.key)
 
+    def notify_config_changed(self):
+        """Tell the conversation's worker that the conversation has changed,
+        so that it discards any cached copy. This does nothing if the API
+        has no message sender.
+        """
+        if self.api.mapi is None:
+            return
+        return self.dispatch_command(
+            'config_changed', user_account_key=self.c.user_account.key,
+            conversation_key=self.c.key)
+
     @Manager.calls_manager
     def archive_conversation(self):
         self.c.set_status_finished()
@@ -180,7 +191,7 @@ class ConversationWrapper(object):
         routing_table = yield self.user_api.get_routing_table(user_account)
         rt_helper = RoutingTableHelper(routing_table)
         rt_helper.remove_conversation(self.c)
-        yield user_account.save()
+        yield self.api.save_user_account(user_account)
 
     @Manager.calls_manager
     def send_token_url(self, token_url, msisdn):
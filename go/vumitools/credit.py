@@ -43,5 +43,113 @@ class CreditManager(object):
             yield self.redis.incr(credit_key, amount)
         returnValue(success)
 
+    @Manager.calls_manager
+    def reserve(self, user_account_key, amount, minimum=None):
+        """Remove up to `amount` credits from a user account.
+
+        If fewer than `amount` credits are available, an attempt is made to
+        remove just `minimum` credits instead.
+
+        :returns:
+            The number of credits removed (zero if neither attempt
+            succeeded).
+        """
+        reserved, _ = yield self._reserve(user_account_key, amount, minimum)
+        returnValue(reserved)
+
+    @Manager.calls_manager
+    def _reserve(self, user_account_key, amount, minimum=None):
+        # Returns the number of credits removed and the balance left
+        # afterwards. This takes at most two INCRs. If the first one
+        # overdraws the account, it also tells us how many credits there
+        # were, so the second one can put back everything except `minimum`
+        # instead of having to restore the balance and try again.
+        if minimum is None or minimum > amount:
+            minimum = amount
+        credit_key = self._credit_key(user_account_key)
+        balance = yield self.redis.incr(credit_key, -amount)
+        if balance >= 0:
+            returnValue((amount, balance))
+        reserved = minimum if balance + amount >= minimum else 0
+        balance = yield self.redis.incr(credit_key, amount - reserved)
+        returnValue((reserved, balance))
+
     def _credit_key(self, user_account_key):
         return ":".join(["credits", user_account_key])
+
+
+class CreditLease(object):
+    """Hands out credits reserved in blocks from a :class:`CreditManager`.
+
+    Each time an account runs out of locally held credits, a block of
+    `lease_size` credits is reserved from the credit store so that most
+    debits don't need to touch Redis at all. Leased credits no longer show
+    up in the credit store until :meth:`release` returns them, so workers
+    using a lease must release it when they shut down.
+
+    Once an account has fewer than `lease_size` credits left, credits are
+    debited directly from the credit store instead (until a debit finds at
+    least `lease_size` credits left again), so that nearly empty accounts
+    don't have their last credits held by whichever worker asked first.
+
+    :param CreditManager credit_manager:
+        The credit manager to reserve credits from.
+    :param int lease_size:
+        The number of credits to reserve at a time.
+    """
+
+    def __init__(self, credit_manager, lease_size):
+        self.cm = credit_manager
+        self.manager = credit_manager.manager  # TODO: calls_manager hack
+        self.lease_size = lease_size
+        self._leased = {}
+        self._low_balance = set()
+
+    def get_leased(self, user_account_key):
+        """Return the number of credits held locally for an account."""
+        return self._leased.get(user_account_key, 0)
+
+    @Manager.calls_manager
+    def debit(self, user_account_key, amount):
+        """Remove an amount of credits from the credits leased for a user
+        account, reserving more if necessary.
+        """
+        shortfall = amount - self.get_leased(user_account_key)
+        if shortfall > 0:
+            if user_account_key in self._low_balance:
+                reserved, balance = yield self.cm._reserve(
+                    user_account_key, shortfall)
+                if balance >= self.lease_size:
+                    self._low_balance.discard(user_account_key)
+            else:
+                lease_size = max(self.lease_size, shortfall)
+                reserved, balance = yield self.cm._reserve(
+                    user_account_key, lease_size, shortfall)
+                if reserved < lease_size:
+                    self._low_balance.add(user_account_key)
+            # Other debits may have changed the lease while we waited.
+            self._leased[user_account_key] = (
+                self.get_leased(user_account_key) + reserved)
+        available = self.get_leased(user_account_key)
+        if available < amount:
+            returnValue(False)
+        self._leased[user_account_key] = available - amount
+        returnValue(True)
+
+    @Manager.calls_manager
+    def release(self):
+        """Return all unused leased credits to the credit store.
+
+        Credits are only forgotten once they have been returned, so if
+        returning them fails, calling this again returns whatever is left.
+        """
+        for user_account_key in self._leased.keys():
+            amount = self._leased.pop(user_account_key, 0)
+            if amount <= 0:
+                continue
+            try:
+                yield self.cm.credit(user_account_key, amount)
+            except Exception:
+                self._leased[user_account_key] = (
+                    self.get_leased(user_account_key) + amount)
+                raise
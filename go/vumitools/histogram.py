@@ -0,0 +1,95 @@
+# -*- test-case-name: go.vumitools.tests.test_histogram -*-
+
+"""Percentile histograms that can be published through a MetricManager.
+
+This is the histogram implementation used throughout Vumi Go, by
+:class:`go.vumitools.middleware.MetricsMiddleware` and (through
+`OneShotMetricManager.observe`) by Go workers.
+"""
+
+import time
+
+from vumi.blinkenlights.metrics import Metric, AVG, MAX
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of `values` (using the nearest rank)."""
+    values = sorted(values)
+    index = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+class HistogramMetric(Metric):
+    """A metric whose value is a statistic of a :class:`Histogram`'s
+    samples. Polling it returns a value only if samples were added since
+    the previous publish.
+    """
+
+    def __init__(self, histogram, statistic, aggregators):
+        super(HistogramMetric, self).__init__(
+            '%s.%s' % (histogram.name, statistic), aggregators)
+        self.histogram = histogram
+        self.statistic = statistic
+
+    def poll(self):
+        return self.histogram.poll(self.statistic)
+
+
+class Histogram(object):
+    """Collects samples and publishes percentiles and the maximum of them.
+
+    Register the metrics returned by :meth:`metrics` with a metric manager.
+    Each time the manager publishes, the metrics named
+    `<name>.p<percentile>` and `<name>.max` are calculated from the samples
+    added since the previous publish.
+
+    :param str name:
+        Prefix for the metric names.
+    :param tuple percentiles:
+        Percentiles to publish.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, name, percentiles=PERCENTILES):
+        self.name = name
+        self.percentiles = percentiles
+        self._samples = []
+        self._snapshot = None
+
+    def metrics(self):
+        """Return the metrics to register for this histogram."""
+        metrics = [HistogramMetric(self, 'p%s' % (pct,), [AVG])
+                   for pct in self.percentiles]
+        metrics.append(HistogramMetric(self, 'max', [MAX]))
+        return metrics
+
+    def add(self, value):
+        """Add a sample."""
+        self._samples.append(value)
+
+    def _take_snapshot(self):
+        samples, self._samples = self._samples, []
+        snapshot = dict(('p%s' % (pct,), percentile(samples, pct))
+                        for pct in self.percentiles)
+        snapshot['max'] = max(samples)
+        return time.time(), snapshot
+
+    def poll(self, statistic):
+        """Return the value of a statistic as a list of `(timestamp, value)`
+        pairs, like :meth:`Metric.poll`.
+
+        The first statistic polled after samples are added takes a snapshot
+        of them which the other statistics are then read from.
+        """
+        if self._snapshot is None:
+            if not self._samples:
+                return []
+            self._snapshot = self._take_snapshot()
+        timestamp, snapshot = self._snapshot
+        value = snapshot.pop(statistic, None)
+        if not snapshot:
+            self._snapshot = None
+        if value is None:
+            return []
+        return [(timestamp, value)]
@@ -0,0 +1,100 @@
+# -*- test-case-name: go.vumitools.tests.test_keywords -*-
+
+"""Matching of keywords (such as opt-out keywords) in message content."""
+
+import re
+import unicodedata
+
+
+_TRAILING_PUNCTUATION = re.compile(r'\W+$', re.UNICODE)
+
+
+def normalize_text(text, case_sensitive=False):
+    """Return `text` as unicode with accents removed, runs of whitespace
+    collapsed into single spaces and leading and trailing whitespace
+    stripped. Unless `case_sensitive` is set, it is also lowercased.
+    """
+    if not text:
+        return u''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        # Only non-ASCII text can contain accents.
+        text = unicodedata.normalize('NFKD', text)
+        text = u''.join(c for c in text if not unicodedata.combining(c))
+    text = u' '.join(text.split())
+    if not case_sensitive:
+        text = text.lower()
+    return text
+
+
+class KeywordMatcher(object):
+    """Matches message content against a set of keywords.
+
+    Keywords and content are compared after normalisation with
+    :func:`normalize_text`.
+
+    :param keywords:
+        The keywords to match.
+    :param str mode:
+        How to match content. One of:
+
+        * `exact`: the whole content must be a keyword.
+        * `first_token`: the first word of the content, ignoring trailing
+          punctuation, must be a keyword. For example, `STOP please`
+          matches `stop`.
+        * `prefix`: the content must start with a keyword that is followed
+          by the end of the content or a non-word character. Unlike
+          `first_token`, this matches keywords of more than one word.
+    :param bool case_sensitive:
+        Whether to compare keywords case sensitively.
+    """
+
+    EXACT = 'exact'
+    FIRST_TOKEN = 'first_token'
+    PREFIX = 'prefix'
+    MODES = (EXACT, FIRST_TOKEN, PREFIX)
+
+    def __init__(self, keywords, mode=EXACT, case_sensitive=False):
+        if mode not in self.MODES:
+            raise ValueError("Unknown keyword match mode: %r" % (mode,))
+        self.mode = mode
+        self.case_sensitive = case_sensitive
+        self.keywords = frozenset(
+            normalize_text(keyword, case_sensitive) for keyword in keywords)
+        self.keywords -= frozenset([u''])
+        self._prefix_re = None
+        if mode == self.PREFIX and self.keywords:
+            # Longer keywords first, so that the longest match wins.
+            alternatives = sorted(self.keywords, key=len, reverse=True)
+            self._prefix_re = re.compile(
+                u'(%s)(?!\\w)' % (u'|'.join(map(re.escape, alternatives)),),
+                re.UNICODE)
+
+    def normalize(self, text):
+        """Normalise `text` for :meth:`match_normalized`."""
+        return normalize_text(text, self.case_sensitive)
+
+    def match(self, text):
+        """Return the (normalised) keyword `text` matches or `None`."""
+        return self.match_normalized(self.normalize(text))
+
+    def match_normalized(self, text):
+        """Like :meth:`match` for text already normalised with
+        :meth:`normalize`, so that several matchers with the same case
+        sensitivity can share the work.
+        """
+        if not text:
+            return None
+        if self.mode == self.EXACT:
+            keyword = text
+        elif self.mode == self.FIRST_TOKEN:
+            keyword = _TRAILING_PUNCTUATION.sub(u'', text.split(u' ', 1)[0])
+        else:
+            if self._prefix_re is None:
+                return None
+            match = self._prefix_re.match(text)
+            return match.group(1) if match is not None else None
+        return keyword if keyword in self.keywords else None
@@ -1,12 +1,18 @@
 # -*- test-case-name: go.vumitools.tests.test_metrics_worker -*-
 
-from twisted.internet.defer import inlineCallbacks
+from zlib import crc32
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredSemaphore, gatherResults)
 from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.errors import ConfigError
 from vumi.service import Worker
 
 from go.vumitools.api import VumiApi, VumiApiCommand
+from go.vumitools.cache import LRUCache
 
 
 class GoMetricsWorker(Worker):
@@ -16,6 +22,13 @@ class GoMetricsWorker(Worker):
     collection and sending commands to the relevant application workers to
     trigger the actual metrics.
 
+    Accounts are processed a few at a time, each at a fixed offset into
+    the metrics interval so that the load is spread across the interval
+    and each account's metrics are collected at regular intervals. The
+    accounts can be split between several metrics workers by giving each
+    one the same `metrics_shard_count` and a different
+    `metrics_shard_index`.
+
     """
 
     worker_name = 'go_metrics'
@@ -26,6 +39,12 @@ class GoMetricsWorker(Worker):
 
         self.vumi_api = yield VumiApi.from_config_async(self.config)
         self.redis = self.vumi_api.redis
+        # Conversation types never change, so we remember them to avoid
+        # loading running conversations on every run.
+        self.conversation_types = LRUCache(self.conversation_type_cache_size)
+        # Maps account keys to the delayed calls that will process them and
+        # the deferreds that fire once they have been processed.
+        self._scheduled_accounts = {}
 
         self.command_publisher = yield self.publish_to(
             self.api_routing_config['routing_key'])
@@ -36,38 +55,171 @@ class GoMetricsWorker(Worker):
     def stopWorker(self):
         if self._looper.running:
             self._looper.stop()
+        self.cancel_scheduled_accounts()
         return self.redis.close_manager()
 
     def validate_config(self):
         self.metrics_interval = int(self.config.get('metrics_interval', 300))
         self.api_routing_config = VumiApiCommand.default_routing_config()
         self.api_routing_config.update(self.config.get('api_routing', {}))
+        # Number of conversations to include in each `collect_metrics_bulk`
+        # command. Zero sends a `collect_metrics` command per conversation.
+        self.metrics_bulk_size = int(self.config.get('metrics_bulk_size', 100))
+        # Number of accounts to process at once.
+        self.metrics_concurrency = int(
+            self.config.get('metrics_concurrency', 10))
+        # Fraction of the metrics interval to spread account processing
+        # over. Zero processes all accounts at the start of the interval.
+        self.metrics_spread = float(self.config.get('metrics_spread', 0.8))
+        self.metrics_shard_count = int(
+            self.config.get('metrics_shard_count', 1))
+        self.metrics_shard_index = int(
+            self.config.get('metrics_shard_index', 0))
+        self.conversation_type_cache_size = int(
+            self.config.get('conversation_type_cache_size', 100000))
+
+        if self.metrics_concurrency < 1:
+            raise ConfigError("metrics_concurrency must be at least 1.")
+        if not 0 <= self.metrics_spread < 1:
+            raise ConfigError("metrics_spread must be at least 0 and less"
+                              " than 1.")
+        if not 0 <= self.metrics_shard_index < self.metrics_shard_count:
+            raise ConfigError("metrics_shard_index must be at least 0 and"
+                              " less than metrics_shard_count.")
+
+    def account_hash(self, account_key):
+        # We need a hash that is the same in every process.
+        if isinstance(account_key, unicode):
+            account_key = account_key.encode('utf-8')
+        return crc32(account_key) & 0xffffffff
+
+    def account_in_shard(self, account_key):
+        return (self.account_hash(account_key) % self.metrics_shard_count
+                == self.metrics_shard_index)
+
+    def account_delay(self, account_key):
+        """Return the number of seconds into each metrics interval at which
+        to process the given account.
+        """
+        fraction = (self.account_hash(account_key) % 1000) / 1000.0
+        return fraction * self.metrics_spread * self.metrics_interval
 
     @inlineCallbacks
     def metrics_loop_func(self):
         account_keys = yield self.find_account_keys()
-        conversations = []
-        # We deliberarely serialise this. We don't want to hit the datastore
-        # too hard for metrics.
-        for account_key in account_keys:
-            convs = yield self.find_conversations_for_account(account_key)
-            conversations.extend(convs)
+        account_keys = [account_key for account_key in account_keys
+                        if self.account_in_shard(account_key)]
+        log.info("Processing metrics for %s users." % (len(account_keys),))
+        # We limit how many accounts we process at once, because we don't
+        # want to hit the datastore too hard for metrics.
+        semaphore = DeferredSemaphore(self.metrics_concurrency)
+        counts = yield gatherResults([
+            self.schedule_account(semaphore, account_key)
+            for account_key in account_keys])
         log.info(
-            "Processing metrics for %s conversations owned by %s users." % (
-                len(conversations), len(account_keys)))
-        for conversation in conversations:
-            yield self.send_metrics_command(conversation)
+            "Processed metrics for %s conversations owned by %s users." % (
+                sum(counts), len(account_keys)))
+
+    def schedule_account(self, semaphore, account_key):
+        delay = self.account_delay(account_key)
+        if delay > 0:
+            d = Deferred()
+            delayed_call = reactor.callLater(
+                delay, self._run_scheduled_account, semaphore, account_key)
+            self._scheduled_accounts[account_key] = (delayed_call, d)
+        else:
+            d = semaphore.run(self.process_account, account_key)
+        d.addErrback(self._process_account_failed, account_key)
+        return d
+
+    def _run_scheduled_account(self, semaphore, account_key):
+        _, d = self._scheduled_accounts.pop(account_key)
+        semaphore.run(self.process_account, account_key).chainDeferred(d)
+
+    def cancel_scheduled_accounts(self):
+        """Cancel the processing of accounts that haven't been reached yet
+        in the current metrics interval.
+        """
+        scheduled, self._scheduled_accounts = self._scheduled_accounts, {}
+        for delayed_call, d in scheduled.itervalues():
+            delayed_call.cancel()
+            d.callback(0)
+
+    def _process_account_failed(self, failure, account_key):
+        log.err(failure, "Error processing metrics for user %s." % (
+            account_key,))
+        return 0
+
+    @inlineCallbacks
+    def process_account(self, account_key):
+        """Send metrics commands for the running conversations in the given
+        account and return the number of conversations.
+        """
+        conversations = yield self.find_running_conversation_keys(
+            account_key)
+        if self.metrics_bulk_size <= 0:
+            for conversation_type, conversation_key in conversations:
+                yield self.send_collect_metrics_command(
+                    conversation_type, account_key, conversation_key)
+            returnValue(len(conversations))
+
+        by_type = {}
+        for conversation_type, conversation_key in conversations:
+            by_type.setdefault(conversation_type, []).append(
+                [account_key, conversation_key])
+        for conversation_type, keys in sorted(by_type.iteritems()):
+            for i in range(0, len(keys), self.metrics_bulk_size):
+                yield self.send_bulk_metrics_command(
+                    conversation_type, keys[i:i + self.metrics_bulk_size])
+        returnValue(len(conversations))
 
     def find_account_keys(self):
         return self.redis.smembers('metrics_accounts')
 
-    def find_conversations_for_account(self, account_key):
-        user_api = self.vumi_api.get_user_api(account_key)
-        return user_api.running_conversations()
+    @inlineCallbacks
+    def find_running_conversation_keys(self, account_key):
+        """Return a list of `(conversation_type, conversation_key)` pairs
+        for the running conversations in the given account.
+
+        Only conversations we haven't seen before are loaded.
+        """
+        conversation_store = self.vumi_api.get_user_api(
+            account_key).conversation_store
+        keys = yield conversation_store.list_running_conversations()
+        types = {}
+        missing = []
+        for key in keys:
+            conversation_type = self.conversation_types.get(
+                (account_key, key))
+            if conversation_type is None:
+                missing.append(key)
+            else:
+                types[key] = conversation_type
+        for convs_bunch in conversation_store.load_all_bunches(missing):
+            for conv in (yield convs_bunch):
+                types[conv.key] = conv.conversation_type
+                self.conversation_types.set(
+                    (account_key, conv.key), conv.conversation_type)
+        returnValue([(types[key], key) for key in keys if key in types])
 
     def send_metrics_command(self, conversation):
+        return self.send_collect_metrics_command(
+            conversation.conversation_type, conversation.user_account.key,
+            conversation.key)
+
+    def send_collect_metrics_command(self, conversation_type,
+                                     user_account_key, conversation_key):
+        cmd = VumiApiCommand.command(
+            conversation_type, 'collect_metrics',
+            conversation_key=conversation_key,
+            user_account_key=user_account_key)
+        return self.command_publisher.publish_message(cmd)
+
+    def send_bulk_metrics_command(self, conversation_type, conversations):
+        """Send a `collect_metrics_bulk` command for a list of
+        `[user_account_key, conversation_key]` pairs.
+        """
         cmd = VumiApiCommand.command(
-            conversation.conversation_type, 'collect_metrics',
-            conversation_key=conversation.key,
-            user_account_key=conversation.user_account.key)
+            conversation_type, 'collect_metrics_bulk',
+            conversations=conversations)
         return self.command_publisher.publish_message(cmd)
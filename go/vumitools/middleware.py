@@ -1,8 +1,11 @@
 # -*- test-case-name: go.vumitools.tests.test_middleware -*-
-import sys
 import time
+from collections import deque
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, succeed, Deferred)
+
+from vumi import log
 
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.middleware.base import TransportMiddleware, BaseMiddleware
@@ -13,7 +16,12 @@ from vumi.blinkenlights.metrics import MetricManager, Count, Metric
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.errors import ConfigError
 
-from go.vumitools.credit import CreditManager
+from go.vumitools.cache import LRUCache
+from go.vumitools.credit import CreditManager, CreditLease
+from go.vumitools.histogram import Histogram
+from go.vumitools.keywords import KeywordMatcher
+from go.vumitools.tagpool_cache import (
+    CachingTagpoolManager, shared_metadata_cache)
 
 
 class NormalizeMsisdnMiddleware(TransportMiddleware):
@@ -57,38 +65,100 @@ class InsufficientCredit(DebitAccountError):
 
 
 class OptOutMiddleware(BaseMiddleware):
+    """
+    Middleware that flags inbound messages that are opt-out requests.
+
+    Message content is normalised once (see
+    :func:`go.vumitools.keywords.normalize_text`) and matched against the
+    configured keywords and any extra keywords in the `optout_keywords`
+    field of the metadata of the tag pool the message arrived on. Setting
+    `disable_global_opt_out` in the tag pool metadata disables the
+    configured keywords but not the tag pool's own.
+
+    Configuration options:
+
+    :param list optout_keywords:
+        Keywords that mark a message as an opt-out request.
+    :param bool case_sensitive:
+        Whether keywords are matched case sensitively. Defaults to `False`.
+    :param str optout_match_mode:
+        How keywords are matched. One of `exact` (the default),
+        `first_token` or `prefix`. See
+        :class:`go.vumitools.keywords.KeywordMatcher`. Tag pools may
+        override this with an `optout_match_mode` metadata field.
+    :param int tagpool_metadata_cache_ttl:
+        Number of seconds to cache tag pool metadata for. Defaults to 60.
+    """
+
+    MATCHER_CACHE_SIZE = 1000
 
     @inlineCallbacks
     def setup_middleware(self):
-        from go.vumitools.api import VumiApi
-        self.vumi_api = yield VumiApi.from_config_async(self.config)
+        from go.vumitools.api import vumi_api_registry
+        self.vumi_api = yield vumi_api_registry.acquire(self.config)
+        self.tpm = CachingTagpoolManager(
+            self.vumi_api.tpm,
+            self.config.get('tagpool_metadata_cache_ttl', 60),
+            cache=shared_metadata_cache(self.worker, self.vumi_api.tpm))
 
         self.case_sensitive = self.config.get('case_sensitive', False)
+        self.match_mode = self.config.get(
+            'optout_match_mode', KeywordMatcher.EXACT)
+        if self.match_mode not in KeywordMatcher.MODES:
+            raise ConfigError(
+                "Unknown optout_match_mode: %r" % (self.match_mode,))
         keywords = self.config.get('optout_keywords', [])
-        self.optout_keywords = set([self.casing(word) for word in keywords])
+        self.matcher = KeywordMatcher(
+            keywords, self.match_mode, self.case_sensitive)
+        self.optout_keywords = self.matcher.keywords
+        self._tagpool_matchers = LRUCache(self.MATCHER_CACHE_SIZE)
+
+    def teardown_middleware(self):
+        from go.vumitools.api import vumi_api_registry
+        return vumi_api_registry.release(self.vumi_api)
 
-    def casing(self, word):
-        if not self.case_sensitive:
-            return word.lower()
-        return word
+    def get_tagpool_matcher(self, tagpool_metadata):
+        """Return a matcher for the keywords in `tagpool_metadata` or
+        `None` if it has none. Matchers are cached by keywords and mode.
+        """
+        keywords = tagpool_metadata.get('optout_keywords')
+        if not keywords:
+            return None
+        mode = tagpool_metadata.get('optout_match_mode', self.match_mode)
+        if mode not in KeywordMatcher.MODES:
+            log.warning("Ignoring unknown optout_match_mode %r in tag pool"
+                        " metadata." % (mode,))
+            mode = self.match_mode
+        key = (tuple(keywords), mode)
+        matcher = self._tagpool_matchers.get(key)
+        if matcher is None:
+            matcher = KeywordMatcher(keywords, mode, self.case_sensitive)
+            self._tagpool_matchers.set(key, matcher)
+        return matcher
 
     @inlineCallbacks
     def handle_inbound(self, message, endpoint):
-        optout_disabled = False
+        matchers = [self.matcher]
         tag = TaggingMiddleware.map_msg_to_tag(message)
         if tag is not None:
-            tagpool_metadata = yield self.vumi_api.tpm.get_metadata(tag[0])
-            optout_disabled = tagpool_metadata.get(
-                'disable_global_opt_out', False)
-        keyword = (message['content'] or '').strip()
+            tagpool_metadata = yield self.tpm.get_metadata(tag[0])
+            if tagpool_metadata.get('disable_global_opt_out', False):
+                matchers = []
+            tagpool_matcher = self.get_tagpool_matcher(tagpool_metadata)
+            if tagpool_matcher is not None:
+                matchers.append(tagpool_matcher)
         helper_metadata = message['helper_metadata']
         optout_metadata = helper_metadata.setdefault(
             'optout', {'optout': False})
 
-        if (not optout_disabled
-                and self.casing(keyword) in self.optout_keywords):
-            optout_metadata['optout'] = True
-            optout_metadata['optout_keyword'] = self.casing(keyword)
+        if matchers:
+            content = self.matcher.normalize(message['content'])
+            for matcher in matchers:
+                keyword = matcher.match_normalized(content)
+                if keyword is not None:
+                    optout_metadata['optout'] = True
+                    optout_metadata['optout_keyword'] = keyword
+                    break
         returnValue(message)
 
     @staticmethod
@@ -97,35 +167,72 @@ class OptOutMiddleware(BaseMiddleware):
 
 
 class DebitAccountMiddleware(TransportMiddleware):
+    """
+    Debits credits from the account an outbound message is sent from.
+
+    The number of credits to debit is read from the `credits_per_message`
+    field of the metadata of the tag pool the message is sent from.
+
+    All Redis access is asynchronous. Debits for concurrent outbound
+    messages are pipelined over the middleware's single Redis connection
+    rather than blocking the transport while each completes.
 
+    Configuration options:
+
+    :param dict redis_manager:
+        Redis configuration.
+    :param dict tagpool_manager:
+        Tagpool manager configuration. `tagpool_prefix` sets the Redis key
+        prefix tagpools are stored under (default `tagpool_store`).
+        Tagpool metadata is cached for `metadata_cache_ttl` seconds
+        (default 60) in a cache shared with other middlewares on the same
+        transport.
+    :param dict credit_manager:
+        Credit manager configuration. `credit_prefix` sets the Redis key
+        prefix credits are stored under (default `credit_store`). If
+        `lease_size` is greater than zero, credits are reserved from Redis
+        in blocks of that size and debited locally (see
+        :class:`go.vumitools.credit.CreditLease`). Unused leased credits are
+        returned when the middleware is torn down.
+    """
+
+    @inlineCallbacks
     def setup_middleware(self):
-        # TODO: There really needs to be a helper function to
-        #       turn this config into managers.
-        from go.vumitools.api import get_redis
-        self._r_server = get_redis(self.config)
+        self.redis = yield TxRedisManager.from_config(
+            self.config.get('redis_manager', {}))
         tpm_config = self.config.get('tagpool_manager', {})
         tpm_prefix = tpm_config.get('tagpool_prefix', 'tagpool_store')
-        self.tpm = TagpoolManager(self._r_server, tpm_prefix)
+        tpm = TagpoolManager(self.redis.sub_manager(tpm_prefix))
+        self.tpm = CachingTagpoolManager(
+            tpm, tpm_config.get('metadata_cache_ttl', 60),
+            cache=shared_metadata_cache(self.worker, tpm))
         cm_config = self.config.get('credit_manager', {})
         cm_prefix = cm_config.get('credit_prefix', 'credit_store')
-        self.cm = CreditManager(self._r_server, cm_prefix)
+        self.cm = CreditManager(self.redis.sub_manager(cm_prefix))
+        lease_size = cm_config.get('lease_size', 0)
+        if lease_size > 0:
+            self.cm = CreditLease(self.cm, lease_size)
 
+    @inlineCallbacks
     def teardown_middleware(self):
-        return self._r_server.close_manager()
+        try:
+            if isinstance(self.cm, CreditLease):
+                yield self.cm.release()
+        finally:
+            yield self.redis.close_manager()
 
+    @inlineCallbacks
     def _credits_per_message(self, pool):
-        tagpool_metadata = self.tpm.get_metadata(pool)
+        tagpool_metadata = yield self.tpm.get_metadata(pool)
         credits_per_message = tagpool_metadata.get('credits_per_message')
         try:
             credits_per_message = int(credits_per_message)
-            assert credits_per_message >= 0
-        except Exception:
-            exc_tb = sys.exc_info()[2]
-            raise (BadTagPool,
-                   BadTagPool("Invalid credits_per_message for pool %r"
-                              % (pool,)),
-                   exc_tb)
-        return credits_per_message
+        except (TypeError, ValueError):
+            credits_per_message = -1
+        if credits_per_message < 0:
+            raise BadTagPool(
+                "Invalid credits_per_message for pool %r" % (pool,))
+        returnValue(credits_per_message)
 
     @staticmethod
     def map_msg_to_user(msg):
@@ -154,6 +261,7 @@ class DebitAccountMiddleware(TransportMiddleware):
         go_metadata = helper_metadata.setdefault('go', {})
         go_metadata['user_account'] = user_account_key
 
+    @inlineCallbacks
     def handle_outbound(self, msg, endpoint):
         # TODO: what actually happens when we raise an exception from
         #       inside middleware?
@@ -163,14 +271,32 @@ class DebitAccountMiddleware(TransportMiddleware):
         tag = TaggingMiddleware.map_msg_to_tag(msg)
         if tag is None:
             raise NoTagError(msg)
-        credits_per_message = self._credits_per_message(tag[0])
-        self._debit_account(user_account_key, credits_per_message)
-        success = self.cm.debit(user_account_key, credits_per_message)
+        credits_per_message = yield self._credits_per_message(tag[0])
+        success = yield self.cm.debit(user_account_key, credits_per_message)
         if not success:
             raise InsufficientCredit("User %r has insufficient credit"
                                      " to debit %r." %
                                      (user_account_key, credits_per_message))
-        return msg
+        returnValue(msg)
+
+
+class LocalCount(Count):
+    """A :class:`Count` that adds up increments locally and reports a single
+    total each time it is polled, instead of recording each increment.
+    """
+
+    def __init__(self, name, aggregators=None):
+        super(LocalCount, self).__init__(name, aggregators)
+        self._count = 0
+
+    def inc(self):
+        self._count += 1
+
+    def poll(self):
+        count, self._count = self._count, 0
+        if not count:
+            return []
+        return [(time.time(), count)]
 
 
 class MetricsMiddleware(BaseMiddleware):
@@ -192,9 +318,20 @@ class MetricsMiddleware(BaseMiddleware):
         `transport_name` based average response time metrics. If a message is
         received its `message_id` is stored and when a reply for the given
         `message_id` is sent out, the timestamps are compared and a averaged
-        metric is published.
+        metric is published. The 50th, 95th and 99th percentiles and the
+        maximum of the response times are published on metrics with
+        `.p50`, `.p95`, `.p99` and `.max` appended.
+    :param int max_inbound_timestamps:
+        Defaults to 10000. The maximum number of inbound message timestamps
+        to keep in memory while waiting for replies. Once this is exceeded
+        the oldest timestamps are discarded.
+    :param int shared_timestamp_ttl:
+        If set, inbound message timestamps are also stored in Redis for
+        this many seconds so that replies sent out through another process
+        can be timed. Defaults to not using Redis.
     :param dict redis_manager:
-        Connection configuration details for Redis.
+        Connection configuration details for Redis. Only required if
+        `shared_timestamp_ttl` is set.
     :param str op_mode:
         What mode to operate in, options are `passive` or `active`.
         Defaults to passive.
@@ -219,18 +356,31 @@ class MetricsMiddleware(BaseMiddleware):
         if self.op_mode not in self.KNOWN_MODES:
             raise ConfigError('Unknown op_mode: %s' % (
                 self.op_mode,))
+        self.max_inbound_timestamps = self.config.get(
+            'max_inbound_timestamps', 10000)
+        self.shared_timestamp_ttl = self.config.get('shared_timestamp_ttl')
+        if (self.shared_timestamp_ttl is not None
+                and 'redis_manager' not in self.config):
+            raise ConfigError(
+                'redis_manager is required if shared_timestamp_ttl is set.')
 
     @inlineCallbacks
     def setup_middleware(self):
         self.validate_config()
-        self.redis = yield TxRedisManager.from_config(
-            self.config['redis_manager'])
+        self._counters = {}
+        self.inbound_timestamps = LRUCache(self.max_inbound_timestamps)
+        self.response_time_histograms = {}
+        self.redis = None
+        if self.shared_timestamp_ttl is not None:
+            self.redis = yield TxRedisManager.from_config(
+                self.config['redis_manager'])
         self.metric_manager = yield self.worker.start_publisher(MetricManager,
             "%s." % (self.manager_name,))
 
     def teardown_middleware(self):
         self.metric_manager.stop()
-        return self.redis.close_manager()
+        if self.redis is not None:
+            return self.redis.close_manager()
 
     def get_or_create_metric(self, name, metric_class, *args, **kwargs):
         """
@@ -243,32 +393,64 @@ class MetricsMiddleware(BaseMiddleware):
 
     def get_counter_metric(self, name):
         metric_name = '%s.%s' % (name, self.count_suffix)
-        return self.get_or_create_metric(metric_name, Count)
+        return self.get_or_create_metric(metric_name, LocalCount)
 
-    def increment_counter(self, transport_name, message_type):
-        metric = self.get_counter_metric('%s.%s' % (transport_name,
-            message_type))
-        metric.inc()
+    def get_counter(self, transport_name, message_type, status=None):
+        """Return the counter for messages of the given type (and status)
+        on `transport_name`. Counters are looked up once and then cached.
+        """
+        key = (transport_name, message_type, status)
+        counter = self._counters.get(key)
+        if counter is None:
+            if status is None:
+                name = '%s.%s' % (transport_name, message_type)
+            else:
+                name = '%s.%s.%s' % (transport_name, message_type, status)
+            counter = self.get_counter_metric(name)
+            self._counters[key] = counter
+        return counter
+
+    def increment_counter(self, transport_name, message_type, status=None):
+        self.get_counter(transport_name, message_type, status).inc()
 
     def get_response_time_metric(self, name):
         metric_name = '%s.%s' % (name, self.response_time_suffix)
         return self.get_or_create_metric(metric_name, Metric)
 
+    def get_response_time_histogram(self, name):
+        histogram = self.response_time_histograms.get(name)
+        if histogram is None:
+            histogram = Histogram('%s.%s' % (name, self.response_time_suffix))
+            for metric in histogram.metrics():
+                self.metric_manager.register(metric)
+            self.response_time_histograms[name] = histogram
+        return histogram
+
     def set_response_time(self, transport_name, time):
         metric = self.get_response_time_metric(transport_name)
         metric.set(time)
+        self.get_response_time_histogram(transport_name).add(time)
 
     def key(self, transport_name, message_id):
         return '%s:%s' % (transport_name, message_id)
 
+    @inlineCallbacks
     def set_inbound_timestamp(self, transport_name, message):
         key = self.key(transport_name, message['message_id'])
-        return self.redis.set(key, repr(time.time()))
+        timestamp = time.time()
+        self.inbound_timestamps.set(key, timestamp)
+        if self.redis is not None:
+            yield self.redis.setex(
+                key, self.shared_timestamp_ttl, repr(timestamp))
 
     @inlineCallbacks
     def get_outbound_timestamp(self, transport_name, message):
         key = self.key(transport_name, message['in_reply_to'])
-        timestamp = yield self.redis.get(key)
+        timestamp = self.inbound_timestamps.get(key)
+        if timestamp is not None:
+            self.inbound_timestamps.delete(key)
+        elif self.redis is not None:
+            timestamp = yield self.redis.get(key)
         if timestamp:
             returnValue(float(timestamp))
 
@@ -298,43 +480,128 @@ class MetricsMiddleware(BaseMiddleware):
         returnValue(message)
 
     def handle_event(self, event, endpoint):
-        self.increment_counter(endpoint, 'event.%s' % (event['event_type']))
-        if event['event_type'] == 'delivery_report':
-            self.increment_counter(endpoint, 'event.%s.%s' % (
-                event['event_type'], event['delivery_status']))
+        event_type = event['event_type']
+        self.increment_counter(endpoint, 'event', event_type)
+        if event_type == 'delivery_report':
+            self.increment_counter(
+                endpoint, 'event.delivery_report', event['delivery_status'])
         return event
 
     def handle_failure(self, failure, endpoint):
-        self.increment_counter(endpoint, 'failure.%s' % (
-            failure['failure_code'] or 'unspecified',))
+        self.increment_counter(
+            endpoint, 'failure', failure['failure_code'] or 'unspecified')
         return failure
 
 
 class GoStoringMiddleware(StoringMiddleware):
+    """
+    Base class for middleware that stores messages in the batch of the
+    conversation or router they belong to.
+
+    By default a message is only passed on once it has been stored. In
+    write-behind mode messages are passed on immediately and stored in
+    the background instead. The worker's connectors are paused while the
+    queue of messages waiting to be stored is full, and all queued messages
+    are stored before the middleware is torn down.
+
+    Configuration options (in addition to those of `StoringMiddleware`):
+
+    :param bool write_behind:
+        Whether to store messages in the background. Defaults to `False`.
+    :param int write_behind_queue_size:
+        The number of messages that may wait to be stored before the
+        worker's connectors are paused. Defaults to 1000.
+    :param int write_behind_parallelism:
+        The maximum number of messages to store at once. Defaults to 10.
+    """
+
     @inlineCallbacks
     def setup_middleware(self):
         yield super(GoStoringMiddleware, self).setup_middleware()
-        from go.vumitools.api import VumiApi
-        self.vumi_api = yield VumiApi.from_config_async(self.config)
+        from go.vumitools.api import vumi_api_registry
+        self.vumi_api = yield vumi_api_registry.acquire(self.config)
+        self.write_behind = self.config.get('write_behind', False)
+        self.write_behind_queue_size = self.config.get(
+            'write_behind_queue_size', 1000)
+        self.write_behind_parallelism = self.config.get(
+            'write_behind_parallelism', 10)
+        self._write_queue = deque()
+        self._writes_in_progress = 0
+        self._flush_waiters = []
+        self._paused_connectors = False
+        self._tearing_down = False
 
     @inlineCallbacks
     def teardown_middleware(self):
-        yield self.vumi_api.redis.close_manager()
+        self._tearing_down = True
+        yield self.flush()
+        from go.vumitools.api import vumi_api_registry
+        yield vumi_api_registry.release(self.vumi_api)
         yield super(GoStoringMiddleware, self).teardown_middleware()
 
     def get_batch_id(self, msg):
         raise NotImplementedError("Sub-classes should implement .get_batch_id")
 
+    def store_message(self, add_message, message, batch_id):
+        """Store a message using `add_message` (one of the message store's
+        `add_*_message` methods).
+
+        In write-behind mode a copy of the message is queued to be stored
+        and this returns immediately.
+        """
+        if not self.write_behind:
+            return add_message(message, batch_id=batch_id)
+        self._write_queue.append((add_message, message.copy(), batch_id))
+        self._start_writes()
+        if (len(self._write_queue) >= self.write_behind_queue_size
+                and not self._paused_connectors):
+            self._paused_connectors = True
+            self.worker.pause_connectors()
+
+    def _start_writes(self):
+        while (self._write_queue and
+               self._writes_in_progress < self.write_behind_parallelism):
+            add_message, message, batch_id = self._write_queue.popleft()
+            self._writes_in_progress += 1
+            d = maybeDeferred(add_message, message, batch_id=batch_id)
+            d.addErrback(
+                log.err, "Error storing message %s" % (message['message_id'],))
+            d.addCallback(self._write_done)
+
+    def _write_done(self, _):
+        self._writes_in_progress -= 1
+        self._start_writes()
+        if (self._paused_connectors and not self._tearing_down
+                and len(self._write_queue) < self.write_behind_queue_size):
+            self._paused_connectors = False
+            self.worker.unpause_connectors()
+        if not self._write_queue and not self._writes_in_progress:
+            waiters, self._flush_waiters = self._flush_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def flush(self):
+        """Return a deferred that fires once all queued messages have been
+        stored.
+        """
+        if not self._write_queue and not self._writes_in_progress:
+            return succeed(None)
+        d = Deferred()
+        self._flush_waiters.append(d)
+        return d
+
     @inlineCallbacks
     def handle_inbound(self, message, connector_name):
         batch_id = yield self.get_batch_id(message)
-        yield self.store.add_inbound_message(message, batch_id=batch_id)
+        yield self.store_message(
+            self.store.add_inbound_message, message, batch_id)
         returnValue(message)
 
     @inlineCallbacks
     def handle_outbound(self, message, connector_name):
         batch_id = yield self.get_batch_id(message)
-        yield self.store.add_outbound_message(message, batch_id=batch_id)
+        yield self.store_message(
+            self.store.add_outbound_message, message, batch_id)
         returnValue(message)
 
 
@@ -344,8 +611,8 @@ class ConversationStoringMiddleware(GoStoringMiddleware):
         # MessageMetadataHelper is imported here to avoid a circular import
         from go.vumitools.utils import MessageMetadataHelper
         mdh = MessageMetadataHelper(self.vumi_api, msg)
-        conversation = yield mdh.get_conversation()
-        returnValue(conversation.batch.key)
+        batch_key = yield mdh.get_conversation_batch_key()
+        returnValue(batch_key)
 
 
 class RouterStoringMiddleware(GoStoringMiddleware):
@@ -354,5 +621,5 @@ class RouterStoringMiddleware(GoStoringMiddleware):
         # MessageMetadataHelper is imported here to avoid a circular import
         from go.vumitools.utils import MessageMetadataHelper
         mdh = MessageMetadataHelper(self.vumi_api, msg)
-        router = yield mdh.get_router()
-        returnValue(router.batch.key)
+        batch_key = yield mdh.get_router_batch_key()
+        returnValue(batch_key)
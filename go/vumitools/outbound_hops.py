@@ -0,0 +1,54 @@
+# -*- test-case-name: go.vumitools.tests.test_outbound_hops -*-
+
+import json
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+
+class OutboundHopsManager(object):
+    """Short-lived records of the routing information for outbound messages
+    that have been sent to transports.
+
+    Each record holds the `go_hops`, tag and user account of an outbound
+    message and is keyed by the message id. This is everything needed to
+    route an event for the message, so events can usually be routed without
+    loading the outbound message from the message store.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.manager = self.redis  # TODO: hack to make calls_manager work
+
+    def _hops_key(self, message_id):
+        return ":".join(["hops", message_id])
+
+    @Manager.calls_manager
+    def set_outbound_hops(self, message_id, hops, tag, user_account_key,
+                          expire_seconds):
+        """Record the routing information for an outbound message."""
+        record = json.dumps({
+            'hops': hops,
+            'tag': list(tag),
+            'user_account': user_account_key,
+        })
+        yield self.redis.setex(
+            self._hops_key(message_id), expire_seconds, record)
+
+    @Manager.calls_manager
+    def get_outbound_hops(self, message_id):
+        """Return the routing information recorded for an outbound message.
+
+        :returns:
+            A dict with `hops`, `tag` and `user_account` keys, or None if
+            there is no record for the message.
+        """
+        record = yield self.redis.get(self._hops_key(message_id))
+        if record is not None:
+            record = json.loads(record)
+        returnValue(record)
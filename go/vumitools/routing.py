@@ -1,14 +1,21 @@
 # -*- test-case-name: go.vumitools.tests.test_routing -*-
 
+import bisect
+import hashlib
+import time
+
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.dispatchers.endpoint_dispatchers import RoutingTableDispatcher
-from vumi.config import ConfigDict, ConfigText
-from vumi.message import TransportEvent
+from vumi.config import ConfigDict, ConfigText, ConfigInt, ConfigBool
+from vumi.message import Message, TransportEvent, TransportUserMessage
 from vumi import log
 
 from go.vumitools.app_worker import GoWorkerMixin, GoWorkerConfigMixin
-from go.vumitools.account import GoConnector
+from go.vumitools.account import GoConnector, RoutingTableHelper
+from go.vumitools.cache import LRUCache, TTLCache
+from go.vumitools.tagpool_cache import CachingTagpoolManager
+from go.vumitools.outbound_hops import OutboundHopsManager
 
 
 class RoutingError(Exception):
@@ -41,10 +48,68 @@ class RoutingMetadata(object):
     to event messages. It allows dispatching events through multiple
     routers while only retrieving the outbound message from the message
     store once.
+
+    Optionally, `go_hop_times` holds a list of timestamps for each hop
+    in `go_hops`. The dispatcher stamps the time it received and published
+    the message and routers stamp the time they received and published it
+    when processing it in between.
+
+    To reduce message sizes, the hops may be stored in a compact form (see
+    :meth:`compact`) in which connector names are replaced by indexes into
+    a `go_connectors` list shared by `go_hops` and `go_outbound_hops`.
+    Compact hops are decoded when a `RoutingMetadata` is created for the
+    message, so the other methods always see the full connector names.
     """
 
     def __init__(self, msg, outbound=None):
         self._msg = msg
+        self._decode()
+
+    def _decode(self):
+        routing_metadata = self._msg.get('routing_metadata')
+        if not routing_metadata or 'go_connectors' not in routing_metadata:
+            return
+        connectors = routing_metadata.pop('go_connectors')
+
+        def decode_point(point):
+            if point is None:
+                return None
+            return [connectors[point[0]], point[1]]
+
+        for key in ('go_hops', 'go_outbound_hops'):
+            if routing_metadata.get(key) is not None:
+                routing_metadata[key] = [
+                    [decode_point(src), decode_point(dst)]
+                    for src, dst in routing_metadata[key]]
+
+    def compact(self):
+        """Replace the connector names in the hops lists with indexes into a
+        shared `go_connectors` list.
+
+        This should only be done immediately before the message is
+        published since it changes the format of the hops lists.
+        """
+        self._decode()
+        routing_metadata = self._msg['routing_metadata']
+        connectors = []
+        indexes = {}
+
+        def encode_point(point):
+            if point is None:
+                return None
+            connector, endpoint = point
+            if connector not in indexes:
+                indexes[connector] = len(connectors)
+                connectors.append(connector)
+            return [indexes[connector], endpoint]
+
+        for key in ('go_hops', 'go_outbound_hops'):
+            if routing_metadata.get(key) is not None:
+                routing_metadata[key] = [
+                    [encode_point(src), encode_point(dst)]
+                    for src, dst in routing_metadata[key]]
+        if connectors:
+            routing_metadata['go_connectors'] = connectors
 
     def get_hops(self):
         """Return a reference to the hops list for the message."""
@@ -63,6 +128,28 @@ class RoutingMetadata(object):
         """Set the cached list of outbound hops."""
         self._msg['routing_metadata']['go_outbound_hops'] = outbound_hops[:]
 
+    def get_hop_times(self):
+        """Return a reference to the list of hop timestamps.
+
+        Returns None if no hop timestamps are present.
+        """
+        return self._msg['routing_metadata'].get('go_hop_times')
+
+    def stamp_hop(self, timestamp):
+        """Append a timestamp to the timestamps for the most recent hop.
+
+        Hops that were pushed without being stamped are given empty lists
+        of timestamps.
+        """
+        hops = self.get_hops()
+        if not hops:
+            return
+        hop_times = self._msg['routing_metadata'].setdefault(
+            'go_hop_times', [])
+        while len(hop_times) < len(hops):
+            hop_times.append([])
+        hop_times[len(hops) - 1].append(timestamp)
+
     def push_hop(self, source, destination):
         """Appends a `[source, destination]` pair to the hops list."""
         hops = self.get_hops()
@@ -136,6 +223,48 @@ class RoutingMetadata(object):
         return outbound_dst[1]
 
 
+class AccountShardRing(object):
+    """Consistent hash ring that assigns user accounts to dispatcher shards.
+
+    Each shard is placed on the ring at several points so that accounts
+    are spread evenly between shards and changing the number of shards
+    only moves a fraction of the accounts to a different shard.
+
+    :param int shard_count:
+        The number of shards.
+    :param int replicas:
+        The number of points on the ring for each shard.
+    """
+
+    def __init__(self, shard_count, replicas=64):
+        self.shard_count = shard_count
+        points = sorted(
+            (self._hash('%s:%s' % (shard, replica)), shard)
+            for shard in range(shard_count)
+            for replica in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def shard_for(self, user_account_key):
+        """Return the index of the shard that owns `user_account_key`."""
+        index = bisect.bisect(self._hashes, self._hash(user_account_key))
+        return self._shards[index % len(self._shards)]
+
+
+class ShardMessage(Message):
+    """A message forwarded from one dispatcher shard to another.
+
+    Contains the `message_type` (`inbound`, `outbound` or
+    `invalidate_routing_table`), the `connector_name` the original message
+    was received on and the original message `payload`.
+    """
+
+
 class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
                                           GoWorkerConfigMixin):
     application_connector_mapping = ConfigDict(
@@ -154,6 +283,54 @@ class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
         static=True, required=True)
     user_account_key = ConfigText(
         "Key of the user account the message is from.")
+    routing_table_cache_size = ConfigInt(
+        "Maximum number of account routing tables to cache in memory.",
+        default=1000, static=True)
+    routing_table_cache_ttl = ConfigInt(
+        "Number of seconds to cache account routing tables for. Cached"
+        " tables are also discarded when an `invalidate_routing_table`"
+        " command arrives, so this only bounds how long a table saved"
+        " without sending one stays stale.",
+        default=30, static=True)
+    tag_owner_cache_size = ConfigInt(
+        "Maximum number of owners of tags missing from the tag ownership"
+        " index to cache in memory. These are cached for"
+        " `routing_table_cache_ttl` seconds.",
+        default=10000, static=True)
+    tagpool_metadata_cache_ttl = ConfigInt(
+        "Number of seconds to cache tagpool metadata for.",
+        default=60, static=True)
+    outbound_hops_ttl = ConfigInt(
+        "Number of seconds to keep the routing information for messages sent"
+        " to transports. Events for messages older than this are routed"
+        " using the message store instead.",
+        default=2 * 24 * 60 * 60, static=True)
+    shard_count = ConfigInt(
+        "Number of dispatcher processes that user accounts are divided"
+        " between. A value of 1 disables sharding.",
+        default=1, static=True)
+    shard_index = ConfigInt(
+        "Index of this dispatcher process (from 0 to shard_count - 1).",
+        default=0, static=True)
+    shard_routing_key = ConfigText(
+        "Routing key prefix for messages forwarded between shards. Each"
+        " shard consumes from '<shard_routing_key>.<shard_index>'.",
+        default='routing_table_dispatcher.shard', static=True)
+    hop_timing = ConfigBool(
+        "Stamp the time messages are received and published in their"
+        " routing metadata and publish histograms of routing latencies.",
+        default=False, static=True)
+    compact_hops = ConfigBool(
+        "Publish messages with compact routing hops (see"
+        " RoutingMetadata.compact).",
+        default=False, static=True)
+    reply_timing_cache_size = ConfigInt(
+        "Maximum number of inbound messages to remember arrival times for"
+        " when measuring reply latency. Only used if hop_timing is set.",
+        default=10000, static=True)
+    forward_to_shard = ConfigInt(
+        "Index of the shard the message should be forwarded to, if it"
+        " belongs to an account owned by another shard.")
 
 
 class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
@@ -210,6 +387,35 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
     Messages received from these sources are expected to include the same
     metadata.
+
+    Routing tables are cached in memory per account for up to
+    `routing_table_cache_ttl` seconds. Anything that saves a routing table
+    is expected to send an `invalidate_routing_table` command (see
+    :meth:`VumiApi.save_user_account`) so that the cached copy is discarded
+    straight away.
+
+    Several dispatchers may share the routing load by setting `shard_count`
+    and giving each a distinct `shard_index`. All shards consume from the
+    same connectors and accounts are assigned to shards using an
+    :class:`AccountShardRing`. Inbound and outbound messages for accounts
+    owned by another shard are forwarded to that shard so that each
+    account's routing table is only cached by one shard. Events are
+    routed by whichever shard receives them since they don't use the
+    routing table.
+
+    If `hop_timing` is set, each hop is stamped with the time it was
+    received and published (see :class:`RoutingMetadata`) and histograms
+    of the following are published:
+
+    * `routing.hop_time`: time taken to route a hop.
+    * `routing.persistence_time`: time spent looking up accounts, routing
+      tables and outbound messages.
+    * `routing.transit_time`: time between publishing a message and
+      receiving it back from a router, conversation or transport.
+    * `routing.router_time`: time spent by routers processing messages.
+    * `routing.reply_time.<conversation_type>`: time between an inbound
+      message arriving from a transport and a reply to it being received
+      from the conversation.
     """
 
     CONFIG_CLASS = AccountRoutingTableDispatcherConfig
@@ -249,9 +455,43 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             config.receive_inbound_connectors)
         self.transport_connectors.discard(
             self.router_connectors)
+        self._routing_table_cache = TTLCache(
+            config.routing_table_cache_size, config.routing_table_cache_ttl)
+        self._routing_table_version = 0
+        self._fallback_tag_owners = TTLCache(
+            config.tag_owner_cache_size, config.routing_table_cache_ttl)
+        self.tpm = CachingTagpoolManager(
+            self.vumi_api.tpm, config.tagpool_metadata_cache_ttl,
+            self.metrics)
+        self.outbound_hops = OutboundHopsManager(
+            self.redis.sub_manager('outbound_hops'))
+        self.outbound_hops_ttl = config.outbound_hops_ttl
+        self.hop_timing = config.hop_timing
+        self.compact_hops = config.compact_hops
+        self._inbound_times = LRUCache(config.reply_timing_cache_size)
+        self.shard_index = config.shard_index
+        self.shard_ring = None
+        self.shard_publishers = {}
+        self.shard_consumer = None
+        if config.shard_count > 1:
+            self.shard_ring = AccountShardRing(config.shard_count)
+            yield self._setup_shards(config)
+
+    @inlineCallbacks
+    def _setup_shards(self, config):
+        for shard in range(config.shard_count):
+            if shard != self.shard_index:
+                self.shard_publishers[shard] = yield self.publish_to(
+                    '%s.%d' % (config.shard_routing_key, shard))
+        self.shard_consumer = yield self.consume(
+            '%s.%d' % (config.shard_routing_key, self.shard_index),
+            self.consume_shard_message, message_class=ShardMessage)
 
     @inlineCallbacks
     def teardown_dispatcher(self):
+        if self.shard_consumer is not None:
+            yield self.shard_consumer.stop()
+            self.shard_consumer = None
         yield self._go_teardown_worker()
         yield super(AccountRoutingTableDispatcher, self).teardown_dispatcher()
 
@@ -273,13 +513,13 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             config_dict['routing_table'] = {}
             returnValue(self.CONFIG_CLASS(config_dict))
 
+        start = time.time()
         msg_mdh = self.get_metadata_helper(msg)
 
         if msg_mdh.has_user_account():
             user_account_key = msg_mdh.get_account_key()
         elif msg_mdh.tag is not None:
-            tag_info = yield self.vumi_api.mdb.get_tag_info(tuple(msg_mdh.tag))
-            user_account_key = tag_info.metadata['user_account']
+            user_account_key = yield self.get_tag_owner(tuple(msg_mdh.tag))
             if user_account_key is None:
                 raise UnroutableMessageError(
                     "Message received for unowned tag.", msg)
@@ -287,15 +527,210 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             raise UnroutableMessageError(
                 "Could not determine user account key", msg)
 
-        user_api = self.get_user_api(user_account_key)
-        routing_table = yield user_api.get_routing_table()
-
         config_dict = self.config.copy()
         config_dict['user_account_key'] = user_account_key
-        config_dict['routing_table'] = routing_table
 
+        shard = self.shard_for_account(user_account_key)
+        if shard != self.shard_index:
+            config_dict['forward_to_shard'] = shard
+            config_dict['routing_table'] = {}
+        else:
+            config_dict['routing_table'] = yield self.get_routing_table(
+                user_account_key)
+
+        self.observe_time('routing.persistence_time', start)
         returnValue(self.CONFIG_CLASS(config_dict))
 
+    def publish_inbound(self, msg, connector_name, endpoint):
+        self.compact_routing_metadata(msg)
+        return super(AccountRoutingTableDispatcher, self).publish_inbound(
+            msg, connector_name, endpoint)
+
+    def publish_outbound(self, msg, connector_name, endpoint):
+        self.compact_routing_metadata(msg)
+        return super(AccountRoutingTableDispatcher, self).publish_outbound(
+            msg, connector_name, endpoint)
+
+    def publish_event(self, event, connector_name, endpoint):
+        self.compact_routing_metadata(event)
+        return super(AccountRoutingTableDispatcher, self).publish_event(
+            event, connector_name, endpoint)
+
+    def compact_routing_metadata(self, msg):
+        if self.compact_hops:
+            RoutingMetadata(msg).compact()
+
+    def observe_time(self, name, start, end=None):
+        """Record the time between `start` and `end` (or now) in the named
+        histogram if hop timing is enabled.
+        """
+        if not self.hop_timing:
+            return
+        if end is None:
+            end = time.time()
+        self.metrics.observe(name, end - start)
+
+    def stamp_source(self, msg):
+        """Stamp the time a message was received from its source and record
+        how long it took to get here from the previous hop.
+        """
+        if not self.hop_timing:
+            return
+        rmeta = RoutingMetadata(msg)
+        rmeta.stamp_hop(time.time())
+        hop_times = rmeta.get_hop_times()
+        if len(hop_times) < 2 or not hop_times[-2]:
+            return
+        previous = hop_times[-2]
+        self.observe_time(
+            'routing.transit_time', previous[-1], hop_times[-1][0])
+        if len(previous) >= 4:
+            # stamped by a router after it was stamped by a dispatcher
+            self.observe_time('routing.router_time', previous[2], previous[3])
+
+    def stamp_destination(self, msg):
+        """Stamp the time a message was published to its destination and
+        record how long it took to route.
+        """
+        if not self.hop_timing:
+            return
+        rmeta = RoutingMetadata(msg)
+        rmeta.stamp_hop(time.time())
+        times = rmeta.get_hop_times()[-1]
+        if len(times) == 2:
+            self.observe_time('routing.hop_time', times[0], times[1])
+
+    def remember_inbound_time(self, msg):
+        """Remember when an inbound message headed for a conversation first
+        arrived so that the time taken to reply to it can be measured.
+        """
+        if not self.hop_timing:
+            return
+        hop_times = RoutingMetadata(msg).get_hop_times()
+        if hop_times and hop_times[0]:
+            self._inbound_times.set(msg['message_id'], hop_times[0][0])
+
+    def observe_reply_time(self, msg):
+        """Record the time taken for a conversation to reply to an inbound
+        message.
+        """
+        if not self.hop_timing or msg.get('in_reply_to') is None:
+            return
+        arrived = self._inbound_times.get(msg['in_reply_to'])
+        if arrived is None:
+            return
+        self._inbound_times.delete(msg['in_reply_to'])
+        conv_type = self.get_metadata_helper(msg).get_conversation_info()[
+            'conversation_type']
+        self.observe_time('routing.reply_time.%s' % (conv_type,), arrived)
+
+    def shard_for_account(self, user_account_key):
+        """Return the index of the shard that routes messages for the given
+        account.
+        """
+        if self.shard_ring is None:
+            return self.shard_index
+        return self.shard_ring.shard_for(user_account_key)
+
+    def forward_to_shard(self, shard, message_type, payload,
+                         connector_name=None):
+        """Forward a message to another shard."""
+        return self.shard_publishers[shard].publish_message(ShardMessage(
+            message_type=message_type, connector_name=connector_name,
+            payload=payload))
+
+    @inlineCallbacks
+    def consume_shard_message(self, shard_msg):
+        """Process a message forwarded from another shard."""
+        message_type = shard_msg['message_type']
+        if message_type == 'invalidate_routing_table':
+            self.invalidate_routing_table(**shard_msg['payload'])
+            return
+        handler = {
+            'inbound': self.process_inbound,
+            'outbound': self.process_outbound,
+        }.get(message_type)
+        if handler is None:
+            log.warning("Ignoring shard message of unknown type: %r"
+                        % (shard_msg,))
+            return
+        msg = TransportUserMessage(**shard_msg['payload'])
+        config = yield self.get_config(msg)
+        yield handler(config, msg, shard_msg['connector_name'])
+
+    @inlineCallbacks
+    def get_tag_owner(self, tag):
+        """Return the key of the account that owns `tag`.
+
+        Ownership is looked up in the tag ownership index. Tags acquired
+        before the index existed are looked up in the message store. Those
+        owners are cached in memory for `routing_table_cache_ttl` seconds
+        rather than added to the index, so that a tag released while we
+        look it up isn't written back to the index with its old owner.
+        """
+        user_account_key = yield self.vumi_api.tag_owners.get_owner(tag)
+        if user_account_key is None:
+            user_account_key = self._fallback_tag_owners.get(tag)
+        if user_account_key is None:
+            tag_info = yield self.vumi_api.mdb.get_tag_info(tag)
+            user_account_key = tag_info.metadata['user_account']
+            if user_account_key is not None:
+                self._fallback_tag_owners.set(tag, user_account_key)
+        returnValue(user_account_key)
+
+    @inlineCallbacks
+    def get_routing_table(self, user_account_key):
+        """Return the routing table for the given account."""
+        rt_helper = yield self.get_routing_table_helper(user_account_key)
+        returnValue(rt_helper.routing_table)
+
+    @inlineCallbacks
+    def get_routing_table_helper(self, user_account_key):
+        """Return a :class:`RoutingTableHelper` for the given account's
+        routing table.
+
+        Helpers are served from the in-memory cache if possible, so a
+        table's compiled form is built at most once each time the table is
+        loaded. A table loaded while an invalidation is being processed is
+        not cached, since it may already be stale.
+        """
+        rt_helper = self._routing_table_cache.get(user_account_key)
+        if rt_helper is not None:
+            returnValue(rt_helper)
+        version = self._routing_table_version
+        user_api = self.get_user_api(user_account_key)
+        rt_helper = RoutingTableHelper((yield user_api.get_routing_table()))
+        if version == self._routing_table_version:
+            self._routing_table_cache.set(user_account_key, rt_helper)
+        returnValue(rt_helper)
+
+    def process_command_invalidate_routing_table(self, user_account_key=None):
+        """Discard the cached routing table for an account.
+
+        If no account is given, all cached routing tables are discarded.
+        When sharding, the command is forwarded to the shard that owns the
+        account (or to all shards if no account is given).
+        """
+        if self.shard_ring is not None:
+            if user_account_key is None:
+                shards = self.shard_publishers.keys()
+            else:
+                shards = [self.shard_for_account(user_account_key)]
+            payload = {'user_account_key': user_account_key}
+            for shard in shards:
+                if shard != self.shard_index:
+                    self.forward_to_shard(
+                        shard, 'invalidate_routing_table', payload)
+        self.invalidate_routing_table(user_account_key)
+
+    def invalidate_routing_table(self, user_account_key=None):
+        """Discard cached routing tables held by this shard."""
+        self._routing_table_version += 1
+        if user_account_key is None:
+            self._routing_table_cache.clear()
+        else:
+            self._routing_table_cache.delete(user_account_key)
+
     def connector_type(self, connector_name):
         if connector_name in self.application_connectors:
             return self.CONVERSATION
@@ -358,6 +793,8 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         if conn.ctype == conn.CONVERSATION:
             msg_mdh.set_conversation_info(conn.conv_type, conn.conv_key)
             dst_connector_name = self.get_application_connector(conn.conv_type)
+            if msg.get('message_type') == 'user_message':
+                self.remember_inbound_time(msg)
 
         elif conn.ctype == conn.ROUTER:
             msg_mdh.set_router_info(conn.router_type, conn.router_key)
@@ -366,8 +803,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         elif conn.ctype == conn.TRANSPORT_TAG:
             msg_mdh.set_tag([conn.tagpool, conn.tagname])
-            tagpool_metadata = yield self.vumi_api.tpm.get_metadata(
-                conn.tagpool)
+            tagpool_metadata = yield self.tpm.get_metadata(conn.tagpool)
             transport_name = tagpool_metadata.get('transport_name')
             if transport_name is None:
                 raise UnroutableMessageError(
@@ -399,6 +835,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         rmeta = RoutingMetadata(msg)
         rmeta.push_destination(str(conn), target[1])
+        self.stamp_destination(msg)
         returnValue((dst_connector_name, target[1]))
 
     def acquire_source(self, msg, connector_type, direction):
@@ -447,10 +884,10 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
                 " but unknown. Bad connector type is: %s"
                 % connector_type, msg)
 
-        src_conn_str = str(src_conn)
         rmeta = RoutingMetadata(msg)
-        rmeta.push_source(src_conn_str, msg.get_routing_endpoint())
-        return src_conn_str
+        rmeta.push_source(src_conn, msg.get_routing_endpoint())
+        self.stamp_source(msg)
+        return src_conn
 
     @inlineCallbacks
     def publish_inbound_optout(self, config, msg):
@@ -481,6 +918,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         dst_conn = GoConnector.for_transport_tag(*orig_msg_mdh.tag)
         dst_connector_name, dst_endpoint = yield self.set_destination(
             msg, [str(dst_conn), 'default'], self.OUTBOUND)
+        yield self.store_outbound_hops(msg)
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
     @inlineCallbacks
@@ -502,6 +940,12 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         msg_mdh = self.get_metadata_helper(msg)
         msg_mdh.set_user_account(config.user_account_key)
 
+        if config.forward_to_shard is not None:
+            yield self.forward_to_shard(
+                config.forward_to_shard, 'inbound', msg.payload,
+                connector_name)
+            return
+
         connector_type = self.connector_type(connector_name)
         src_conn = self.acquire_source(msg, connector_type, self.INBOUND)
 
@@ -540,9 +984,18 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         msg_mdh = self.get_metadata_helper(msg)
         msg_mdh.set_user_account(config.user_account_key)
 
+        if config.forward_to_shard is not None:
+            yield self.forward_to_shard(
+                config.forward_to_shard, 'outbound', msg.payload,
+                connector_name)
+            return
+
         connector_type = self.connector_type(connector_name)
         src_conn = self.acquire_source(msg, connector_type, self.OUTBOUND)
 
+        if connector_type == self.CONVERSATION:
+            self.observe_reply_time(msg)
+
         if connector_type == self.OPT_OUT:
             yield self.publish_outbound_optout(config, msg)
             return
@@ -556,8 +1009,20 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         dst_connector_name, dst_endpoint = yield self.set_destination(
             msg, target, self.OUTBOUND)
 
+        if self.connector_type(dst_connector_name) == self.TRANSPORT_TAG:
+            yield self.store_outbound_hops(msg)
+
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
+    def store_outbound_hops(self, msg):
+        """Record the routing information events for a message sent to a
+        transport will need.
+        """
+        msg_mdh = self.get_metadata_helper(msg)
+        return self.outbound_hops.set_outbound_hops(
+            msg['message_id'], RoutingMetadata(msg).get_hops(), msg_mdh.tag,
+            msg_mdh.get_account_key(), self.outbound_hops_ttl)
+
     @inlineCallbacks
     def _set_event_metadata(self, event):
         """Sets the user account, tag and outbound hops metadata on an event
@@ -574,8 +1039,21 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
                 and event_mdh.tag is not None):
             return
 
-        # some metadata is missing, grab the associated outbound message
-        # and look for it there:
+        # some metadata is missing, look for the routing information stored
+        # when the associated outbound message was sent:
+
+        user_message_id = event.get('user_message_id')
+        if user_message_id is not None:
+            outbound_hops = yield self.outbound_hops.get_outbound_hops(
+                user_message_id)
+            if outbound_hops is not None:
+                event_mdh.set_tag(outbound_hops['tag'])
+                event_mdh.set_user_account(outbound_hops['user_account'])
+                event_rmeta.set_outbound_hops(outbound_hops['hops'])
+                return
+
+        # we don't have the routing information, so grab the associated
+        # outbound message and look for it there:
 
         msg = yield self.find_message_for_event(event)
         if msg is None:
@@ -624,7 +1102,9 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         # events are in same direction as inbound messages so
         # we use INBOUND as the direction in this method.
 
+        start = time.time()
         yield self._set_event_metadata(event)
+        self.observe_time('routing.persistence_time', start)
 
         connector_type = self.connector_type(connector_name)
         # we ignore the source connector returned but .acquire_source() sets
@@ -0,0 +1,40 @@
+# -*- test-case-name: go.vumitools.tests.test_tag_ownership -*-
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+
+class TagOwnershipManager(object):
+    """An index of which user account owns each acquired tag.
+
+    This duplicates the `user_account` field of the message store's tag
+    info so that the owner of a tag can be found with a single Redis lookup
+    instead of a Riak load. The owners for each tag pool are stored in a
+    single Redis hash.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.manager = self.redis  # TODO: hack to make calls_manager work
+
+    @Manager.calls_manager
+    def get_owner(self, tag):
+        """Return the key of the account owning `tag` (or None if the tag
+        has no owner in the index).
+        """
+        user_account_key = yield self.redis.hget(
+            self._owners_key(tag[0]), tag[1])
+        returnValue(user_account_key)
+
+    def set_owner(self, tag, user_account_key):
+        """Record that `tag` is owned by the given user account."""
+        return self.redis.hset(
+            self._owners_key(tag[0]), tag[1], user_account_key)
+
+    def clear_owner(self, tag):
+        """Remove any ownership record for `tag`."""
+        return self.redis.hdel(self._owners_key(tag[0]), tag[1])
+
+    def _owners_key(self, pool):
+        return ":".join(["owners", pool])
@@ -0,0 +1,115 @@
+# -*- test-case-name: go.vumitools.tests.test_tagpool_cache -*-
+
+from weakref import WeakKeyDictionary
+
+from twisted.internet import reactor
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+from vumi.blinkenlights.metrics import Count
+
+
+class CachingTagpoolManager(object):
+    """Wraps a :class:`vumi.components.tagpool.TagpoolManager` and caches
+    tagpool metadata in memory.
+
+    Cached metadata expires after `ttl` seconds and is discarded immediately
+    if it is changed through this wrapper. Everything other than metadata
+    access is passed straight through to the wrapped tagpool manager.
+
+    :param TagpoolManager tpm:
+        The tagpool manager to wrap.
+    :param int ttl:
+        Number of seconds to cache metadata for.
+    :param MetricManager metric_manager:
+        If given, cache hits and misses are counted on the
+        `tagpool_metadata_cache.hits` and `tagpool_metadata_cache.misses`
+        metrics.
+    :param clock:
+        Provider of the current time. Defaults to the reactor.
+    :param dict cache:
+        Dictionary to hold cached metadata in. Defaults to a new dictionary.
+        See :func:`shared_metadata_cache`.
+    """
+
+    HITS_METRIC = 'tagpool_metadata_cache.hits'
+    MISSES_METRIC = 'tagpool_metadata_cache.misses'
+
+    def __init__(self, tpm, ttl=60, metric_manager=None, clock=None,
+                 cache=None):
+        self.tpm = tpm
+        self.manager = tpm.redis  # TODO: hack to make calls_manager work
+        self.ttl = ttl
+        self.metric_manager = metric_manager
+        self.clock = clock if clock is not None else reactor
+        self.hits = 0
+        self.misses = 0
+        self._metadata = cache if cache is not None else {}
+
+    def __getattr__(self, name):
+        # Proxy anything we don't have back to the wrapped tagpool manager.
+        return getattr(self.tpm, name)
+
+    def _count(self, name):
+        if self.metric_manager is None:
+            return
+        if name not in self.metric_manager:
+            self.metric_manager.register(Count(name))
+        self.metric_manager[name].inc()
+
+    def _get_cached(self, pool):
+        cached = self._metadata.get(pool)
+        if cached is None:
+            return None
+        expires_at, metadata = cached
+        if expires_at <= self.clock.seconds():
+            del self._metadata[pool]
+            return None
+        return metadata
+
+    @Manager.calls_manager
+    def get_metadata(self, pool):
+        metadata = self._get_cached(pool)
+        if metadata is not None:
+            self.hits += 1
+            self._count(self.HITS_METRIC)
+            returnValue(metadata)
+        self.misses += 1
+        self._count(self.MISSES_METRIC)
+        metadata = yield self.tpm.get_metadata(pool)
+        self._metadata[pool] = (self.clock.seconds() + self.ttl, metadata)
+        returnValue(metadata)
+
+    def set_metadata(self, pool, metadata):
+        self.invalidate(pool)
+        return self.tpm.set_metadata(pool, metadata)
+
+    def purge_pool(self, pool):
+        self.invalidate(pool)
+        return self.tpm.purge_pool(pool)
+
+    def invalidate(self, pool=None):
+        """Discard cached metadata for `pool` (or for all pools if no pool
+        is given).
+        """
+        if pool is None:
+            self._metadata.clear()
+        else:
+            self._metadata.pop(pool, None)
+
+
+# Maps workers to dictionaries of metadata caches keyed by Redis key prefix.
+# The caches are discarded along with the worker.
+_worker_metadata_caches = WeakKeyDictionary()
+
+
+def shared_metadata_cache(worker, tpm):
+    """Return a metadata cache shared by all caching tagpool managers that
+    are created for `worker` and store tagpools under the same Redis key
+    prefix as `tpm`.
+
+    This allows middlewares running in the same transport worker to share
+    cached tagpool metadata.
+    """
+    caches = _worker_metadata_caches.setdefault(worker, {})
+    return caches.setdefault(tpm.redis.get_key_prefix(), {})
@@ -0,0 +1,294 @@
+"""Benchmarks for the AccountRoutingTableDispatcher.
+
+These use the same persistence and AMQP stand-ins as the routing tests but
+are not part of the normal test suite. Run them with::
+
+    trial go.vumitools.tests.benchmark_routing
+
+The number of messages sent through each topology may be changed by setting
+the GO_ROUTING_BENCHMARK_MESSAGES environment variable.
+
+For each topology and kind of traffic the report lists the messages routed
+per second, percentiles of the time taken to route a single hop (i.e. to
+dispatch a message to the dispatcher and have it published onwards) and
+the number of Riak and Redis calls made per message.
+"""
+
+import os
+import sys
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.message import TransportUserMessage, TransportEvent
+
+from go.vumitools.histogram import percentile
+from go.vumitools.routing import AccountRoutingTableDispatcher, RoutingMetadata
+from go.vumitools.tests.utils import AppWorkerTestCase
+from go.vumitools.utils import MessageMetadataHelper
+
+
+RIAK_METHODS = (
+    'load', 'load_all_bunches', 'store', 'delete', 'run_map_reduce')
+
+ROUTER_CHAIN_LENGTH = 3
+MANY_TAGS_TAG_COUNT = 100
+MANY_TAGS_CONVERSATION_COUNT = 10
+
+
+class BenchmarkResult(object):
+    """Timings and persistence call counts for a benchmark run."""
+
+    def __init__(self, topology, traffic):
+        self.topology = topology
+        self.traffic = traffic
+        self.messages = 0
+        self.elapsed = 0.0
+        self.hop_times = []
+        self.persistence_calls = {'riak': 0, 'redis': 0}
+
+    def per_message(self, value):
+        return float(value) / self.messages if self.messages else 0.0
+
+    def rate(self):
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    def format(self):
+        if self.hop_times:
+            hops = ' '.join(
+                'p%s=%.2fms' % (pct, percentile(self.hop_times, pct) * 1000)
+                for pct in (50, 90, 99))
+        else:
+            hops = 'no hops'
+        return (
+            "%-22s %-8s %6d msgs %9.1f msgs/s  hop: %s  riak/msg: %.2f"
+            "  redis/msg: %.2f" % (
+                self.topology, self.traffic, self.messages, self.rate(),
+                hops, self.per_message(self.persistence_calls['riak']),
+                self.per_message(self.persistence_calls['redis'])))
+
+
+class RoutingBenchmark(AppWorkerTestCase):
+    timeout = 600
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(RoutingBenchmark, self).setUp()
+        self.message_count = int(
+            os.environ.get('GO_ROUTING_BENCHMARK_MESSAGES', 500))
+        self.dispatcher = yield self.get_worker(self.mk_config({
+            "receive_inbound_connectors": ["sphex", "router_ro"],
+            "receive_outbound_connectors": ["app1", "router_ri", "optout"],
+            "application_connector_mapping": {"app1": "app1"},
+            "router_inbound_connector_mapping": {"router": "router_ro"},
+            "router_outbound_connector_mapping": {"router": "router_ri"},
+            "opt_out_connector": "optout",
+        }), AccountRoutingTableDispatcher)
+        self.vumi_api = self.dispatcher.vumi_api
+        self.result = None
+        self.count_persistence_calls()
+
+    def count_persistence_calls(self):
+        """Patch the Riak manager and Redis client to count calls made to
+        them while a benchmark is running.
+        """
+        def counting(kind, method):
+            def wrapper(*args, **kw):
+                if self.result is not None:
+                    self.result.persistence_calls[kind] += 1
+                return method(*args, **kw)
+            return wrapper
+
+        riak_manager_class = type(self.vumi_api.manager)
+        for name in RIAK_METHODS:
+            method = getattr(riak_manager_class, name, None)
+            if method is not None:
+                self.patch(riak_manager_class, name, counting('riak', method))
+
+        redis_client = self.vumi_api.redis._client
+        for name in dir(redis_client):
+            method = getattr(redis_client, name)
+            if not name.startswith('_') and callable(method):
+                self.patch(redis_client, name, counting('redis', method))
+
+    @inlineCallbacks
+    def setup_account(self, routing_table, tag_count):
+        user_account = yield self.mk_user(self.vumi_api, u'benchuser')
+        user_account.routing_table = routing_table
+        yield user_account.save()
+        self.user_account_key = user_account.key
+        user_api = self.vumi_api.get_user_api(self.user_account_key)
+        tags = yield self.setup_tagpool(
+            u"pool1", [u"%04d" % i for i in range(tag_count)])
+        for tag in tags:
+            yield user_api.acquire_specific_tag(tag)
+        returnValue(tags)
+
+    def take_published(self, connector_name, message_type):
+        """Remove and return the messages published on a connector."""
+        rkey = '%s.%s' % (connector_name, message_type)
+        contents = self._amqp.dispatched['vumi'].pop(rkey, [])
+        if message_type == 'event':
+            message_class = TransportEvent
+        else:
+            message_class = TransportUserMessage
+        return [message_class.from_json(content.body) for content in contents]
+
+    @inlineCallbacks
+    def timed_dispatch(self, dispatch, msg, connector_name):
+        start = time.time()
+        yield dispatch(msg, connector_name)
+        self.result.hop_times.append(time.time() - start)
+
+    @inlineCallbacks
+    def route_inbound(self, msg):
+        """Route an inbound message from the transport to a conversation,
+        standing in for any routers along the way.
+        """
+        yield self.timed_dispatch(self.dispatch_inbound, msg, 'sphex')
+        router_msgs = self.take_published('router_ri', 'inbound')
+        while router_msgs:
+            for router_msg in router_msgs:
+                router_msg.set_routing_endpoint('default')
+                yield self.timed_dispatch(
+                    self.dispatch_inbound, router_msg, 'router_ro')
+            router_msgs = self.take_published('router_ri', 'inbound')
+        self.take_published('app1', 'inbound')
+
+    @inlineCallbacks
+    def route_outbound(self, msg):
+        """Route an outbound message from a conversation to the transport,
+        standing in for any routers along the way. Returns the messages
+        published to the transport.
+        """
+        yield self.timed_dispatch(self.dispatch_outbound, msg, 'app1')
+        router_msgs = self.take_published('router_ro', 'outbound')
+        while router_msgs:
+            for router_msg in router_msgs:
+                router_msg.set_routing_endpoint('default')
+                yield self.timed_dispatch(
+                    self.dispatch_outbound, router_msg, 'router_ri')
+            router_msgs = self.take_published('router_ro', 'outbound')
+        returnValue(self.take_published('sphex', 'outbound'))
+
+    @inlineCallbacks
+    def route_event(self, event):
+        """Route an event from the transport to a conversation, standing in
+        for any routers along the way.
+        """
+        yield self.timed_dispatch(self.dispatch_event, event, 'sphex')
+        router_events = self.take_published('router_ri', 'event')
+        while router_events:
+            for router_event in router_events:
+                router_event.set_routing_endpoint(
+                    RoutingMetadata(router_event).next_router_endpoint())
+                yield self.timed_dispatch(
+                    self.dispatch_event, router_event, 'router_ro')
+            router_events = self.take_published('router_ri', 'event')
+        self.take_published('app1', 'event')
+
+    def mk_inbound(self, tag):
+        msg = self.mkmsg_in()
+        msg.payload.setdefault('helper_metadata', {})
+        MessageMetadataHelper(self.vumi_api, msg).set_tag(list(tag))
+        return msg
+
+    def mk_outbound(self, conversation_key, endpoint='default'):
+        msg = self.mkmsg_out()
+        msg.payload.setdefault('helper_metadata', {})
+        msg.set_routing_endpoint(endpoint)
+        md = MessageMetadataHelper(self.vumi_api, msg)
+        md.set_conversation_info(u'app1', conversation_key)
+        md.set_user_account(self.user_account_key)
+        return msg
+
+    @inlineCallbacks
+    def run_traffic(self, topology, tags, conversation_endpoints):
+        """Send inbound, outbound and event traffic through the dispatcher
+        and report on each.
+
+        Inbound messages are sent from each of `tags` in turn and outbound
+        messages from each `(conversation_key, endpoint)` pair in
+        `conversation_endpoints` in turn.
+        """
+        count = self.message_count
+
+        self.result = BenchmarkResult(topology, 'inbound')
+        msgs = [self.mk_inbound(tags[i % len(tags)]) for i in range(count)]
+        start = time.time()
+        for msg in msgs:
+            yield self.route_inbound(msg)
+        self.report(start, count)
+
+        self.result = BenchmarkResult(topology, 'outbound')
+        msgs = [
+            self.mk_outbound(*conversation_endpoints[
+                i % len(conversation_endpoints)])
+            for i in range(count)]
+        sent = []
+        start = time.time()
+        for msg in msgs:
+            sent.extend((yield self.route_outbound(msg)))
+        self.report(start, count)
+
+        self.result = BenchmarkResult(topology, 'event')
+        events = [
+            self.mkmsg_ack(user_message_id=msg['message_id']) for msg in sent]
+        start = time.time()
+        for event in events:
+            yield self.route_event(event)
+        self.report(start, len(events))
+
+    def report(self, start, messages):
+        self.result.elapsed = time.time() - start
+        self.result.messages = messages
+        sys.stdout.write(self.result.format() + '\n')
+        self.result = None
+
+    @inlineCallbacks
+    def test_tag_to_conversation(self):
+        yield self.setup_account({
+            "TRANSPORT_TAG:pool1:0000": {
+                "default": ["CONVERSATION:app1:conv1", "default"]},
+            "CONVERSATION:app1:conv1": {
+                "default": ["TRANSPORT_TAG:pool1:0000", "default"]},
+        }, tag_count=1)
+        yield self.run_traffic(
+            'tag_to_conversation', [("pool1", "0000")],
+            [(u'conv1', 'default')])
+
+    @inlineCallbacks
+    def test_router_chain(self):
+        # tag <-> router0 <-> router1 <-> ... <-> conversation
+        sides = ["TRANSPORT_TAG:pool1:0000"]
+        for i in range(ROUTER_CHAIN_LENGTH):
+            sides.append("ROUTER:router:router%d:INBOUND" % i)
+            sides.append("ROUTER:router:router%d:OUTBOUND" % i)
+        sides.append("CONVERSATION:app1:conv1")
+        routing_table = {}
+        for src, dst in zip(sides[::2], sides[1::2]):
+            routing_table[src] = {"default": [dst, "default"]}
+            routing_table[dst] = {"default": [src, "default"]}
+        yield self.setup_account(routing_table, tag_count=1)
+        yield self.run_traffic(
+            'router_chain_%d' % (ROUTER_CHAIN_LENGTH,), [("pool1", "0000")],
+            [(u'conv1', 'default')])
+
+    @inlineCallbacks
+    def test_many_tags(self):
+        # Each tag is routed to one of the conversations. Conversations
+        # reply via an endpoint named after the tag.
+        routing_table = {}
+        tags = [("pool1", "%04d" % i) for i in range(MANY_TAGS_TAG_COUNT)]
+        conversation_endpoints = []
+        for i, (pool, tag) in enumerate(tags):
+            conv_key = u'conv%d' % (i % MANY_TAGS_CONVERSATION_COUNT,)
+            tag_conn = "TRANSPORT_TAG:%s:%s" % (pool, tag)
+            conv_conn = "CONVERSATION:app1:%s" % (conv_key,)
+            routing_table[tag_conn] = {"default": [conv_conn, "default"]}
+            routing_table.setdefault(conv_conn, {})[tag] = [
+                tag_conn, "default"]
+            conversation_endpoints.append((conv_key, tag))
+        yield self.setup_account(routing_table, len(tags))
+        yield self.run_traffic(
+            'many_tags_%d' % (len(tags),), tags, conversation_endpoints)
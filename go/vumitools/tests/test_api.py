@@ -13,7 +13,7 @@ from vumi.errors import VumiError
 from go.vumitools.opt_out import OptOutStore
 from go.vumitools.contact import ContactStore
 from go.vumitools.api import (
-    VumiApi, VumiUserApi, VumiApiCommand, VumiApiEvent)
+    VumiApi, VumiUserApi, VumiApiCommand, VumiApiEvent, VumiApiRegistry)
 from go.vumitools.tests.utils import AppWorkerTestCase, FakeAmqpConnection
 from go.vumitools.account.old_models import AccountStoreVNone, AccountStoreV1
 from go.vumitools.account.models import GoConnector, RoutingTableHelper
@@ -51,6 +51,32 @@ class TestTxVumiApi(AppWorkerTestCase):
         self.assertEqual(cmd1.payload['kwargs']['to_addr'], '+12')
         self.assertEqual(cmd2.payload['kwargs']['to_addr'], '+34')
 
+    @inlineCallbacks
+    def test_save_user_account(self):
+        user_account = yield self.mk_user(self.vumi_api, u'Buster')
+        user_account.routing_table = {}
+        yield self.vumi_api.save_user_account(user_account)
+        [cmd] = self.get_dispatcher_commands()
+        self.assertEqual(cmd['worker_name'], 'routing_table_dispatcher')
+        self.assertEqual(cmd['command'], 'invalidate_routing_table')
+        self.assertEqual(cmd['kwargs'], {
+            'user_account_key': user_account.key,
+        })
+
+    @inlineCallbacks
+    def test_invalidate_routing_table_configured_worker_name(self):
+        config = self.mk_config({
+            'routing_table_dispatcher_name': 'my_dispatcher'})
+        if self.sync_persistence:
+            vumi_api = VumiApi.from_config_sync(
+                config, FakeAmqpConnection(self._amqp))
+        else:
+            vumi_api = yield VumiApi.from_config_async(
+                config, get_fake_amq_client(self._amqp))
+        yield vumi_api.invalidate_routing_table(u'user-1')
+        [cmd] = self.get_dispatcher_commands()
+        self.assertEqual(cmd['worker_name'], 'my_dispatcher')
+
 
 class TestVumiApi(TestTxVumiApi):
     sync_persistence = True
@@ -147,11 +173,15 @@ class TestTxVumiUserApi(AppWorkerTestCase):
         self.assertEqual(tag2_info.metadata['user_account'],
                          self.user_api.user_account_key)
         self.assertNotEqual(tag2_info.current_batch.key, None)
+        self.assertEqual((yield self.vumi_api.tag_owners.get_owner(tag2)),
+                         self.user_api.user_account_key)
 
         yield self.user_api.release_tag(tag2)
         yield self.assert_account_tags([list(tag1)])
         tag2_info = yield self.vumi_api.mdb.get_tag_info(tag2)
         self.assertEqual(tag2_info.metadata['user_account'], None)
+        self.assertEqual((yield self.vumi_api.tag_owners.get_owner(tag2)),
+                         None)
         self.assertEqual(tag2_info.current_batch.key, None)
         self.assertEqual((yield self.user_api.acquire_tag(u"poolA")), tag2)
         self.assertEqual((yield self.user_api.acquire_tag(u"poolA")), None)
@@ -411,6 +441,12 @@ class TestTxVumiRouterApi(AppWorkerTestCase):
         router = yield router_api.get_router()
         self.assertEqual(router.archive_status, 'archived')
         self.assertEqual({}, (yield self.user_api.get_routing_table()))
+        [cmd] = self.get_dispatcher_commands()
+        self.assertEqual(cmd['worker_name'], 'routing_table_dispatcher')
+        self.assertEqual(cmd['command'], 'invalidate_routing_table')
+        self.assertEqual(cmd['kwargs'], {
+            'user_account_key': self.user_account.key,
+        })
 
     @inlineCallbacks
     def test_start_router(self):
@@ -455,6 +491,61 @@ class TestVumiRouterApi(TestTxVumiRouterApi):
     sync_persistence = True
 
 
+class TestVumiApiRegistry(AppWorkerTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestVumiApiRegistry, self).setUp()
+        self.registry = VumiApiRegistry()
+
+    @inlineCallbacks
+    def test_acquire_shares_api(self):
+        config = self.mk_config({})
+        vumi_api = yield self.registry.acquire(config)
+        self.assertTrue(isinstance(vumi_api, VumiApi))
+        other_api = yield self.registry.acquire(
+            dict(config, unrelated_option=True))
+        self.assertTrue(other_api is vumi_api)
+        yield self.registry.release(vumi_api)
+        yield self.registry.release(vumi_api)
+
+    @inlineCallbacks
+    def test_acquire_different_config(self):
+        config = self.mk_config({})
+        vumi_api = yield self.registry.acquire(config)
+        redis_config = dict(config['redis_manager'], key_prefix='other')
+        other_api = yield self.registry.acquire(
+            dict(config, redis_manager=redis_config))
+        self.assertFalse(other_api is vumi_api)
+        yield self.registry.release(vumi_api)
+        yield self.registry.release(other_api)
+
+    @inlineCallbacks
+    def test_acquire_adds_sender(self):
+        config = self.mk_config({})
+        vumi_api = yield self.registry.acquire(config)
+        self.assertEqual(vumi_api.mapi, None)
+        yield self.registry.acquire(config, get_fake_amq_client(self._amqp))
+        self.assertNotEqual(vumi_api.mapi, None)
+        yield self.registry.release(vumi_api)
+        yield self.registry.release(vumi_api)
+
+    @inlineCallbacks
+    def test_release(self):
+        closed = []
+        config = self.mk_config({})
+        vumi_api = yield self.registry.acquire(config)
+        yield self.registry.acquire(config)
+        self.patch(vumi_api.redis, 'close_manager',
+                   lambda: closed.append(vumi_api))
+        yield self.registry.release(vumi_api)
+        self.assertEqual(closed, [])
+        yield self.registry.release(vumi_api)
+        self.assertEqual(closed, [vumi_api])
+        new_api = yield self.registry.acquire(config)
+        self.assertFalse(new_api is vumi_api)
+        yield self.registry.release(new_api)
+
+
 class TestVumiApiCommand(TestCase):
     def test_default_routing_config(self):
         cfg = VumiApiCommand.default_routing_config()
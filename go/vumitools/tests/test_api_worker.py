@@ -4,10 +4,10 @@
 
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.tests.utils import LogCatcher
+from vumi.tests.utils import LogCatcher, get_fake_amq_client
 
 from go.vumitools.api_worker import EventDispatcher, CommandDispatcher
-from go.vumitools.api import VumiApiCommand, VumiApiEvent
+from go.vumitools.api import VumiApi, VumiApiCommand, VumiApiEvent
 from go.vumitools.handler import EventHandler, SendMessageCommandHandler
 from go.vumitools.tests.utils import AppWorkerTestCase
 
@@ -50,6 +50,34 @@ class CommandDispatcherTestCase(AppWorkerTestCase):
                                 error['message'][0])
 
 
+class SetupEnvCommandDispatcherTestCase(AppWorkerTestCase):
+    """Tests for a command dispatcher configured the way go_setup_env
+    configures it.
+    """
+
+    application_class = CommandDispatcher
+
+    @inlineCallbacks
+    def setUp(self):
+        super(SetupEnvCommandDispatcherTestCase, self).setUp()
+        self.api = yield self.get_application({
+            'worker_names': [
+                'bulk_message_application', 'keyword_router',
+                'routing_table_dispatcher'],
+        })
+
+    @inlineCallbacks
+    def test_forwarding_routing_table_invalidation(self):
+        vumi_api = yield VumiApi.from_config_async(
+            self.mk_config({}), get_fake_amq_client(self._amqp))
+        yield vumi_api.invalidate_routing_table(u'user-1')
+        yield self._amqp.kick_delivery()
+        [dispatched] = self._amqp.get_messages(
+            'vumi', 'routing_table_dispatcher.control')
+        self.assertEqual(dispatched['command'], 'invalidate_routing_table')
+        self.assertEqual(dispatched['kwargs'], {'user_account_key': u'user-1'})
+
+
 class ToyHandler(EventHandler):
     def setup_handler(self):
         self.handled_events = []
@@ -2,9 +2,13 @@
 
 """Tests for go.vumitools.app_worker."""
 
-from twisted.internet.defer import inlineCallbacks
+import json
 
-from go.vumitools.app_worker import GoApplicationWorker
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.trial.unittest import TestCase
+
+from go.vumitools.api import VumiApiCommand
+from go.vumitools.app_worker import GoApplicationWorker, OneShotMetricManager
 from go.vumitools.tests.utils import AppWorkerTestCase
 
 
@@ -34,6 +38,26 @@ class DummyApplication(GoApplicationWorker):
         self.events.append(event)
 
 
+class TestOneShotMetricManager(TestCase):
+    def test_observe(self):
+        metrics = OneShotMetricManager('prefix.')
+        for value in range(1, 101):
+            metrics.observe('latency', value)
+        for name in ['p50', 'p95', 'p99', 'max']:
+            self.assertTrue('latency.%s' % (name,) in metrics)
+        [(_, p95)] = metrics['latency.p95'].poll()
+        self.assertEqual(95, p95)
+        [(_, max_value)] = metrics['latency.max'].poll()
+        self.assertEqual(100, max_value)
+
+    def test_histograms_cleared(self):
+        metrics = OneShotMetricManager('prefix.')
+        metrics.observe('latency', 1)
+        metrics._clear_metrics()
+        self.assertFalse('latency.max' in metrics)
+        self.assertEqual({}, metrics._histograms)
+
+
 class TestGoApplicationWorker(AppWorkerTestCase):
 
     application_class = DummyApplication
@@ -88,3 +112,118 @@ class TestGoApplicationWorker(AppWorkerTestCase):
         self.assertTrue(self.conv.running())
         yield self.dispatch_event_to_conv(event, self.conv)
         self.assertEqual([event], self.app.events)
+
+    @inlineCallbacks
+    def test_conversation_cached(self):
+        conv = yield self.app.get_conversation(
+            self.user_account.key, self.conv.key)
+        cached_conv = yield self.app.get_conversation(
+            self.user_account.key, self.conv.key)
+        self.assertTrue(cached_conv is conv)
+        msg = self.mkmsg_in()
+        self.conv.set_go_helper_metadata(msg['helper_metadata'])
+        md_conv = yield self.app.get_metadata_helper(msg).get_conversation()
+        self.assertTrue(md_conv is conv)
+
+    @inlineCallbacks
+    def test_conversation_cache_cleared_by_config_changed(self):
+        conv = yield self.app.get_conversation(
+            self.user_account.key, self.conv.key)
+        yield self.dispatch_command(
+            'config_changed', user_account_key=self.user_account.key,
+            conversation_key=self.conv.key)
+        new_conv = yield self.app.get_conversation(
+            self.user_account.key, self.conv.key)
+        self.assertFalse(new_conv is conv)
+
+    @inlineCallbacks
+    def test_conversation_cache_cleared_by_start(self):
+        # Load the stopped conversation into the cache.
+        yield self.app.get_conversation(self.user_account.key, self.conv.key)
+        yield self.start_conversation(self.conv)
+        conv = yield self.app.get_conversation(
+            self.user_account.key, self.conv.key)
+        self.assertTrue(conv.running())
+
+    @inlineCallbacks
+    def test_event_index(self):
+        msg = self.mkmsg_out()
+        self.conv.set_go_helper_metadata(msg['helper_metadata'])
+        yield self.app.index_outbound_message(msg)
+        # The message must not need to be loaded.
+        self.patch(self.app, 'find_message_for_event', lambda event: None)
+        info = yield self.app.find_message_info_for_event(
+            self.mkmsg_ack(user_message_id=msg['message_id']))
+        self.assertEqual(info, {
+            'user_account_key': self.user_account.key,
+            'conversation_key': self.conv.key,
+            'batch_key': self.conv.batch.key,
+        })
+
+    @inlineCallbacks
+    def test_event_index_entry(self):
+        msg = self.mkmsg_out()
+        self.conv.set_go_helper_metadata(msg['helper_metadata'])
+        # The conversation must not need to be loaded.
+        self.patch(self.app, 'get_user_api', lambda account_key: None)
+        yield self.app.index_outbound_message(msg)
+        entry = yield self.app.event_index.get(msg['message_id'])
+        self.assertEqual(
+            json.loads(entry), [self.user_account.key, self.conv.key, None])
+        ttl = yield self.app.event_index.ttl(msg['message_id'])
+        self.assertTrue(0 < ttl <= self.app.event_index_ttl)
+
+    @inlineCallbacks
+    def test_publish_message_does_not_wait_for_event_index(self):
+        self.patch(self.app.event_index, 'setex', lambda *args: Deferred())
+        msg = self.mkmsg_out()
+        self.conv.set_go_helper_metadata(msg['helper_metadata'])
+        yield self.app._publish_message(msg)
+        [published] = yield self.get_dispatched_messages()
+        self.assertEqual(published['message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_event_index_missing(self):
+        msg = self.mkmsg_out()
+        self.conv.set_go_helper_metadata(msg['helper_metadata'])
+        yield self.store_outbound_msg(msg, self.conv)
+        info = yield self.app.find_message_info_for_event(
+            self.mkmsg_ack(user_message_id=msg['message_id']))
+        self.assertEqual(info, {
+            'user_account_key': self.user_account.key,
+            'conversation_key': self.conv.key,
+            'batch_key': self.conv.batch.key,
+        })
+
+    @inlineCallbacks
+    def test_control_commands_scheduled(self):
+        self.app.command_scheduler.max_concurrency = 1
+        self.app.command_scheduler.concurrency_limits = {}
+        blocker = Deferred()
+        self.app.process_command_slow = lambda: blocker
+        calls = []
+        self.app.process_command_fast = lambda: calls.append('fast')
+        self.app.consume_control_command(VumiApiCommand.command(
+            'worker', 'slow'))
+        self.app.consume_control_command(VumiApiCommand.command(
+            'worker', 'fast'))
+        self.assertEqual(calls, [])
+        self.assertEqual(self.app.command_scheduler.queued('fast'), 1)
+        # Lifecycle commands are not held up by other commands.
+        yield self.app.consume_control_command(VumiApiCommand.command(
+            'worker', 'config_changed', user_account_key=self.user_account.key,
+            conversation_key=self.conv.key))
+        blocker.callback(None)
+        self.assertEqual(calls, ['fast'])
+
+    @inlineCallbacks
+    def test_collect_metrics_bulk(self):
+        collected = []
+        self.app.collect_metrics = (
+            lambda user_api, conversation_key: collected.append(
+                (user_api.user_account_key, conversation_key)))
+        yield self.dispatch_command(
+            'collect_metrics_bulk',
+            conversations=[[self.user_account.key, self.conv.key]])
+        self.assertEqual(collected, [(self.user_account.key, self.conv.key)])
+        self.assertEqual(self.app._metrics_conversations, set())
@@ -0,0 +1,79 @@
+"""Tests for go.vumitools.cache."""
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from go.vumitools.cache import LRUCache, TTLCache
+
+
+class TestLRUCache(TestCase):
+    def test_get_missing(self):
+        cache = LRUCache(2)
+        self.assertEqual(None, cache.get('foo'))
+        self.assertEqual('bar', cache.get('foo', 'bar'))
+
+    def test_set_and_get(self):
+        cache = LRUCache(2)
+        cache.set('foo', 1)
+        self.assertEqual(1, cache.get('foo'))
+        self.assertTrue('foo' in cache)
+        self.assertEqual(1, len(cache))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_zero_size(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(0, len(cache))
+        self.assertEqual(None, cache.get('a'))
+
+    def test_delete(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('b')
+        self.assertEqual(None, cache.get('a'))
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+
+class TestTTLCache(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_set_and_get(self):
+        cache = TTLCache(2, 10, clock=self.clock)
+        cache.set('foo', 1)
+        self.assertEqual(1, cache.get('foo'))
+        self.assertTrue('foo' in cache)
+
+    def test_expiry(self):
+        cache = TTLCache(2, 10, clock=self.clock)
+        cache.set('foo', 1)
+        self.clock.advance(9)
+        self.assertEqual(1, cache.get('foo'))
+        self.clock.advance(1)
+        self.assertEqual(None, cache.get('foo'))
+        self.assertFalse('foo' in cache)
+        self.assertEqual(0, len(cache))
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(1, 10, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(2, cache.get('b'))
@@ -0,0 +1,104 @@
+"""Tests for go.vumitools.command_scheduler."""
+
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase
+
+from go.vumitools.command_scheduler import CommandScheduler
+
+
+class TestCommandScheduler(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.pending = []
+        self.metrics = []
+
+    def mk_scheduler(self, **kw):
+        kw.setdefault('publish_metric',
+                      lambda name, value: self.metrics.append((name, value)))
+        return CommandScheduler(**kw)
+
+    def command(self, name):
+        d = Deferred()
+        self.calls.append(name)
+        self.pending.append((name, d))
+        return d
+
+    def finish(self, name, result=None):
+        for i, (pending_name, d) in enumerate(self.pending):
+            if pending_name == name:
+                del self.pending[i]
+                d.callback(result)
+                return
+        self.fail("No pending %r command." % (name,))
+
+    def test_unbounded(self):
+        scheduler = self.mk_scheduler()
+        for i in range(5):
+            scheduler.schedule('foo', self.command, 'foo')
+        self.assertEqual(self.calls, ['foo'] * 5)
+        self.assertEqual(scheduler.queued(), 0)
+
+    def test_result(self):
+        scheduler = self.mk_scheduler()
+        d = scheduler.schedule('foo', lambda x: x * 2, 21)
+        self.assertEqual(self.successResultOf(d), 42)
+
+    def test_failure_frees_slot(self):
+        scheduler = self.mk_scheduler(max_concurrency=1)
+        d = scheduler.schedule('foo', lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        scheduler.schedule('foo', self.command, 'foo')
+        self.assertEqual(self.calls, ['foo'])
+
+    def test_max_concurrency(self):
+        scheduler = self.mk_scheduler(max_concurrency=2)
+        d1 = scheduler.schedule('foo', self.command, 'foo')
+        scheduler.schedule('bar', self.command, 'bar')
+        scheduler.schedule('baz', self.command, 'baz')
+        self.assertEqual(self.calls, ['foo', 'bar'])
+        self.assertEqual(scheduler.running(), 2)
+        self.assertEqual(scheduler.queued('baz'), 1)
+        self.finish('foo', 'done')
+        self.assertEqual(self.successResultOf(d1), 'done')
+        self.assertEqual(self.calls, ['foo', 'bar', 'baz'])
+        self.assertEqual(scheduler.queued(), 0)
+
+    def test_per_command_limit(self):
+        scheduler = self.mk_scheduler(
+            max_concurrency=10, concurrency_limits={'heavy': 1})
+        scheduler.schedule('heavy', self.command, 'heavy')
+        scheduler.schedule('heavy', self.command, 'heavy')
+        scheduler.schedule('light', self.command, 'light')
+        self.assertEqual(self.calls, ['heavy', 'light'])
+        self.finish('heavy')
+        self.assertEqual(self.calls, ['heavy', 'light', 'heavy'])
+
+    def test_priority_commands(self):
+        scheduler = self.mk_scheduler(
+            max_concurrency=1, priority_commands=['stop'])
+        scheduler.schedule('heavy', self.command, 'heavy')
+        scheduler.schedule('heavy', self.command, 'heavy')
+        scheduler.schedule('other', self.command, 'other')
+        # Priority commands don't wait for other commands.
+        scheduler.schedule('stop', self.command, 'stop')
+        self.assertEqual(self.calls, ['heavy', 'stop'])
+        self.finish('heavy')
+        self.assertEqual(self.calls, ['heavy', 'stop', 'heavy'])
+
+    def test_queue_depth_metrics(self):
+        scheduler = self.mk_scheduler(max_concurrency=1)
+        scheduler.schedule('foo', self.command, 'foo')
+        # Nothing is published while commands don't have to wait.
+        self.assertEqual(self.metrics, [])
+        scheduler.schedule('foo', self.command, 'foo')
+        self.assertEqual(self.metrics, [
+            ('command_queue.depth', 1),
+            ('command_queue.foo.depth', 1),
+        ])
+        self.finish('foo')
+        self.assertEqual(self.metrics[2:], [
+            ('command_queue.depth', 0),
+            ('command_queue.foo.depth', 0),
+        ])
+        self.finish('foo')
+        self.assertEqual(len(self.metrics), 4)
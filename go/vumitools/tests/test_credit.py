@@ -4,7 +4,7 @@ import uuid
 
 from twisted.internet.defer import inlineCallbacks
 
-from go.vumitools.credit import CreditManager
+from go.vumitools.credit import CreditManager, CreditLease
 from go.vumitools.tests.utils import GoTestCase
 
 
@@ -39,3 +39,89 @@ class TestCreditManager(GoTestCase):
         self.assertEqual((yield self.cm.get_credit(self.user_id)), 5)
         self.assertEqual((yield self.cm.debit(self.user_id, 5)), True)
         self.assertEqual((yield self.cm.get_credit(self.user_id)), 0)
+
+    @inlineCallbacks
+    def test_reserve(self):
+        yield self.cm.credit(self.user_id, 10)
+        self.assertEqual((yield self.cm.reserve(self.user_id, 4)), 4)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 6)
+        self.assertEqual((yield self.cm.reserve(self.user_id, 8, 2)), 2)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 4)
+        self.assertEqual((yield self.cm.reserve(self.user_id, 8, 5)), 0)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 4)
+
+
+class TestCreditLease(GoTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        super(TestCreditLease, self).setUp()
+        redis = yield self.get_redis_manager()
+        self.cm = CreditManager(redis)
+        self.lease = CreditLease(self.cm, 10)
+        self.user_id = uuid.uuid4().hex
+
+    @inlineCallbacks
+    def test_debit_reserves_block(self):
+        yield self.cm.credit(self.user_id, 25)
+        self.assertEqual((yield self.lease.debit(self.user_id, 1)), True)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 15)
+        self.assertEqual(self.lease.get_leased(self.user_id), 9)
+        for i in range(9):
+            self.assertEqual((yield self.lease.debit(self.user_id, 1)), True)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 15)
+        self.assertEqual((yield self.lease.debit(self.user_id, 1)), True)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 5)
+
+    @inlineCallbacks
+    def test_debit_partial_block(self):
+        yield self.cm.credit(self.user_id, 3)
+        self.assertEqual((yield self.lease.debit(self.user_id, 2)), True)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 1)
+        self.assertEqual(self.lease.get_leased(self.user_id), 0)
+
+    @inlineCallbacks
+    def test_debit_insufficient_credit(self):
+        self.assertEqual((yield self.lease.debit(self.user_id, 1)), False)
+        yield self.cm.credit(self.user_id, 1)
+        self.assertEqual((yield self.lease.debit(self.user_id, 2)), False)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 1)
+
+    @inlineCallbacks
+    def test_debit_low_balance(self):
+        yield self.cm.credit(self.user_id, 3)
+        self.assertEqual((yield self.lease.debit(self.user_id, 2)), True)
+        yield self.cm.credit(self.user_id, 20)
+        # Below the lease size, credits are debited directly.
+        self.assertEqual((yield self.lease.debit(self.user_id, 1)), True)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 20)
+        self.assertEqual(self.lease.get_leased(self.user_id), 0)
+        # That debit left enough credits to lease again.
+        self.assertEqual((yield self.lease.debit(self.user_id, 1)), True)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 10)
+        self.assertEqual(self.lease.get_leased(self.user_id), 9)
+
+    @inlineCallbacks
+    def test_release(self):
+        yield self.cm.credit(self.user_id, 25)
+        yield self.lease.debit(self.user_id, 3)
+        yield self.lease.release()
+        self.assertEqual(self.lease.get_leased(self.user_id), 0)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 22)
+
+    @inlineCallbacks
+    def test_release_failure(self):
+        yield self.cm.credit(self.user_id, 25)
+        yield self.lease.debit(self.user_id, 3)
+        credit = self.cm.credit
+
+        def broken_credit(user_account_key, amount):
+            self.cm.credit = credit
+            raise RuntimeError("Connection lost.")
+
+        self.cm.credit = broken_credit
+        yield self.assertFailure(self.lease.release(), RuntimeError)
+        self.assertEqual(self.lease.get_leased(self.user_id), 7)
+        yield self.lease.release()
+        self.assertEqual(self.lease.get_leased(self.user_id), 0)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 22)
@@ -0,0 +1,52 @@
+"""Tests for go.vumitools.histogram."""
+
+from twisted.trial.unittest import TestCase
+
+from vumi.blinkenlights.metrics import MetricManager
+
+from go.vumitools.histogram import Histogram, percentile
+
+
+class TestPercentile(TestCase):
+    def test_percentile(self):
+        values = range(100, 0, -1)
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual(7, percentile([7], 95))
+
+
+class TestHistogram(TestCase):
+    def setUp(self):
+        self.histogram = Histogram('latency')
+        self.metric_manager = MetricManager('prefix.')
+        for metric in self.histogram.metrics():
+            self.metric_manager.register(metric)
+
+    def poll(self, name):
+        return [value for _, value in self.metric_manager[name].poll()]
+
+    def test_metrics(self):
+        self.assertEqual(
+            ['p50', 'p95', 'p99', 'max'],
+            [metric.statistic for metric in self.histogram.metrics()])
+
+    def test_poll(self):
+        for value in range(1, 101):
+            self.histogram.add(value)
+        self.assertEqual([95], self.poll('latency.p95'))
+        self.assertEqual([100], self.poll('latency.max'))
+        self.assertEqual([50], self.poll('latency.p50'))
+        self.assertEqual([99], self.poll('latency.p99'))
+        self.assertEqual([], self.poll('latency.p50'))
+
+    def test_poll_without_samples(self):
+        self.assertEqual([], self.poll('latency.p50'))
+        self.assertEqual([], self.poll('latency.max'))
+
+    def test_samples_cleared_between_polls(self):
+        self.histogram.add(10)
+        for name in ['p50', 'p95', 'p99', 'max']:
+            self.poll('latency.%s' % (name,))
+        self.histogram.add(1)
+        self.assertEqual([1], self.poll('latency.max'))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for go.vumitools.keywords."""
+
+from twisted.trial.unittest import TestCase
+
+from go.vumitools.keywords import normalize_text, KeywordMatcher
+
+
+class TestNormalizeText(TestCase):
+    def test_empty(self):
+        self.assertEqual(normalize_text(None), u'')
+        self.assertEqual(normalize_text(''), u'')
+
+    def test_whitespace_and_case(self):
+        self.assertEqual(normalize_text(u'  Stop \t NOW\n'), u'stop now')
+        self.assertEqual(
+            normalize_text(u' Stop ', case_sensitive=True), u'Stop')
+
+    def test_accents(self):
+        self.assertEqual(normalize_text(u'ARRÊTER'), u'arreter')
+        self.assertEqual(normalize_text(u'ARRÊTER'.encode('utf-8')),
+                         u'arreter')
+
+
+class TestKeywordMatcher(TestCase):
+    def test_exact(self):
+        matcher = KeywordMatcher([u'STOP', u'Arrêter'])
+        self.assertEqual(matcher.match(u' stop '), u'stop')
+        self.assertEqual(matcher.match(u'ARRETER'), u'arreter')
+        self.assertEqual(matcher.match(u'stop please'), None)
+        self.assertEqual(matcher.match(u''), None)
+
+    def test_case_sensitive(self):
+        matcher = KeywordMatcher([u'STOP'], case_sensitive=True)
+        self.assertEqual(matcher.match(u'STOP'), u'STOP')
+        self.assertEqual(matcher.match(u'stop'), None)
+
+    def test_first_token(self):
+        matcher = KeywordMatcher([u'stop'], KeywordMatcher.FIRST_TOKEN)
+        self.assertEqual(matcher.match(u'STOP please'), u'stop')
+        self.assertEqual(matcher.match(u'Stop!'), u'stop')
+        self.assertEqual(matcher.match(u'stopping'), None)
+        self.assertEqual(matcher.match(u'please stop'), None)
+
+    def test_prefix(self):
+        matcher = KeywordMatcher(
+            [u'stop', u'stop all'], KeywordMatcher.PREFIX)
+        self.assertEqual(matcher.match(u'STOP please'), u'stop')
+        self.assertEqual(matcher.match(u'stop all, thanks'), u'stop all')
+        self.assertEqual(matcher.match(u'stop'), u'stop')
+        self.assertEqual(matcher.match(u'stopping'), None)
+
+    def test_prefix_no_keywords(self):
+        matcher = KeywordMatcher([], KeywordMatcher.PREFIX)
+        self.assertEqual(matcher.match(u'stop'), None)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, KeywordMatcher, [u'stop'], 'fuzzy')
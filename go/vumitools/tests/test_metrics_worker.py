@@ -14,6 +14,7 @@ class GoMetricsWorkerTestCase(GoWorkerTestCase):
         super(GoMetricsWorkerTestCase, self).setUp()
         self.clock = Clock()
         self.patch(metrics_worker, 'LoopingCall', self.looping_call)
+        self.patch(metrics_worker, 'reactor', self.clock)
 
     def get_metrics_worker(self, config=None, start=True):
         if config is None:
@@ -73,39 +74,41 @@ class GoMetricsWorkerTestCase(GoWorkerTestCase):
         self.assertEqual(sorted([acc1.key, acc2.key]), sorted(account_keys))
 
     @inlineCallbacks
-    def test_find_conversations_for_account(self):
+    def test_send_metrics_command(self):
         worker = yield self.get_metrics_worker()
         acc1 = yield self.make_account(worker, u'acc1')
         akey = acc1.key
         user_api = worker.vumi_api.get_user_api(akey)
 
         conv1 = yield self.make_conv(user_api, u'conv1')
-        yield self.archive_conv(conv1)
-        conv2 = yield self.make_conv(user_api, u'conv2')
-        yield self.start_conv(conv2)
-        yield self.make_conv(user_api, u'conv3')
+        yield self.start_conv(conv1)
 
-        conversations = yield worker.find_conversations_for_account(akey)
-        self.assertEqual([c.key for c in conversations], [conv2.key])
+        yield worker.send_metrics_command(conv1)
+        [cmd] = self._get_dispatched('vumi.api')
+        self.assertEqual(cmd.payload['kwargs']['conversation_key'], conv1.key)
+        self.assertEqual(cmd.payload['kwargs']['user_account_key'], akey)
 
     @inlineCallbacks
-    def test_send_metrics_command(self):
+    def test_send_bulk_metrics_command(self):
         worker = yield self.get_metrics_worker()
         acc1 = yield self.make_account(worker, u'acc1')
         akey = acc1.key
         user_api = worker.vumi_api.get_user_api(akey)
 
         conv1 = yield self.make_conv(user_api, u'conv1')
-        yield self.start_conv(conv1)
+        conv2 = yield self.make_conv(user_api, u'conv2')
 
-        yield worker.send_metrics_command(conv1)
+        yield worker.send_bulk_metrics_command(
+            u'my_conv', [[akey, conv1.key], [akey, conv2.key]])
         [cmd] = self._get_dispatched('vumi.api')
-        self.assertEqual(cmd.payload['kwargs']['conversation_key'], conv1.key)
-        self.assertEqual(cmd.payload['kwargs']['user_account_key'], akey)
+        self.assertEqual(cmd.payload['command'], 'collect_metrics_bulk')
+        self.assertEqual(cmd.payload['kwargs']['conversations'],
+                         [[akey, conv1.key], [akey, conv2.key]])
 
     @inlineCallbacks
     def test_metrics_loop_func(self):
-        worker = yield self.get_metrics_worker()
+        worker = yield self.get_metrics_worker({
+            'metrics_bulk_size': 0, 'metrics_spread': 0})
         acc1 = yield self.make_account(worker, u'acc1')
         acc2 = yield self.make_account(worker, u'acc2')
         yield worker.redis.sadd('metrics_accounts', acc1.key)
@@ -128,3 +131,109 @@ class GoMetricsWorkerTestCase(GoWorkerTestCase):
         conv_keys = [c.payload['kwargs']['conversation_key'] for c in cmds]
         self.assertEqual(sorted(conv_keys),
                          sorted(c.key for c in [conv1, conv2, conv3, conv4]))
+
+    @inlineCallbacks
+    def test_metrics_loop_func_bulk(self):
+        worker = yield self.get_metrics_worker({
+            'metrics_bulk_size': 2, 'metrics_spread': 0})
+        acc1 = yield self.make_account(worker, u'acc1')
+        yield worker.redis.sadd('metrics_accounts', acc1.key)
+        user_api = worker.vumi_api.get_user_api(acc1.key)
+
+        convs = []
+        for name, conv_type in [(u'conv1', u'type_a'), (u'conv2', u'type_a'),
+                                (u'conv3', u'type_a'), (u'conv4', u'type_b')]:
+            conv = yield self.make_conv(user_api, name, conv_type)
+            yield self.start_conv(conv)
+            convs.append(conv)
+
+        yield worker.metrics_loop_func()
+
+        cmds = self._get_dispatched('vumi.api')
+        self.assertEqual(
+            [(c.payload['worker_name'], c.payload['command']) for c in cmds],
+            [('type_a', 'collect_metrics_bulk'),
+             ('type_a', 'collect_metrics_bulk'),
+             ('type_b', 'collect_metrics_bulk')])
+        conv_keys = [key for c in cmds
+                     for _, key in c.payload['kwargs']['conversations']]
+        self.assertEqual(sorted(conv_keys), sorted(c.key for c in convs))
+
+    @inlineCallbacks
+    def test_find_running_conversation_keys(self):
+        worker = yield self.get_metrics_worker()
+        acc1 = yield self.make_account(worker, u'acc1')
+        user_api = worker.vumi_api.get_user_api(acc1.key)
+        conv1 = yield self.make_conv(user_api, u'conv1')
+        yield self.start_conv(conv1)
+        yield self.make_conv(user_api, u'conv2')
+
+        convs = yield worker.find_running_conversation_keys(acc1.key)
+        self.assertEqual(convs, [(u'my_conv', conv1.key)])
+
+        # Conversations we've seen before aren't loaded again.
+        loaded = []
+        self.patch(user_api.conversation_store.__class__, 'load_all_bunches',
+                   lambda store, keys: loaded.extend(keys) or [])
+        convs = yield worker.find_running_conversation_keys(acc1.key)
+        self.assertEqual(convs, [(u'my_conv', conv1.key)])
+        self.assertEqual(loaded, [])
+
+    @inlineCallbacks
+    def test_metrics_loop_func_shards(self):
+        workers = []
+        for shard in range(2):
+            worker = yield self.get_metrics_worker({
+                'metrics_spread': 0,
+                'metrics_shard_count': 2,
+                'metrics_shard_index': shard,
+            })
+            workers.append(worker)
+        processed = []
+        account_keys = [u'acc%s' % (i,) for i in range(10)]
+        for shard, worker in enumerate(workers):
+            worker.find_account_keys = lambda: account_keys
+            worker.process_account = (
+                lambda account_key, shard=shard: processed.append(
+                    (shard, account_key)) or 0)
+            yield worker.metrics_loop_func()
+
+        # Each account is processed by exactly one worker.
+        self.assertEqual(sorted(key for _, key in processed), account_keys)
+        self.assertEqual(set(shard for shard, _ in processed), set([0, 1]))
+
+    @inlineCallbacks
+    def test_metrics_loop_func_spread(self):
+        worker = yield self.get_metrics_worker({'metrics_spread': 0.5})
+        processed = []
+        account_keys = [u'acc%s' % (i,) for i in range(10)]
+        worker.find_account_keys = lambda: account_keys
+        worker.process_account = lambda key: processed.append(key) or 0
+        delays = [worker.account_delay(key) for key in account_keys]
+        self.assertTrue(all(0 <= delay < 150 for delay in delays))
+        self.assertTrue(len(set(delays)) > 1)
+
+        d = worker.metrics_loop_func()
+        self.clock.advance(min(delays))
+        self.assertTrue(0 < len(processed) < len(account_keys))
+        self.clock.advance(150)
+        yield d
+        self.assertEqual(sorted(processed), sorted(account_keys))
+
+    @inlineCallbacks
+    def test_cancel_scheduled_accounts(self):
+        worker = yield self.get_metrics_worker({'metrics_spread': 0.5})
+        processed = []
+        account_keys = [u'acc%s' % (i,) for i in range(10)]
+        worker.find_account_keys = lambda: account_keys
+        worker.process_account = lambda key: processed.append(key) or 0
+        delays = [worker.account_delay(key) for key in account_keys]
+
+        d = worker.metrics_loop_func()
+        self.clock.advance(min(delays))
+        processed_count = len(processed)
+        self.assertTrue(processed_count < len(account_keys))
+        worker.cancel_scheduled_accounts()
+        yield d
+        self.clock.advance(150)
+        self.assertEqual(processed_count, len(processed))
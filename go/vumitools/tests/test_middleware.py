@@ -1,7 +1,8 @@
 """Tests for go.vumitools.middleware"""
 import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, Deferred)
 
 from vumi.message import TransportUserMessage
 from vumi.application.tests.test_base import DummyApplicationWorker
@@ -11,7 +12,8 @@ from vumi.middleware.tagger import TaggingMiddleware
 from go.vumitools.tests.utils import AppWorkerTestCase, GoRouterWorkerTestMixin
 from go.vumitools.middleware import (NormalizeMsisdnMiddleware,
     OptOutMiddleware, MetricsMiddleware, ConversationStoringMiddleware,
-    RouterStoringMiddleware)
+    RouterStoringMiddleware, DebitAccountMiddleware, NoUserError,
+    NoTagError, BadTagPool, InsufficientCredit)
 
 
 class MiddlewareTestCase(AppWorkerTestCase):
@@ -165,6 +167,113 @@ class OptOutMiddlewareTestCase(MiddlewareTestCase):
             }
         })
 
+    @inlineCallbacks
+    def test_first_token_mode(self):
+        config = dict(self.config, optout_match_mode='first_token')
+        mw = yield self.create_middleware(OptOutMiddleware, config=config)
+        yield mw.vumi_api.tpm.declare_tags([("pool", "tag1")])
+        yield self.send_keyword(mw, 'Stop please!', {
+            'optout': {
+                'optout': True,
+                'optout_keyword': 'stop',
+            }
+        })
+
+    @inlineCallbacks
+    def test_tagpool_keywords(self):
+        yield self.mw.vumi_api.tpm.set_metadata("pool", {
+                "transport_type": "other",
+                "msg_options": {"transport_name": "other_transport"},
+                "disable_global_opt_out": True,
+                "optout_keywords": [u"ARR\xcaTER"],
+                })
+        yield self.send_keyword(self.mw, u'arr\xeater', {
+            'optout': {
+                'optout': True,
+                'optout_keyword': u'arreter',
+            }
+        })
+        yield self.send_keyword(self.mw, 'STOP', {
+            'optout': {
+                'optout': False,
+            }
+        })
+
+
+class DebitAccountMiddlewareTestCase(MiddlewareTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(DebitAccountMiddlewareTestCase, self).setUp()
+        self.mw = yield self.get_debit_middleware()
+        yield self.mw.tpm.declare_tags([("pool", "tag1")])
+        yield self.mw.tpm.set_metadata("pool", {"credits_per_message": 2})
+
+    @inlineCallbacks
+    def get_debit_middleware(self, **config):
+        mw_config = self.default_config.copy()
+        mw_config.update(config)
+        mw = yield self.create_middleware(
+            DebitAccountMiddleware, config=mw_config)
+        self._middlewares.append(mw)
+        returnValue(mw)
+
+    def mk_outbound(self, user_account_key='user1', tag=("pool", "tag1")):
+        msg = self.mk_msg()
+        if tag is not None:
+            TaggingMiddleware.add_tag_to_msg(msg, tag)
+        if user_account_key is not None:
+            DebitAccountMiddleware.add_user_to_message(msg, user_account_key)
+        return msg
+
+    def get_credit(self, mw, user_account_key='user1'):
+        cm = getattr(mw.cm, 'cm', mw.cm)
+        return cm.get_credit(user_account_key)
+
+    @inlineCallbacks
+    def test_debit(self):
+        yield self.mw.cm.credit('user1', 5)
+        msg = self.mk_outbound()
+        result = yield self.mw.handle_outbound(msg, 'default')
+        self.assertEqual(result, msg)
+        self.assertEqual((yield self.get_credit(self.mw)), 3)
+
+    @inlineCallbacks
+    def test_insufficient_credit(self):
+        yield self.mw.cm.credit('user1', 1)
+        yield self.assertFailure(
+            self.mw.handle_outbound(self.mk_outbound(), 'default'),
+            InsufficientCredit)
+        self.assertEqual((yield self.get_credit(self.mw)), 1)
+
+    def test_no_user(self):
+        return self.assertFailure(
+            self.mw.handle_outbound(
+                self.mk_outbound(user_account_key=None), 'default'),
+            NoUserError)
+
+    def test_no_tag(self):
+        return self.assertFailure(
+            self.mw.handle_outbound(self.mk_outbound(tag=None), 'default'),
+            NoTagError)
+
+    @inlineCallbacks
+    def test_bad_tag_pool(self):
+        yield self.mw.tpm.set_metadata("pool", {})
+        yield self.assertFailure(
+            self.mw.handle_outbound(self.mk_outbound(), 'default'),
+            BadTagPool)
+
+    @inlineCallbacks
+    def test_lease(self):
+        mw = yield self.get_debit_middleware(credit_manager={'lease_size': 10})
+        yield mw.cm.cm.credit('user1', 15)
+        yield mw.handle_outbound(self.mk_outbound(), 'default')
+        self.assertEqual((yield self.get_credit(mw)), 5)
+        self.assertEqual(mw.cm.get_leased('user1'), 8)
+        yield mw.cm.release()
+        self.assertEqual((yield self.get_credit(mw)), 13)
+
 
 class MetricsMiddlewareTestCase(MiddlewareTestCase):
 
@@ -220,14 +329,33 @@ class MetricsMiddlewareTestCase(MiddlewareTestCase):
         [metric] = mw.metric_manager['dummy_endpoint.outbound.counter'].poll()
         self.assertEqual(metric[1], 1)
 
+    @inlineCallbacks
+    def test_counts_aggregated_locally(self):
+        mw = yield self.get_middleware({'op_mode': 'passive'})
+        for i in range(3):
+            yield mw.handle_inbound(self.mk_msg(), 'dummy_endpoint')
+        counter = mw.metric_manager['dummy_endpoint.inbound.counter']
+        [(_, count)] = counter.poll()
+        self.assertEqual(count, 3)
+        self.assertEqual(counter.poll(), [])
+
+    @inlineCallbacks
+    def test_counter_handles_cached(self):
+        mw = yield self.get_middleware({'op_mode': 'passive'})
+        counter = mw.get_counter('dummy_endpoint', 'event', 'ack')
+        self.assertTrue(
+            counter is mw.get_counter('dummy_endpoint', 'event', 'ack'))
+        self.assertTrue(
+            counter is mw.metric_manager['dummy_endpoint.event.ack.counter'])
+
     @inlineCallbacks
     def test_active_response_time_inbound(self):
         mw = yield self.get_middleware({'op_mode': 'active'})
         msg = self.mk_msg(transport_name='endpoint_0')
         yield mw.handle_inbound(msg, 'dummy_endpoint')
         key = mw.key('endpoint_0', msg['message_id'])
-        timestamp = yield mw.redis.get(key)
-        self.assertTrue(timestamp)
+        self.assertTrue(mw.inbound_timestamps.get(key))
+        self.assertEqual(mw.redis, None)
 
     @inlineCallbacks
     def test_passive_response_time_inbound(self):
@@ -235,8 +363,25 @@ class MetricsMiddlewareTestCase(MiddlewareTestCase):
         msg = self.mk_msg(transport_name='endpoint_0')
         yield mw.handle_inbound(msg, 'dummy_endpoint')
         key = mw.key('dummy_endpoint', msg['message_id'])
+        self.assertTrue(mw.inbound_timestamps.get(key))
+
+    @inlineCallbacks
+    def test_shared_response_time_inbound(self):
+        mw = yield self.get_middleware({'shared_timestamp_ttl': 60})
+        msg = self.mk_msg(transport_name='endpoint_0')
+        yield mw.handle_inbound(msg, 'dummy_endpoint')
+        key = mw.key('dummy_endpoint', msg['message_id'])
         timestamp = yield mw.redis.get(key)
-        self.assertTrue(timestamp)
+        self.assertEqual(float(timestamp), mw.inbound_timestamps.get(key))
+        ttl = yield mw.redis.ttl(key)
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_inbound_timestamps_bounded(self):
+        mw = yield self.get_middleware({'max_inbound_timestamps': 2})
+        for i in range(3):
+            yield mw.handle_inbound(self.mk_msg(), 'dummy_endpoint')
+        self.assertEqual(len(mw.inbound_timestamps), 2)
 
     @inlineCallbacks
     def test_active_response_time_comparison_on_outbound(self):
@@ -245,13 +390,16 @@ class MetricsMiddlewareTestCase(MiddlewareTestCase):
         key = mw.key('endpoint_0', inbound_msg['message_id'])
         # Fake it to be 10 seconds in the past
         timestamp = time.time() - 10
-        yield mw.redis.set(key, repr(timestamp))
+        mw.inbound_timestamps.set(key, timestamp)
         outbound_msg = self.mk_msg(transport_name='endpoint_0',
             in_reply_to=inbound_msg['message_id'])
         yield mw.handle_outbound(outbound_msg, 'dummy_endpoint')
         [timer_metric] = mw.metric_manager['endpoint_0.timer'].poll()
         [timestamp, value] = timer_metric
         self.assertTrue(value > 10)
+        [(_, p50)] = mw.metric_manager['endpoint_0.timer.p50'].poll()
+        self.assertEqual(p50, value)
+        self.assertEqual(mw.inbound_timestamps.get(key), None)
 
     @inlineCallbacks
     def test_passive_response_time_comparison_on_outbound(self):
@@ -260,6 +408,21 @@ class MetricsMiddlewareTestCase(MiddlewareTestCase):
         key = mw.key('dummy_endpoint', inbound_msg['message_id'])
         # Fake it to be 10 seconds in the past
         timestamp = time.time() - 10
+        mw.inbound_timestamps.set(key, timestamp)
+        outbound_msg = self.mk_msg(transport_name='endpoint_0',
+            in_reply_to=inbound_msg['message_id'])
+        yield mw.handle_outbound(outbound_msg, 'dummy_endpoint')
+        [timer_metric] = mw.metric_manager['dummy_endpoint.timer'].poll()
+        [timestamp, value] = timer_metric
+        self.assertTrue(value > 10)
+
+    @inlineCallbacks
+    def test_shared_response_time_comparison_on_outbound(self):
+        mw = yield self.get_middleware({'shared_timestamp_ttl': 60})
+        inbound_msg = self.mk_msg(transport_name='endpoint_0')
+        key = mw.key('dummy_endpoint', inbound_msg['message_id'])
+        # Fake it to be 10 seconds in the past and only known to Redis
+        timestamp = time.time() - 10
         yield mw.redis.set(key, repr(timestamp))
         outbound_msg = self.mk_msg(transport_name='endpoint_0',
             in_reply_to=inbound_msg['message_id'])
@@ -343,6 +506,78 @@ class ConversationStoringMiddlewareTestCase(MiddlewareTestCase):
         msg_ids = yield self.vumi_api.mdb.batch_outbound_keys(batch_id)
         self.assertEqual(msg_ids, [msg['message_id']])
 
+    def use_write_behind(self, queue_size=1000, parallelism=10):
+        self.mw.write_behind = True
+        self.mw.write_behind_queue_size = queue_size
+        self.mw.write_behind_parallelism = parallelism
+        paused = []
+        self.patch(self.mw.worker, 'pause_connectors',
+                   lambda: paused.append(True))
+        self.patch(self.mw.worker, 'unpause_connectors',
+                   lambda: paused.remove(True))
+        return paused
+
+    def delay_inbound_writes(self):
+        """Hold back inbound message writes until the returned deferred
+        fires."""
+        release = Deferred()
+        add_inbound_message = self.mw.store.add_inbound_message
+
+        def delayed_add(msg, batch_id=None):
+            d = Deferred()
+            release.addCallback(
+                lambda _: add_inbound_message(msg, batch_id=batch_id))
+            release.addCallback(d.callback)
+            return d
+
+        self.patch(self.mw.store, 'add_inbound_message', delayed_add)
+        return release
+
+    @inlineCallbacks
+    def test_write_behind(self):
+        self.use_write_behind()
+        release = self.delay_inbound_writes()
+        msg = self.mkmsg_in()
+        self.add_conversation_md_to_msg(msg, self.conv)
+        result = yield self.mw.handle_inbound(msg, 'default')
+        self.assertEqual(result, msg)
+        batch_id = self.conv.batch.key
+        msg_ids = yield self.vumi_api.mdb.batch_inbound_keys(batch_id)
+        self.assertEqual(msg_ids, [])
+        flushed = self.mw.flush()
+        release.callback(None)
+        yield flushed
+        msg_ids = yield self.vumi_api.mdb.batch_inbound_keys(batch_id)
+        self.assertEqual(msg_ids, [msg['message_id']])
+
+    @inlineCallbacks
+    def test_write_behind_pauses_when_full(self):
+        paused = self.use_write_behind(queue_size=1, parallelism=1)
+        release = self.delay_inbound_writes()
+        msgs = [self.mkmsg_in() for _ in range(2)]
+        for msg in msgs:
+            self.add_conversation_md_to_msg(msg, self.conv)
+        yield self.mw.handle_inbound(msgs[0], 'default')
+        self.assertEqual(paused, [])
+        yield self.mw.handle_inbound(msgs[1], 'default')
+        self.assertEqual(paused, [True])
+        release.callback(None)
+        yield self.mw.flush()
+        self.assertEqual(paused, [])
+        msg_ids = yield self.vumi_api.mdb.batch_inbound_keys(
+            self.conv.batch.key)
+        self.assertEqual(
+            sorted(msg_ids), sorted(msg['message_id'] for msg in msgs))
+
+    @inlineCallbacks
+    def test_batch_key_cached(self):
+        msg = self.mkmsg_in()
+        self.add_conversation_md_to_msg(msg, self.conv)
+        yield self.mw.handle_inbound(msg, 'default')
+        self.assertEqual(self.vumi_api.batch_key_cache.get(
+            ('conversation', self.conv.user_account.key, self.conv.key)),
+            self.conv.batch.key)
+
 
 class RouterStoringMiddlewareTestCase(MiddlewareTestCase,
                                       GoRouterWorkerTestMixin):
@@ -0,0 +1,36 @@
+"""Tests for go.vumitools.outbound_hops."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from go.vumitools.outbound_hops import OutboundHopsManager
+from go.vumitools.tests.utils import GoTestCase
+
+
+class TestOutboundHopsManager(GoTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        super(TestOutboundHopsManager, self).setUp()
+        self.redis = yield self.get_redis_manager()
+        self.ohm = OutboundHopsManager(self.redis)
+
+    @inlineCallbacks
+    def test_get_outbound_hops_missing(self):
+        self.assertEqual((yield self.ohm.get_outbound_hops("msg-1")), None)
+
+    @inlineCallbacks
+    def test_set_outbound_hops(self):
+        hops = [
+            [['CONVERSATION:app1:conv1', 'default'],
+             ['TRANSPORT_TAG:pool1:1234', 'default']],
+        ]
+        yield self.ohm.set_outbound_hops(
+            "msg-1", hops, ("pool1", "1234"), "user-1", 3600)
+        record = yield self.ohm.get_outbound_hops("msg-1")
+        self.assertEqual(record, {
+            'hops': hops,
+            'tag': ['pool1', '1234'],
+            'user_account': 'user-1',
+        })
+        ttl = yield self.redis.ttl("hops:msg-1")
+        self.assertTrue(0 < ttl <= 3600)
@@ -1,7 +1,9 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 
 from go.vumitools.routing import (
-    AccountRoutingTableDispatcher, RoutingMetadata, RoutingError)
+    AccountRoutingTableDispatcher, RoutingMetadata, RoutingError,
+    AccountShardRing, ShardMessage)
 from go.vumitools.tests.utils import GoTestCase, AppWorkerTestCase
 from go.vumitools.utils import MessageMetadataHelper
 
@@ -52,6 +54,69 @@ class TestRoutingMetadata(GoTestCase):
             [['sc1', 'se1'], ['dc1', 'de1']],
         ], rmeta.get_outbound_hops())
 
+    def test_stamp_hop(self):
+        msg, rmeta = self.mk_msg_rmeta()
+        rmeta.stamp_hop(1.0)
+        self.assertEqual(None, rmeta.get_hop_times())
+        rmeta.push_source('sc1', 'se1')
+        rmeta.stamp_hop(1.0)
+        rmeta.push_destination('dc1', 'de1')
+        rmeta.stamp_hop(2.0)
+        self.assertEqual([[1.0, 2.0]], rmeta.get_hop_times())
+
+    def test_stamp_hop_unstamped_hops(self):
+        msg, rmeta = self.mk_msg_rmeta()
+        self.set_hops(msg, [
+            [['sc1', 'se1'], ['dc1', 'de1']],
+            [['sc2', 'se2'], ['dc2', 'de2']],
+        ])
+        rmeta.stamp_hop(3.0)
+        self.assertEqual([[], [3.0]], rmeta.get_hop_times())
+
+    def test_compact(self):
+        msg, rmeta = self.mk_msg_rmeta()
+        hops = [
+            [['CONVERSATION:app1:conv1', 'default'],
+             ['ROUTER:router:router1:OUTBOUND', 'default']],
+            [['ROUTER:router:router1:INBOUND', 'default'],
+             ['TRANSPORT_TAG:pool1:1234', 'default']],
+        ]
+        self.set_hops(msg, [hop[:] for hop in hops])
+        self.set_outbound_hops(msg, [hop[:] for hop in hops])
+        rmeta.compact()
+        self.assertEqual(msg['routing_metadata'], {
+            'go_connectors': [
+                'CONVERSATION:app1:conv1', 'ROUTER:router:router1:OUTBOUND',
+                'ROUTER:router:router1:INBOUND', 'TRANSPORT_TAG:pool1:1234',
+            ],
+            'go_hops': [
+                [[0, 'default'], [1, 'default']],
+                [[2, 'default'], [3, 'default']],
+            ],
+            'go_outbound_hops': [
+                [[0, 'default'], [1, 'default']],
+                [[2, 'default'], [3, 'default']],
+            ],
+        })
+        rmeta = RoutingMetadata(msg)
+        self.assertEqual(hops, rmeta.get_hops())
+        self.assertEqual(hops, rmeta.get_outbound_hops())
+        self.assertFalse('go_connectors' in msg['routing_metadata'])
+
+    def test_compact_incomplete_hop(self):
+        msg, rmeta = self.mk_msg_rmeta()
+        rmeta.push_source('sc1', 'se1')
+        rmeta.compact()
+        self.assertEqual([[[0, 'se1'], None]],
+                         msg['routing_metadata']['go_hops'])
+        self.assertEqual([[['sc1', 'se1'], None]],
+                         RoutingMetadata(msg).get_hops())
+
+    def test_compact_without_hops(self):
+        msg, rmeta = self.mk_msg_rmeta()
+        rmeta.compact()
+        self.assertEqual({}, msg['routing_metadata'])
+
     def test_set_outbound_hops(self):
         msg, rmeta = self.mk_msg_rmeta()
         self.assert_outbound_hops(msg, None)
@@ -208,6 +273,27 @@ class TestRoutingMetadata(GoTestCase):
         ], 'se2')
 
 
+class TestAccountShardRing(GoTestCase):
+    def test_shard_for_is_stable(self):
+        ring = AccountShardRing(4)
+        shard = ring.shard_for(u'account-1')
+        self.assertTrue(0 <= shard < 4)
+        self.assertEqual(shard, AccountShardRing(4).shard_for('account-1'))
+
+    def test_all_shards_used(self):
+        ring = AccountShardRing(4)
+        shards = set(ring.shard_for('account-%s' % i) for i in range(200))
+        self.assertEqual(shards, set(range(4)))
+
+    def test_adding_shard_moves_few_accounts(self):
+        keys = ['account-%s' % i for i in range(1000)]
+        ring4, ring5 = AccountShardRing(4), AccountShardRing(5)
+        moved = [k for k in keys if ring4.shard_for(k) != ring5.shard_for(k)]
+        # Ideally one fifth of the accounts move to the new shard.
+        self.assertTrue(len(moved) < 400)
+        self.assertEqual(set(ring5.shard_for(k) for k in moved), set([4]))
+
+
 class TestRoutingTableDispatcher(AppWorkerTestCase):
     @inlineCallbacks
     def setUp(self):
@@ -564,3 +650,254 @@ class TestRoutingTableDispatcher(AppWorkerTestCase):
             ['TRANSPORT_TAG:pool1:1234', 'default'],
         ])
         self.assertEqual([msg], self.get_dispatched_outbound('sphex'))
+
+    @inlineCallbacks
+    def test_routing_table_is_cached(self):
+        yield self.get_dispatcher()
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(1, len(self.get_dispatched_inbound('app1')))
+
+        user_account = yield self.user_api.get_user_account()
+        user_account.routing_table["TRANSPORT_TAG:pool1:1234"] = {
+            "default": ["CONVERSATION:app2:conv2", "default"]}
+        yield user_account.save()
+
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(2, len(self.get_dispatched_inbound('app1')))
+        self.assertEqual([], self.get_dispatched_inbound('app2'))
+
+    @inlineCallbacks
+    def test_invalidate_routing_table(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(1, len(self.get_dispatched_inbound('app1')))
+
+        user_account = yield self.user_api.get_user_account()
+        user_account.routing_table["TRANSPORT_TAG:pool1:1234"] = {
+            "default": ["CONVERSATION:app2:conv2", "default"]}
+        yield user_account.save()
+        dispatcher.process_command_invalidate_routing_table(
+            self.user_account_key)
+
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(1, len(self.get_dispatched_inbound('app1')))
+        self.assertEqual(1, len(self.get_dispatched_inbound('app2')))
+
+    @inlineCallbacks
+    def test_invalidate_all_routing_tables(self):
+        dispatcher = yield self.get_dispatcher()
+        yield dispatcher.get_routing_table(self.user_account_key)
+        self.assertEqual(1, len(dispatcher._routing_table_cache))
+        dispatcher.process_command_invalidate_routing_table()
+        self.assertEqual(0, len(dispatcher._routing_table_cache))
+
+    @inlineCallbacks
+    def test_routing_table_helper_cached(self):
+        dispatcher = yield self.get_dispatcher()
+        rt_helper = yield dispatcher.get_routing_table_helper(
+            self.user_account_key)
+        compiled = rt_helper.compiled
+        cached_helper = yield dispatcher.get_routing_table_helper(
+            self.user_account_key)
+        self.assertIdentical(cached_helper, rt_helper)
+        self.assertIdentical(cached_helper.compiled, compiled)
+        routing_table = yield dispatcher.get_routing_table(
+            self.user_account_key)
+        self.assertIdentical(routing_table, rt_helper.routing_table)
+
+    @inlineCallbacks
+    def test_routing_table_cache_expires(self):
+        dispatcher = yield self.get_dispatcher()
+        clock = Clock()
+        dispatcher._routing_table_cache.clock = clock
+        yield dispatcher.get_routing_table(self.user_account_key)
+        self.assertTrue(
+            self.user_account_key in dispatcher._routing_table_cache)
+        clock.advance(dispatcher.get_static_config().routing_table_cache_ttl)
+        self.assertFalse(
+            self.user_account_key in dispatcher._routing_table_cache)
+
+    @inlineCallbacks
+    def test_tag_owner_from_index(self):
+        dispatcher = yield self.get_dispatcher()
+        owner = yield dispatcher.get_tag_owner(("pool1", "1234"))
+        self.assertEqual(owner, self.user_account_key)
+
+    @inlineCallbacks
+    def test_tag_owner_missing_from_index(self):
+        dispatcher = yield self.get_dispatcher()
+        tag = ("pool1", "1234")
+        yield self.vumi_api.tag_owners.clear_owner(tag)
+        owner = yield dispatcher.get_tag_owner(tag)
+        self.assertEqual(owner, self.user_account_key)
+        # The owner isn't added to the index, but is cached for a while.
+        self.assertEqual((yield self.vumi_api.tag_owners.get_owner(tag)),
+                         None)
+        self.assertEqual(
+            dispatcher._fallback_tag_owners.get(tag), self.user_account_key)
+
+    @inlineCallbacks
+    def test_tag_owner_missing_from_index_expires(self):
+        dispatcher = yield self.get_dispatcher()
+        clock = Clock()
+        dispatcher._fallback_tag_owners.clock = clock
+        tag = ("pool1", "1234")
+        yield self.vumi_api.tag_owners.clear_owner(tag)
+        yield dispatcher.get_tag_owner(tag)
+        # Another process gives the tag to a different account without
+        # updating the index.
+        tag_info = yield self.vumi_api.mdb.get_tag_info(tag)
+        tag_info.metadata['user_account'] = u'other-account'
+        yield tag_info.save()
+        owner = yield dispatcher.get_tag_owner(tag)
+        self.assertEqual(owner, self.user_account_key)
+        clock.advance(dispatcher.get_static_config().routing_table_cache_ttl)
+        owner = yield dispatcher.get_tag_owner(tag)
+        self.assertEqual(owner, u'other-account')
+
+    @inlineCallbacks
+    def test_outbound_message_to_transport_stores_hops(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(self.mkmsg_out(), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        record = yield dispatcher.outbound_hops.get_outbound_hops(
+            msg['message_id'])
+        self.assertEqual(record, {
+            'hops': [
+                [['CONVERSATION:app1:conv1', 'default'],
+                 ['TRANSPORT_TAG:pool1:1234', 'default']],
+            ],
+            'tag': ['pool1', '1234'],
+            'user_account': self.user_account_key,
+        })
+
+    @inlineCallbacks
+    def test_event_routing_from_stored_hops(self):
+        yield self.get_dispatcher()
+        msg = self.with_md(self.mkmsg_out(), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        # The outbound message is not in the message store, so the event
+        # can only be routed using the stored hops.
+        ack = self.mkmsg_ack(user_message_id=msg['message_id'])
+        yield self.dispatch_event(ack, 'sphex')
+        self.assert_rkeys_used(
+            'app1.outbound', 'sphex.outbound', 'sphex.event', 'app1.event')
+        [sent_msg] = self.get_dispatched_outbound('sphex')
+        self.with_md(ack, tag=('pool1', '1234'), conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ], outbound_hops_from=sent_msg)
+        self.assertEqual([ack], self.get_dispatched_events('app1'))
+
+    def get_sharded_dispatcher(self, owner):
+        """Return a dispatcher that is one of two shards. If `owner` is true
+        the dispatcher owns the test account.
+        """
+        owner_shard = AccountShardRing(2).shard_for(self.user_account_key)
+        if owner:
+            shard_index = owner_shard
+        else:
+            shard_index = 1 - owner_shard
+        return self.get_dispatcher(shard_count=2, shard_index=shard_index)
+
+    @inlineCallbacks
+    def test_inbound_message_forwarded_to_owning_shard(self):
+        dispatcher = yield self.get_sharded_dispatcher(owner=False)
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        config = yield dispatcher.get_config(msg)
+        yield dispatcher.process_inbound(config, msg, 'sphex')
+        self.assertEqual([], self.get_dispatched_inbound('app1'))
+        self.assertEqual(0, len(dispatcher._routing_table_cache))
+        owner_shard = 1 - dispatcher.shard_index
+        rkey = 'routing_table_dispatcher.shard.%d' % (owner_shard,)
+        [shard_msg] = self._amqp.get_messages('vumi', rkey)
+        self.assertEqual(shard_msg['message_type'], 'inbound')
+        self.assertEqual(shard_msg['connector_name'], 'sphex')
+        self.assertEqual(
+            shard_msg['payload']['helper_metadata']['go']['user_account'],
+            self.user_account_key)
+
+    @inlineCallbacks
+    def test_forwarded_inbound_message_routed_by_owning_shard(self):
+        dispatcher = yield self.get_sharded_dispatcher(owner=True)
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"),
+                           user_account=self.user_account_key)
+        yield dispatcher.consume_shard_message(ShardMessage(
+            message_type='inbound', connector_name='sphex',
+            payload=msg.payload))
+        self.with_md(msg, conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ])
+        self.assertEqual([msg], self.get_dispatched_inbound('app1'))
+
+    @inlineCallbacks
+    def test_invalidate_routing_table_forwarded_to_owning_shard(self):
+        dispatcher = yield self.get_sharded_dispatcher(owner=False)
+        dispatcher.process_command_invalidate_routing_table(
+            self.user_account_key)
+        owner_shard = 1 - dispatcher.shard_index
+        rkey = 'routing_table_dispatcher.shard.%d' % (owner_shard,)
+        [shard_msg] = self._amqp.get_messages('vumi', rkey)
+        self.assertEqual(shard_msg['message_type'], 'invalidate_routing_table')
+        self.assertEqual(shard_msg['payload'], {
+            'user_account_key': self.user_account_key})
+
+    @inlineCallbacks
+    def test_hop_timing(self):
+        dispatcher = yield self.get_dispatcher(hop_timing=True)
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        [app_msg] = self.get_dispatched_inbound('app1')
+        [[received, published]] = RoutingMetadata(app_msg).get_hop_times()
+        self.assertTrue(received <= published)
+        histograms = dispatcher.metrics._histograms
+        self.assertEqual(1, len(histograms['routing.hop_time']._samples))
+        self.assertEqual(
+            1, len(histograms['routing.persistence_time']._samples))
+
+        reply = app_msg.reply(content="Reply")
+        yield self.dispatch_outbound(reply, 'app1')
+        self.assertEqual(2, len(histograms['routing.hop_time']._samples))
+        self.assertEqual(
+            1, len(histograms['routing.reply_time.app1']._samples))
+
+    @inlineCallbacks
+    def test_hop_timing_disabled(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(self.mkmsg_in(), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        [app_msg] = self.get_dispatched_inbound('app1')
+        self.assertEqual(None, RoutingMetadata(app_msg).get_hop_times())
+        self.assertEqual({}, dispatcher.metrics._histograms)
+
+    @inlineCallbacks
+    def test_compact_hops(self):
+        yield self.get_dispatcher(compact_hops=True)
+        msg = self.with_md(self.mkmsg_out(), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        [sent_msg] = self.get_dispatched_outbound('sphex')
+        self.assertEqual(sent_msg['routing_metadata'], {
+            'go_connectors': [
+                'CONVERSATION:app1:conv1', 'TRANSPORT_TAG:pool1:1234'],
+            'go_hops': [[[0, 'default'], [1, 'default']]],
+        })
+
+        ack = self.mkmsg_ack(user_message_id=msg['message_id'])
+        yield self.dispatch_event(ack, 'sphex')
+        [app_ack] = self.get_dispatched_events('app1')
+        rmeta = RoutingMetadata(app_ack)
+        self.assertEqual([
+            [['TRANSPORT_TAG:pool1:1234', 'default'],
+             ['CONVERSATION:app1:conv1', 'default']],
+        ], rmeta.get_hops())
+        self.assertEqual([
+            [['CONVERSATION:app1:conv1', 'default'],
+             ['TRANSPORT_TAG:pool1:1234', 'default']],
+        ], rmeta.get_outbound_hops())
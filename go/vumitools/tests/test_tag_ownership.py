@@ -0,0 +1,37 @@
+"""Tests for go.vumitools.tag_ownership."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from go.vumitools.tag_ownership import TagOwnershipManager
+from go.vumitools.tests.utils import GoTestCase
+
+
+class TestTagOwnershipManager(GoTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        super(TestTagOwnershipManager, self).setUp()
+        redis = yield self.get_redis_manager()
+        self.tom = TagOwnershipManager(redis)
+
+    @inlineCallbacks
+    def test_get_owner_missing(self):
+        self.assertEqual((yield self.tom.get_owner(("pool", "tag"))), None)
+
+    @inlineCallbacks
+    def test_set_owner(self):
+        yield self.tom.set_owner(("pool", "tag1"), "user-1")
+        yield self.tom.set_owner(("pool", "tag2"), "user-2")
+        self.assertEqual((yield self.tom.get_owner(("pool", "tag1"))),
+                         "user-1")
+        self.assertEqual((yield self.tom.get_owner(("pool", "tag2"))),
+                         "user-2")
+        self.assertEqual((yield self.tom.get_owner(("other", "tag1"))), None)
+
+    @inlineCallbacks
+    def test_clear_owner(self):
+        yield self.tom.set_owner(("pool", "tag1"), "user-1")
+        yield self.tom.clear_owner(("pool", "tag1"))
+        self.assertEqual((yield self.tom.get_owner(("pool", "tag1"))), None)
+        # Clearing a missing owner is harmless.
+        yield self.tom.clear_owner(("pool", "tag1"))
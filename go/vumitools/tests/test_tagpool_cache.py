@@ -0,0 +1,106 @@
+"""Tests for go.vumitools.tagpool_cache."""
+
+import gc
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.components.tagpool import TagpoolManager
+from vumi.blinkenlights.metrics import MetricManager
+
+from go.vumitools import tagpool_cache
+from go.vumitools.tagpool_cache import (
+    CachingTagpoolManager, shared_metadata_cache)
+from go.vumitools.tests.utils import GoTestCase
+
+
+class DummyWorker(object):
+    pass
+
+
+class TestCachingTagpoolManager(GoTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        super(TestCachingTagpoolManager, self).setUp()
+        redis = yield self.get_redis_manager()
+        self.tpm = TagpoolManager(redis)
+        self.clock = Clock()
+        self.metric_manager = MetricManager("test.")
+        self.cached_tpm = CachingTagpoolManager(
+            self.tpm, ttl=10, metric_manager=self.metric_manager,
+            clock=self.clock)
+        yield self.tpm.set_metadata("pool", {"transport_name": "foo"})
+
+    def poll(self, name):
+        return sum(v for _, v in self.metric_manager[name].poll())
+
+    @inlineCallbacks
+    def test_get_metadata_cached(self):
+        metadata = yield self.cached_tpm.get_metadata("pool")
+        self.assertEqual(metadata, {"transport_name": "foo"})
+        yield self.tpm.set_metadata("pool", {"transport_name": "bar"})
+        metadata = yield self.cached_tpm.get_metadata("pool")
+        self.assertEqual(metadata, {"transport_name": "foo"})
+        self.assertEqual(self.cached_tpm.hits, 1)
+        self.assertEqual(self.cached_tpm.misses, 1)
+        self.assertEqual(self.poll(CachingTagpoolManager.HITS_METRIC), 1)
+        self.assertEqual(self.poll(CachingTagpoolManager.MISSES_METRIC), 1)
+
+    @inlineCallbacks
+    def test_get_metadata_expires(self):
+        yield self.cached_tpm.get_metadata("pool")
+        yield self.tpm.set_metadata("pool", {"transport_name": "bar"})
+        self.clock.advance(9)
+        metadata = yield self.cached_tpm.get_metadata("pool")
+        self.assertEqual(metadata, {"transport_name": "foo"})
+        self.clock.advance(1)
+        metadata = yield self.cached_tpm.get_metadata("pool")
+        self.assertEqual(metadata, {"transport_name": "bar"})
+        self.assertEqual(self.cached_tpm.misses, 2)
+
+    @inlineCallbacks
+    def test_set_metadata_invalidates(self):
+        yield self.cached_tpm.get_metadata("pool")
+        yield self.cached_tpm.set_metadata("pool", {"transport_name": "bar"})
+        metadata = yield self.cached_tpm.get_metadata("pool")
+        self.assertEqual(metadata, {"transport_name": "bar"})
+
+    @inlineCallbacks
+    def test_invalidate(self):
+        yield self.cached_tpm.get_metadata("pool")
+        yield self.tpm.set_metadata("pool", {"transport_name": "bar"})
+        self.cached_tpm.invalidate()
+        metadata = yield self.cached_tpm.get_metadata("pool")
+        self.assertEqual(metadata, {"transport_name": "bar"})
+
+    @inlineCallbacks
+    def test_proxies_other_methods(self):
+        yield self.cached_tpm.declare_tags([("pool", "tag1")])
+        tag = yield self.cached_tpm.acquire_tag("pool")
+        self.assertEqual(tag, ("pool", "tag1"))
+
+    @inlineCallbacks
+    def test_shared_metadata_cache(self):
+        worker = DummyWorker()
+        cache = shared_metadata_cache(worker, self.tpm)
+        self.assertTrue(cache is shared_metadata_cache(worker, self.tpm))
+        self.assertFalse(
+            cache is shared_metadata_cache(DummyWorker(), self.tpm))
+
+        cached_tpm1 = CachingTagpoolManager(self.tpm, cache=cache)
+        cached_tpm2 = CachingTagpoolManager(self.tpm, cache=cache)
+        yield cached_tpm1.get_metadata("pool")
+        yield cached_tpm2.get_metadata("pool")
+        self.assertEqual(cached_tpm1.misses, 1)
+        self.assertEqual(cached_tpm2.hits, 1)
+
+    def test_shared_metadata_cache_discarded_with_worker(self):
+        caches = tagpool_cache._worker_metadata_caches
+        worker = DummyWorker()
+        shared_metadata_cache(worker, self.tpm)
+        self.assertTrue(worker in caches)
+        worker_count = len(caches)
+        del worker
+        gc.collect()
+        self.assertEqual(worker_count - 1, len(caches))
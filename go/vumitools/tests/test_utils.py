@@ -86,6 +86,56 @@ class MessageMetadataHelperTestCase(GoTestCase):
         md_conv = yield md.get_conversation()
         self.assertEqual(md_conv.key, conversation.key)
 
+    @inlineCallbacks
+    def test_get_conversation_memoized(self):
+        conversation = yield self.create_conversation()
+        msg = self.mk_msg(go_metadata={
+            'user_account': self.user_api.user_account_key,
+            'conversation_key': conversation.key,
+        })
+        md_conv = yield self.mk_md(msg).get_conversation()
+        # A new helper for the same message reuses the loaded conversation.
+        other_md_conv = yield self.mk_md(msg).get_conversation()
+        self.assertIdentical(md_conv, other_md_conv)
+
+    def test_get_user_api_memoized(self):
+        msg = self.mk_msg(go_metadata={
+            'user_account': self.user_api.user_account_key})
+        self.assertIdentical(
+            self.mk_md(msg).get_user_api(), self.mk_md(msg).get_user_api())
+
+    @inlineCallbacks
+    def test_get_contact(self):
+        yield self.user_api.contact_store.contacts.enable_search()
+        msg = self.mk_msg(go_metadata={
+            'user_account': self.user_api.user_account_key})
+        msg['transport_type'] = 'sms'
+        md = self.mk_md(msg)
+        contact = yield md.get_contact()
+        self.assertEqual(contact.msisdn, u'+from@domain.org')
+        self.assertIdentical(contact, (yield self.mk_md(msg).get_contact()))
+
+    @inlineCallbacks
+    def test_get_conversation_batch_key(self):
+        conversation = yield self.create_conversation()
+        go_metadata = {
+            'user_account': self.user_api.user_account_key,
+            'conversation_key': conversation.key,
+        }
+        md = self.mk_md(go_metadata=go_metadata)
+        batch_key = yield md.get_conversation_batch_key()
+        self.assertEqual(batch_key, conversation.batch.key)
+        cache_key = (
+            'conversation', self.user_api.user_account_key, conversation.key)
+        self.assertEqual(
+            self.vumi_api.batch_key_cache.get(cache_key), batch_key)
+
+        # Later messages use the cached batch key.
+        self.vumi_api.batch_key_cache.set(cache_key, u'cached-batch')
+        md = self.mk_md(go_metadata=go_metadata)
+        batch_key = yield md.get_conversation_batch_key()
+        self.assertEqual(batch_key, u'cached-batch')
+
     def test_get_conversation_info(self):
         md = self.mk_md()
         self.assertEqual(md.get_conversation_info(), None)
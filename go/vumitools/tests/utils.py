@@ -13,7 +13,7 @@ from vumi.message import TransportEvent
 from vumi.application.tests.test_base import ApplicationTestCase
 from vumi.tests.utils import VumiWorkerTestCase, PersistenceMixin
 
-from go.vumitools.api import VumiApiCommand, VumiApi
+from go.vumitools.api import VumiApiCommand, VumiApi, vumi_api_registry
 from go.vumitools.account import UserAccount, RoutingTableHelper
 from go.vumitools.contact import Contact, ContactGroup
 from go.vumitools.utils import MessageMetadataHelper
@@ -73,6 +73,9 @@ class FakeAmqpConnection(object):
 class GoPersistenceMixin(PersistenceMixin):
     def _persist_setUp(self):
         self._users_created = 0
+        # Shared APIs left over from earlier tests use managers that have
+        # since been purged.
+        vumi_api_registry.clear()
         return super(GoPersistenceMixin, self)._persist_setUp()
 
     @PersistenceMixin.sync_or_async
@@ -262,6 +265,11 @@ class GoAppWorkerTestMixin(GoWorkerTestMixin):
                 cmd.payload['command'], *cmd.payload['args'],
                 **cmd.payload['kwargs'])
 
+    def notify_config_changed(self, conversation):
+        return self.dispatch_command(
+            'config_changed', user_account_key=conversation.user_account.key,
+            conversation_key=conversation.key)
+
     @inlineCallbacks
     def stop_conversation(self, conversation):
         old_cmds = len(self.get_dispatcher_commands())
@@ -1,6 +1,10 @@
 # -*- test-case-name: go.vumitools.tests.test_utils -*-
 
+from twisted.internet.defer import returnValue
+
 from vumi.middleware.tagger import TaggingMiddleware
+from vumi.persist.model import Manager
+
 from go.vumitools.middleware import OptOutMiddleware
 
 
@@ -25,9 +29,12 @@ class MessageMetadataHelper(object):
        (Between different middlewares, for example.)
     """
 
-    def __init__(self, vumi_api, message):
+    def __init__(self, vumi_api, message, conversation_cache=None):
         self.vumi_api = vumi_api
+        self.manager = vumi_api.manager
         self.message = message
+        # A worker's cache of conversations (see GoWorkerMixin).
+        self.conversation_cache = conversation_cache
 
         # Easier access to metadata.
         message_metadata = message.get('helper_metadata', {})
@@ -58,15 +65,96 @@ class MessageMetadataHelper(object):
         return self._go_metadata['user_account']
 
     def get_user_api(self):
-        return self.vumi_api.get_user_api(self.get_account_key())
+        account_key = self.get_account_key()
+        stash_key = ('user_api', account_key)
+        user_api = self._store_objects.get(stash_key)
+        if user_api is None:
+            user_api = self.vumi_api.get_user_api(account_key)
+            self._store_objects[stash_key] = user_api
+        return user_api
 
     def get_conversation_key(self):
         # TODO: Better exception.
         return self._go_metadata['conversation_key']
 
     def get_conversation(self):
-        return self.get_user_api().get_wrapped_conversation(
-            self.get_conversation_key())
+        return self._get_conversation(
+            self.get_account_key(), self.get_conversation_key())
+
+    @Manager.calls_manager
+    def _get_conversation(self, account_key, conversation_key):
+        stash_key = ('conversation', account_key, conversation_key)
+        conversation = self._store_objects.get(stash_key)
+        if conversation is not None:
+            returnValue(conversation)
+        cache_key = (account_key, conversation_key)
+        if self.conversation_cache is not None:
+            conversation = self.conversation_cache.get(cache_key)
+        if conversation is None:
+            conversation = yield self.get_user_api().get_wrapped_conversation(
+                conversation_key)
+            if (conversation is not None
+                    and self.conversation_cache is not None):
+                self.conversation_cache.set(cache_key, conversation)
+        if conversation is not None:
+            self._store_objects[stash_key] = conversation
+        returnValue(conversation)
+
+    @Manager.calls_manager
+    def get_conversation_batch_key(self):
+        """Return the batch key of the message's conversation.
+
+        The batch key is taken from a conversation already stashed on the
+        message or from the API's batch key cache if possible, so that the
+        conversation only needs to be loaded the first time. Batch keys
+        never change, so cached ones are never invalidated.
+        """
+        batch_key = self.get_cached_conversation_batch_key()
+        if batch_key is not None:
+            returnValue(batch_key)
+        conversation = yield self.get_conversation()
+        self.vumi_api.batch_key_cache.set(
+            ('conversation', self.get_account_key(),
+             self.get_conversation_key()),
+            conversation.batch.key)
+        returnValue(conversation.batch.key)
+
+    def get_cached_conversation_batch_key(self):
+        """Return the batch key of the message's conversation if it is
+        known without loading the conversation, or `None` if it isn't.
+        """
+        account_key = self.get_account_key()
+        conversation_key = self.get_conversation_key()
+        conversation = self._store_objects.get(
+            ('conversation', account_key, conversation_key))
+        if conversation is None and self.conversation_cache is not None:
+            conversation = self.conversation_cache.get(
+                (account_key, conversation_key))
+        if conversation is not None:
+            return conversation.batch.key
+        return self.vumi_api.batch_key_cache.get(
+            ('conversation', account_key, conversation_key))
+
+    @Manager.calls_manager
+    def get_contact(self, create=True):
+        """Return the contact for the user the message is from (or, for an
+        outbound message, to).
+
+        :param bool create:
+            Whether to create the contact if it doesn't exist.
+        """
+        user_api = self.get_user_api()
+        delivery_class = user_api.delivery_class_for_msg(self.message)
+        addr = self.message.user()
+        stash_key = (
+            'contact', user_api.user_account_key, delivery_class, addr)
+        contact = self._store_objects.get(stash_key)
+        if contact is None:
+            contact = yield user_api.contact_store.contact_for_addr(
+                delivery_class, addr, create=create)
+            if contact is not None:
+                self._store_objects[stash_key] = contact
+        returnValue(contact)
 
     def get_conversation_info(self):
         conversation_info = {}
@@ -98,8 +186,35 @@ class MessageMetadataHelper(object):
         return self._go_metadata['router_key']
 
     def get_router(self):
-        return self.get_user_api().get_router(
-            self.get_router_key())
+        return self._get_router(self.get_account_key(), self.get_router_key())
+
+    @Manager.calls_manager
+    def _get_router(self, account_key, router_key):
+        stash_key = ('router', account_key, router_key)
+        router = self._store_objects.get(stash_key)
+        if router is None:
+            router = yield self.get_user_api().get_router(router_key)
+            if router is not None:
+                self._store_objects[stash_key] = router
+        returnValue(router)
+
+    @Manager.calls_manager
+    def get_router_batch_key(self):
+        """Return the batch key of the message's router.
+
+        See :meth:`get_conversation_batch_key`.
+        """
+        account_key = self.get_account_key()
+        router_key = self.get_router_key()
+        router = self._store_objects.get(('router', account_key, router_key))
+        if router is None:
+            cache_key = ('router', account_key, router_key)
+            batch_key = self.vumi_api.batch_key_cache.get(cache_key)
+            if batch_key is not None:
+                returnValue(batch_key)
+            router = yield self.get_router()
+            self.vumi_api.batch_key_cache.set(cache_key, router.batch.key)
+        returnValue(router.batch.key)
 
     def get_router_info(self):
         router_info = {}